@@ -0,0 +1 @@
+../../lib/__init__.py
\ No newline at end of file
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from __armando__ import Armando
+
+###
+Armando.initialize()
+###
+
+from config import Config
+from genrules import RulesGenerator
+
+class RulesBenchmark(object):
+    """
+    Benchmark of the rules engine over synthetic rules files of growing size.
+    For each size it times the Rules construction, pattern_match,
+    get_rules_by_patterns and run_action, and it reports throughput,
+    p50/p99 latencies and peak memory as a JSON document.
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __default_sizes = [(100, 50, 100), (1000, 200, 1000), (5000, 500, 5000)]
+
+    def __init__(self, sizes=None, utterances=1000, constructions=3, shell_actions=20, seed=0):
+        """
+        sizes -- List of (patterns, actions, rules) tuples (default: 100/1000/5000 patterns)
+        utterances -- Number of utterances matched for each size
+        constructions -- Number of times the Rules object is built for each size
+        shell_actions -- Number of shell action runs for each size
+        seed -- Seed of the rules and utterances generator
+        """
+        self.sizes = sizes or self.__default_sizes
+        self.utterances = utterances
+        self.constructions = constructions
+        self.shell_actions = shell_actions
+        self.seed = seed
+
+    @classmethod
+    def __percentile(cls, sorted_values, percentile):
+        " Nearest-rank percentile of an already sorted list "
+        if not sorted_values:
+            return None
+        rank = max(0, min(len(sorted_values)-1,
+            int(round(percentile / 100.0 * len(sorted_values) + 0.5)) - 1))
+        return sorted_values[rank]
+
+    @classmethod
+    def __get_stats(cls, latencies, peak_memory=None):
+        latencies = sorted(latencies)
+        total = sum(latencies)
+        stats = {
+            'count': len(latencies),
+            'total_s': total,
+            'throughput_per_s': len(latencies) / total if total else None,
+            'mean_ms': 1000 * total / len(latencies) if latencies else None,
+            'p50_ms': 1000 * cls.__percentile(latencies, 50) if latencies else None,
+            'p99_ms': 1000 * cls.__percentile(latencies, 99) if latencies else None,
+            'max_ms': 1000 * latencies[-1] if latencies else None,
+        }
+
+        if peak_memory is not None:
+            stats['peak_memory_bytes'] = peak_memory
+        return stats
+
+    @classmethod
+    def __timed(cls, function, args_list):
+        " Call function(*args) for each args in args_list, return (latencies, results, peak_memory) "
+
+        # Memory is traced on a separate run, as tracemalloc slows allocations down
+        latencies = []
+        results = []
+        for args in args_list:
+            start_time = time.perf_counter()
+            results.append(function(*args))
+            latencies.append(time.perf_counter() - start_time)
+
+        tracemalloc.start()
+        try:
+            for args in args_list:
+                function(*args)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        return latencies, results, peak_memory
+
+    def __bench_construction(self, rules_file, **kwargs):
+        from rules import Rules
+
+        # Memory is traced on a separate run, as tracemalloc slows allocations down
+        latencies = []
+        for i in range(self.constructions):
+            start_time = time.perf_counter()
+            rules = Rules(rules_file, **kwargs)
+            latencies.append(time.perf_counter() - start_time)
+            del rules
+
+        tracemalloc.start()
+        try:
+            rules = Rules(rules_file, **kwargs)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        return rules, self.__get_stats(latencies, peak_memory)
+
+    def __bench_pattern_match(self, rules, utterances):
+        # Warm up the lazily initialized structures before measuring
+        for utterance in utterances[:10]:
+            rules.pattern_match(utterance)
+
+        start_time = time.perf_counter()
+        matches = [rules.pattern_match(_) for _ in utterances]
+        total = time.perf_counter() - start_time
+
+        latencies, _, peak_memory = self.__timed(rules.pattern_match, [(_,) for _ in utterances])
+        stats = self.__get_stats(latencies, peak_memory)
+        # Throughput measured without the per-call timers
+        stats['throughput_per_s'] = len(utterances) / total if total else None
+        stats['matched_ratio'] = len([_ for _ in matches if _]) / len(utterances) if utterances else None
+        return matches, stats
+
+    def __bench_get_rules_by_patterns(self, rules, matches):
+        pattern_ids = [([_['id'] for _ in match],) for match in matches]
+        latencies, results, peak_memory = self.__timed(rules.get_rules_by_patterns, pattern_ids)
+
+        stats = self.__get_stats(latencies, peak_memory)
+        stats['resolved_ratio'] = len([_ for _ in results if _]) / len(results) if results else None
+        return stats
+
+    def __bench_run_action(self, rules, matches, action_type, count):
+        actions = [_ for _ in rules.get_actions() if _.get_type() == action_type]
+        if not actions:
+            return None
+
+        arguments = [match[0]['attributes'] for match in matches if match] or [{}]
+        calls = [(actions[i % len(actions)].get_id(), arguments[i % len(arguments)])
+            for i in range(count)]
+
+        latencies, _, peak_memory = self.__timed(rules.run_action, calls)
+        return self.__get_stats(latencies, peak_memory)
+
+    def run_size(self, patterns, actions, rules_count, work_dir):
+        " Run the benchmarks over a generated rules file of the given size "
+
+        generator = RulesGenerator(patterns=patterns, actions=actions,
+            rules=rules_count, seed=self.seed)
+
+        rules_file = os.path.join(work_dir, 'rules-%d-%d-%d.xml' % (patterns, actions, rules_count))
+        generator.write(rules_file)
+        utterances = generator.get_utterances(self.utterances)
+
+        benchmarks = {}
+        rules, benchmarks['construction'] = self.__bench_construction(
+            rules_file, use_cache=False, streaming=False, watch=False)
+        _, benchmarks['construction_streaming'] = self.__bench_construction(
+            rules_file, use_cache=False, streaming=True, watch=False)
+
+        matches, benchmarks['pattern_match'] = self.__bench_pattern_match(rules, utterances)
+        benchmarks['get_rules_by_patterns'] = self.__bench_get_rules_by_patterns(rules, matches)
+        benchmarks['run_action_python'] = self.__bench_run_action(rules, matches, 'python', self.utterances)
+        benchmarks['run_action_shell'] = self.__bench_run_action(rules, matches, 'shell', self.shell_actions)
+
+        return {
+            'size': {
+                'patterns': patterns,
+                'actions': actions,
+                'rules': rules_count,
+                'rules_file_bytes': os.path.getsize(rules_file),
+            },
+            'benchmarks': benchmarks,
+        }
+
+    def run(self):
+        " Run the benchmarks for all the sizes and return the report as a dictionary "
+
+        work_dir = tempfile.mkdtemp(prefix='armando-bench-')
+        try:
+            results = [self.run_size(patterns, actions, rules, work_dir)
+                for (patterns, actions, rules) in self.sizes]
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        return {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': self.seed,
+            'utterances': self.utterances,
+            'results': results,
+        }
+
+def parse_sizes(sizes):
+    " Parse a list of sizes in the format patterns[xactions[xrules]],... "
+
+    parsed = []
+    for size in sizes.split(','):
+        values = [int(_) for _ in size.strip().lower().split('x')]
+        if len(values) == 1:
+            values = [values[0], max(1, values[0] // 2), values[0]]
+        elif len(values) == 2:
+            values.append(values[0])
+        elif len(values) != 3:
+            raise argparse.ArgumentTypeError('Invalid size [%s]' % size)
+        parsed.append(tuple(values))
+    return parsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the rules engine over synthetic rules files')
+    parser.add_argument('-s', '--sizes', type=parse_sizes,
+        help='Comma-separated sizes as patterns[xactions[xrules]] (default: 100x50x100,1000x200x1000,5000x500x5000)')
+    parser.add_argument('-u', '--utterances', type=int, default=1000, help='Utterances matched for each size')
+    parser.add_argument('-c', '--constructions', type=int, default=3, help='Rules constructions timed for each size')
+    parser.add_argument('--shell-actions', type=int, default=20, help='Shell action runs for each size')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
+        'conf', 'main.bench.conf'), help='Armando configuration file')
+    parser.add_argument('-o', '--output', help='Output JSON file (default: stdout)')
+    args = parser.parse_args()
+
+    Config.get_config(args.config)
+    report = RulesBenchmark(sizes=args.sizes, utterances=args.utterances,
+        constructions=args.constructions, shell_actions=args.shell_actions,
+        seed=args.seed).run()
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
+
+# vim:sw=4:ts=4:et:
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import argparse
+import random
+import sys
+
+from xml.sax.saxutils import escape
+
+class RulesGenerator(object):
+    """
+    Generator of synthetic rules.xml files, used to benchmark the rules engine.
+    Patterns mix placeholder-heavy matches, optional groups and alternations,
+    rules mix single patterns and AND/OR structures, and the generator can
+    produce utterances matching (or not matching) the generated patterns.
+    The output is fully determined by the sizes and the seed.
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __syllables = ['ba', 'ko', 'ri', 'tu', 'me', 'sa', 'lo', 'ni', 'de', 'fu',
+                   'ga', 'pe', 'zo', 'vi', 'ha', 'mu']
+
+    __pattern_templates = [
+        # (match, number of placeholders)
+        (r'%(verb)s\s*.*%(noun)s\s*{arg0[regex-index=1]}', 1),
+        (r'%(verb)s\s*.*%(noun)s\s*(%(key1)s {arg0[regex-index=2]}\s*)?(%(key2)s {arg1[regex-index=4]}\s*)?', 2),
+        (r'(%(verb)s|%(alt)s)\s+(the\s+)?%(noun)s\s+{arg0[regex-index=3]}', 1),
+        (r'%(verb)s\s+{arg0[regex-index=1]}\s+%(key1)s\s+%(noun)s\s+{arg1[regex-index=2]}', 2),
+    ]
+
+    def __init__(self, patterns, actions, rules, seed=0):
+        """
+        patterns -- Number of patterns to be generated
+        actions -- Number of actions to be generated
+        rules -- Number of rules to be generated
+        seed -- Seed of the random generator
+        """
+        self.n_patterns = patterns
+        self.n_actions = actions
+        self.n_rules = rules
+        self.__random = random.Random(seed)
+        self.__words = self.__build_vocabulary(max(64, patterns // 2))
+
+        self.patterns = [self.__build_pattern(i) for i in range(patterns)]
+        self.actions = [self.__build_action(i) for i in range(actions)]
+        self.rules = [self.__build_rule(i) for i in range(rules)]
+
+    def __build_vocabulary(self, size):
+        words = set()
+        while len(words) < size:
+            words.add(''.join(self.__random.choice(self.__syllables)
+                for _ in range(self.__random.randint(2, 4))))
+        return sorted(words)
+
+    def __build_pattern(self, index):
+        template, n_args = self.__pattern_templates[index % len(self.__pattern_templates)]
+        words = dict(zip(['verb', 'noun', 'alt', 'key1', 'key2'],
+            self.__random.sample(self.__words, 5)))
+
+        return {
+            'id': 'pattern-%d' % index,
+            'match': template % words,
+            'template': index % len(self.__pattern_templates),
+            'words': words,
+            'args': n_args,
+        }
+
+    def __build_action(self, index):
+        # One action out of ten runs a shell command, the others are python actions
+        if index % 10 == 9:
+            return {
+                'id': 'action-%d' % index,
+                'type': 'shell',
+                'code': 'true "$$arg0$$" "$$arg1$$"',
+            }
+
+        return {
+            'id': 'action-%d' % index,
+            'type': 'python',
+            'code': 'len("$$arg0$$") + len("arg1=$$arg1$$")',
+        }
+
+    def __build_rule(self, index):
+        kind = self.__random.random()
+        pattern_ids = [_['id'] for _ in self.__random.sample(self.patterns, min(3, len(self.patterns)))]
+
+        if kind < 0.6 or len(pattern_ids) < 2:
+            on = ('pattern', pattern_ids[:1])
+        elif kind < 0.85:
+            on = ('and', pattern_ids[:self.__random.randint(2, len(pattern_ids))])
+        else:
+            on = ('or', pattern_ids[:2])
+
+        n_actions = min(self.__random.randint(1, 3), len(self.actions))
+        return {
+            'id': 'rule-%d' % index,
+            'on': on,
+            'then': [_['id'] for _ in self.__random.sample(self.actions, n_actions)],
+        }
+
+    def __build_utterance(self, pattern):
+        words = pattern['words']
+        args = [' '.join(self.__random.sample(self.__words, self.__random.randint(1, 3)))
+            for _ in range(pattern['args'])]
+
+        if pattern['template'] == 0:
+            return 'please %s some %s %s' % (words['verb'], words['noun'], args[0])
+        elif pattern['template'] == 1:
+            return '%s the %s %s %s %s %s' % (words['verb'], words['noun'],
+                words['key1'], args[0], words['key2'], args[1])
+        elif pattern['template'] == 2:
+            return '%s the %s %s' % (words['alt'], words['noun'], args[0])
+        return '%s %s %s %s %s' % (words['verb'], args[0], words['key1'], words['noun'], args[1])
+
+    def get_utterances(self, count, match_ratio=0.8):
+        """
+        Return [count] utterances, where about [match_ratio] of them are built to
+        match a randomly chosen pattern and the others are random sentences
+        """
+
+        utterances = []
+        for i in range(count):
+            if self.patterns and self.__random.random() < match_ratio:
+                utterances.append(self.__build_utterance(self.__random.choice(self.patterns)))
+            else:
+                utterances.append(' '.join(self.__random.sample(self.__words, 6)))
+        return utterances
+
+    def to_xml(self):
+        " Return the generated rules as a rules.xml document "
+
+        lines = ['<app>', '\t<patterns>']
+        for pattern in self.patterns:
+            lines.append('\t\t<pattern id="%s">' % pattern['id'])
+            lines.append('\t\t\t<match><![CDATA[%s]]></match>' % pattern['match'])
+            lines.append('\t\t</pattern>')
+
+        lines += ['\t</patterns>', '', '\t<actions>']
+        for action in self.actions:
+            lines.append('\t\t<action id="%s" type="%s" args="arg0,arg1"><![CDATA[%s]]></action>'
+                % (action['id'], action['type'], action['code']))
+
+        lines += ['\t</actions>', '', '\t<rules>']
+        for rule in self.rules:
+            tag, pattern_ids = rule['on']
+            lines += ['\t\t<rule id="%s">' % rule['id'], '\t\t\t<on>']
+
+            if tag == 'pattern':
+                lines.append('\t\t\t\t<pattern id="%s"/>' % escape(pattern_ids[0]))
+            else:
+                lines.append('\t\t\t\t<%s>' % tag)
+                lines += ['\t\t\t\t\t<pattern id="%s"/>' % escape(_) for _ in pattern_ids]
+                lines.append('\t\t\t\t</%s>' % tag)
+
+            lines += ['\t\t\t</on>', '\t\t\t<then>']
+            lines += ['\t\t\t\t<action id="%s"/>' % escape(_) for _ in rule['then']]
+            lines += ['\t\t\t</then>', '\t\t</rule>']
+
+        lines += ['\t</rules>', '</app>', '']
+        return '\n'.join(lines)
+
+    def write(self, rules_file):
+        " Write the generated rules to [rules_file] "
+        with open(rules_file, 'w') as fp:
+            fp.write(self.to_xml())
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic rules.xml file')
+    parser.add_argument('-p', '--patterns', type=int, default=100, help='Number of patterns')
+    parser.add_argument('-a', '--actions', type=int, default=50, help='Number of actions')
+    parser.add_argument('-r', '--rules', type=int, default=100, help='Number of rules')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('-o', '--output', help='Output file (default: stdout)')
+    args = parser.parse_args()
+
+    generator = RulesGenerator(patterns=args.patterns, actions=args.actions,
+        rules=args.rules, seed=args.seed)
+
+    if args.output:
+        generator.write(args.output)
+    else:
+        sys.stdout.write(generator.to_xml())
+
+if __name__ == '__main__':
+    main()
+
+# vim:sw=4:ts=4:et:
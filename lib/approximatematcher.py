@@ -0,0 +1,204 @@
+import collections
+import itertools
+import re
+
+from config import Config
+
+class ApproximateMatcher(object):
+    """
+    Approximate matching engine for misrecognized utterances (e.g. "plai some
+    musik" for a "play ... music" pattern). The literal words required by each
+    pattern (see Pattern.get_literals) are indexed by character trigrams: the
+    index narrows the patterns down to the few sharing enough trigrams with the
+    utterance, their literals are aligned to the most similar words of the
+    utterance, and the pattern regex is finally run on the corrected utterance
+    to extract the attributes.
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __default_threshold = 0.6
+    __default_max_candidates = 8
+    # Literals shorter than this don't have enough trigrams to be compared
+    # reliably, they must appear verbatim in the utterance
+    __min_literal_length = 3
+    __token_regex = re.compile(r'\w+')
+
+    def __init__(self, patterns, threshold=None, max_candidates=None):
+        """
+        patterns -- List of Pattern objects, in the order they should be matched
+        threshold -- Minimum trigram similarity, between 0 and 1, between each literal
+            of a pattern and the word of the utterance it is aligned to
+            (default: config[rules.approximate_threshold] or 0.6)
+        max_candidates -- Maximum number of candidate patterns whose regex is run
+            on the corrected utterance, in order of score (default: 8)
+        """
+        self.__patterns = list(patterns)
+        self.threshold = float(threshold or Config.get_config().get('rules.approximate_threshold') or self.__default_threshold)
+        self.max_candidates = int(max_candidates or self.__default_max_candidates)
+        self.__build_index()
+
+    @classmethod
+    def get_trigrams(cls, word):
+        " Return the set of the trigrams of [word], padded as '  word ' "
+
+        word = '  %s ' % word
+        return set(word[i:i+3] for i in range(len(word)-2))
+
+    @classmethod
+    def get_similarity(cls, trigrams, other_trigrams):
+        " Dice coefficient of two trigram sets "
+
+        if not trigrams or not other_trigrams:
+            return 0.0
+        return 2.0 * len(trigrams & other_trigrams) / (len(trigrams) + len(other_trigrams))
+
+    def __build_index(self):
+        """
+        Index the distinct literals of the patterns.
+        self.__literals maps each literal ID to its (literal, number of trigrams),
+        self.__trigram_literals maps each trigram to the IDs of the literals containing it,
+        self.__literal_patterns maps each literal ID to the indexes of the patterns requiring it
+        and self.__pattern_literals holds, for each pattern, the IDs of its fuzzy literals
+        and the list of its short literals
+        """
+
+        literal_ids = {}
+        self.__literals = []
+        self.__trigram_literals = {}
+        self.__literal_patterns = []
+        self.__pattern_literals = []
+
+        for pattern_index, pattern in enumerate(self.__patterns):
+            fuzzy_literals = []
+            short_literals = []
+
+            for literal in pattern.get_literals():
+                if len(literal) < self.__min_literal_length:
+                    short_literals.append(literal)
+                    continue
+
+                if literal not in literal_ids:
+                    literal_id = literal_ids[literal] = len(self.__literals)
+                    trigrams = self.get_trigrams(literal)
+                    self.__literals.append((literal, len(trigrams)))
+                    self.__literal_patterns.append([])
+
+                    for trigram in trigrams:
+                        self.__trigram_literals.setdefault(trigram, []).append(literal_id)
+
+                fuzzy_literals.append(literal_ids[literal])
+                self.__literal_patterns[literal_ids[literal]].append(pattern_index)
+
+            self.__pattern_literals.append((fuzzy_literals, short_literals))
+
+    def __get_similar_literals(self, tokens):
+        """
+        Return a map literal ID -> (similarity, token index) holding, for each literal,
+        the most similar token of the utterance, if at least as similar as the threshold.
+        A literal contained in a similar token gets similarity 1, as it needs no correction
+        """
+
+        trigram_literals = self.__trigram_literals
+        similar_literals = {}
+
+        for token_index, token in enumerate(tokens):
+            token = token.group(0).lower()
+            trigrams = self.get_trigrams(token)
+            # Minimum number of shared trigrams to reach the threshold with the shortest literal
+            min_hits = self.threshold * (len(trigrams) + self.__min_literal_length) / 2
+
+            hits = collections.Counter(itertools.chain.from_iterable(
+                trigram_literals.get(_, ()) for _ in trigrams))
+
+            for literal_id, count in hits.items():
+                if count < min_hits:
+                    continue
+
+                literal, literal_trigrams = self.__literals[literal_id]
+                similarity = 2.0 * count / (len(trigrams) + literal_trigrams)
+                if similarity < self.threshold:
+                    continue
+                if literal in token:
+                    similarity = 1.0
+
+                if similarity > similar_literals.get(literal_id, (0,))[0]:
+                    similar_literals[literal_id] = (similarity, token_index)
+
+        return similar_literals
+
+    def get_candidates(self, string):
+        """
+        Return a tuple (tokens, candidates), where tokens are the word matches
+        of [string] and candidates are the candidate patterns for [string], as a list
+        of (score, pattern_index, {token_index: literal}) sorted by descending score,
+        where score is the average similarity of the pattern literals with their
+        most similar tokens and the map holds the corrections to apply to the tokens
+        """
+
+        tokens = list(self.__token_regex.finditer(string))
+        similar_literals = self.__get_similar_literals(tokens)
+        hits = collections.Counter(itertools.chain.from_iterable(
+            self.__literal_patterns[_] for _ in similar_literals))
+
+        lower_string = None
+        candidates = []
+
+        for pattern_index, count in hits.items():
+            fuzzy_literals, short_literals = self.__pattern_literals[pattern_index]
+            if count < len(fuzzy_literals):
+                continue
+
+            if short_literals:
+                lower_string = lower_string or string.lower()
+                if any(_ not in lower_string for _ in short_literals):
+                    continue
+
+            score = 0.0
+            corrections = {}
+
+            for literal_id in fuzzy_literals:
+                similarity, token_index = similar_literals[literal_id]
+                score += similarity
+                if similarity < 1:
+                    corrections.setdefault(token_index, self.__literals[literal_id][0])
+
+            candidates.append((score / len(fuzzy_literals), pattern_index, corrections))
+
+        candidates.sort(key=lambda _: (-_[0], _[1]))
+        return tokens, candidates
+
+    def match(self, string, limit=1):
+        """
+        Approximately match [string] and return up to [limit] matched patterns as
+        [{ 'id': pattern_id, 'attributes': { ... }, 'score': similarity }, ...],
+        sorted by descending score. Attributes are extracted from the corrected
+        utterance, and patterns without literals of at least three characters
+        are never matched approximately
+        """
+
+        tokens, candidates = self.get_candidates(string)
+        matches = []
+
+        for score, pattern_index, corrections in candidates[:self.max_candidates]:
+            corrected_string = string
+            for token_index in sorted(corrections.keys(), reverse=True):
+                start, end = tokens[token_index].span()
+                corrected_string = corrected_string[:start] + corrections[token_index] + corrected_string[end:]
+
+            pattern = self.__patterns[pattern_index]
+            attributes = pattern.search(corrected_string)
+            if attributes is None:
+                continue
+
+            matches.append({
+                'id': pattern.get_id(),
+                'attributes': attributes,
+                'score': score,
+            })
+
+            if len(matches) >= limit:
+                break
+
+        return matches
+
+# vim:sw=4:ts=4:et:
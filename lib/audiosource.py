@@ -1,8 +1,13 @@
 import os
+import signal
+import subprocess
+import threading
 
 from __init__ import Armando
 from config import Config
 from logger import Logger
+from tracing import Tracer
+from voiceactivitydetector import VoiceActivityDetector
 
 class AudioSource(object):
     """
@@ -21,6 +26,13 @@ class AudioSource(object):
     __default_record_cmd = 'arecord -f cd -t wav -d %d -r 44100 > %s' \
         % (__default_record_seconds, __default_wav_file)
     __default_flac_cmd = 'flac -f %s -o %s' % (__default_wav_file, __default_flac_file)
+    __default_stream_record_cmd = 'arecord -q -f cd -t wav -d %d -r 44100'
+    __default_stream_flac_cmd = 'flac -s -c -'
+    __default_vad_record_cmd = 'arecord -q -f cd -t raw'
+    __default_vad_flac_cmd = 'flac -s -c --force-raw-format --endian=little --sign=signed ' \
+        '--channels=2 --bps=16 --sample-rate=44100 -'
+    # Audio kept before the detected start of the speech
+    __vad_preroll_seconds = 0.3
 
     def __init__(self):
         """
@@ -29,16 +41,26 @@ class AudioSource(object):
         self.record_seconds -- From config[audio.record_seconds] or 3
         self.record_cmd -- From config[audio.record_cmd] or `arecord -f cd -t wav -d self.record_seconds -r 44100 > self.wav_file`
         self.flac_cmd -- From config[audio.flac_cmd] or `flac -f self.wav_file -o self.flac_file`
+        self.streaming -- From config[audio.streaming] or False. If set, record_to_flac pipes the
+            recorder output straight into the encoder (see record_to_flac_data) and no WAV file is written
+        self.stream_record_cmd -- From config[audio.stream_record_cmd] or
+            `arecord -q -f cd -t wav -d self.record_seconds -r 44100`, recording command
+            writing the WAV audio to its standard output
+        self.stream_flac_cmd -- From config[audio.stream_flac_cmd] or `flac -s -c -`, encoding command
+            reading the WAV audio from its standard input and writing the FLAC audio to its standard output
+        self.vad -- From config[audio.vad] or False. If set, the recordings stop after the speech is over
+            (see VoiceActivityDetector) instead of lasting self.record_seconds, and they are discarded
+            if they contain no speech
+        self.vad_record_cmd -- From config[audio.vad_record_cmd] or `arecord -q -f cd -t raw`, recording
+            command writing raw 16 bit little endian stereo PCM audio at 44100 Hz to its standard output
+        self.vad_flac_cmd -- From config[audio.vad_flac_cmd] or `flac -s -c --force-raw-format ... -`,
+            encoding command reading the raw PCM audio from its standard input
         """
 
-        self.__config = Config.get_config()
         self.__logger = Logger.get_logger(__name__)
-
-        self.wav_file = self.__config.get('audio.wav_file') or self.__default_wav_file
-        self.flac_file = self.__config.get('audio.flac_file') or self.__default_flac_file
-        self.record_seconds = self.__config.get('audio.record_seconds') or self.__default_record_seconds
-        self.record_cmd = self.__config.get('audio.record_cmd') or self.__default_record_cmd
-        self.flac_cmd = self.__config.get('audio.flac_cmd') or self.__default_flac_cmd
+        self.__tracer = Tracer.get_tracer()
+        self.__load_settings()
+        Config.subscribe('audio', self.__on_config_change)
 
         self.__logger.info({
             'msg_type': 'Initializing audio source',
@@ -47,8 +69,28 @@ class AudioSource(object):
             'record_seconds': self.record_seconds,
             'record_cmd': self.record_cmd,
             'flac_cmd': self.flac_cmd,
+            'streaming': self.streaming,
         })
 
+    def __load_settings(self):
+        self.__config = Config.get_config()
+        self.wav_file = self.__config.get('audio.wav_file') or self.__default_wav_file
+        self.flac_file = self.__config.get('audio.flac_file') or self.__default_flac_file
+        self.record_seconds = self.__config.get('audio.record_seconds') or self.__default_record_seconds
+        self.record_cmd = self.__config.get('audio.record_cmd') or self.__default_record_cmd
+        self.flac_cmd = self.__config.get('audio.flac_cmd') or self.__default_flac_cmd
+        self.streaming = bool(self.__config.get('audio.streaming'))
+        self.stream_record_cmd = self.__config.get('audio.stream_record_cmd') or \
+            self.__default_stream_record_cmd % self.record_seconds
+        self.stream_flac_cmd = self.__config.get('audio.stream_flac_cmd') or self.__default_stream_flac_cmd
+        self.vad = bool(self.__config.get('audio.vad'))
+        self.vad_record_cmd = self.__config.get('audio.vad_record_cmd') or self.__default_vad_record_cmd
+        self.vad_flac_cmd = self.__config.get('audio.vad_flac_cmd') or self.__default_vad_flac_cmd
+
+    def __on_config_change(self, key, old_value, new_value):
+        " Apply the changes to the [audio] settings, used by the next recording "
+        self.__load_settings()
+
     def record_to_wav(self):
         """ Record from the audio source and output the recorded WAV audio to self.wav_file """
         self.__logger.info({
@@ -56,25 +98,173 @@ class AudioSource(object):
             'wav_file': self.wav_file,
         })
 
-        os.system(self.record_cmd)
+        with self.__tracer.span('audio.record', record_seconds=self.record_seconds):
+            os.system(self.record_cmd)
 
         self.__logger.info({
             'msg_type': 'Recording stopped',
             'wav_file': self.wav_file,
         })
 
-    def record_to_flac(self):
-        """ Record from the audio source and output the recorded audio to self.flac_file """
-        self.record_to_wav()
+    def record_to_flac_data(self):
+        """
+        Record from the audio source and return the recorded FLAC audio as bytes.
+        The recorder output is piped into the encoder, so the audio is encoded while
+        it's being recorded and nothing is written to disk.
+        If self.vad is set, return None if the recording contained no speech
+        """
 
-        self.__logger.debug({
-            'msg_type': 'Converting WAV to FLAC file',
-            'wav_file': self.wav_file,
-            'flac_file': self.flac_file,
+        if self.vad:
+            return self.__record_to_flac_data_vad()
+
+        self.__logger.info({
+            'msg_type': 'Streaming recording started',
+            'record_cmd': self.stream_record_cmd,
+            'flac_cmd': self.stream_flac_cmd,
+        })
+
+        with self.__tracer.span('audio.record_and_encode', record_seconds=self.record_seconds) as span:
+            recorder = subprocess.Popen(self.stream_record_cmd, shell=True, stdout=subprocess.PIPE)
+
+            try:
+                encoder = subprocess.Popen(self.stream_flac_cmd, shell=True,
+                    stdin=recorder.stdout, stdout=subprocess.PIPE)
+            except Exception as e:
+                recorder.kill()
+                raise e
+            finally:
+                # The encoder owns the read end of the pipe now
+                recorder.stdout.close()
+
+            data = encoder.communicate()[0]
+            record_status = recorder.wait()
+            span.set('bytes', len(data))
+
+        if record_status != 0 or encoder.returncode != 0 or not data:
+            raise RuntimeError('Streaming recording failed - recorder status: %d, encoder status: %d, %d bytes encoded'
+                % (record_status, encoder.returncode, len(data)))
+
+        self.__logger.info({
+            'msg_type': 'Streaming recording stopped',
+            'bytes': len(data),
+        })
+
+        return data
+
+    def __record_to_flac_data_vad(self):
+        detector = VoiceActivityDetector(sample_rate=44100, channels=2)
+        preroll_windows = int((detector.min_speech + self.__vad_preroll_seconds) * 1000 / detector.window_ms) + 1
+        pending = []
+        encoder = None
+        encoded = []
+
+        self.__logger.info({
+            'msg_type': 'Recording started',
+            'record_cmd': self.vad_record_cmd,
+            'vad': True,
         })
 
-        os.system(self.flac_cmd)
-        os.remove(self.wav_file)
+        with self.__tracer.span('audio.record_vad') as span:
+            recorder = subprocess.Popen(self.vad_record_cmd, shell=True, stdout=subprocess.PIPE,
+                start_new_session=True)
+
+            try:
+                while not detector.finished:
+                    window = recorder.stdout.read(detector.window_bytes)
+                    if not window:
+                        break
+
+                    detector.process(window)
+
+                    if encoder is not None:
+                        encoder.stdin.write(window)
+                        continue
+
+                    pending.append(window)
+                    if not detector.speech_detected:
+                        del pending[:-preroll_windows]
+                        continue
+
+                    # Speech started: the encoder only runs on recordings with speech
+                    encoder = subprocess.Popen(self.vad_flac_cmd, shell=True,
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                    reader = threading.Thread(target=lambda: encoded.append(encoder.stdout.read()))
+                    reader.daemon = True
+                    reader.start()
+                    encoder.stdin.write(b''.join(pending))
+            except Exception as e:
+                if encoder is not None:
+                    encoder.kill()
+                raise e
+            finally:
+                self.__stop_recorder(recorder)
+
+            span.set('duration', detector.get_duration()).set('speech', detector.speech_detected)
+
+            if encoder is not None:
+                encoder.stdin.close()
+                reader.join()
+                encoder.stdout.close()
+                encoder.wait()
+
+        if encoder is None:
+            self.__logger.info({
+                'msg_type': 'No speech detected, recording discarded',
+                'duration': detector.get_duration(),
+            })
+
+            return None
+
+        data = encoded[0] if encoded else b''
+        if encoder.returncode != 0 or not data:
+            raise RuntimeError('Encoding failed - encoder status: %d, %d bytes encoded' % (encoder.returncode, len(data)))
+
+        self.__logger.info({
+            'msg_type': 'Recording stopped',
+            'duration': detector.get_duration(),
+            'bytes': len(data),
+        })
+
+        return data
+
+    @classmethod
+    def __stop_recorder(cls, recorder):
+        if recorder.poll() is None:
+            try:
+                os.killpg(recorder.pid, signal.SIGTERM)
+            except OSError as e:
+                pass
+
+        recorder.stdout.close()
+        recorder.wait()
+
+    def record_to_flac(self):
+        """
+        Record from the audio source and output the recorded audio to self.flac_file.
+        Return False if the recording was discarded because it contained no speech
+        (if self.vad is set), True otherwise
+        """
+        if self.streaming or self.vad:
+            data = self.record_to_flac_data()
+            if data is None:
+                return False
+
+            with open(self.flac_file, 'wb') as fp:
+                fp.write(data)
+            return True
+
+        with self.__tracer.span('audio.record_to_flac'):
+            self.record_to_wav()
+
+            self.__logger.debug({
+                'msg_type': 'Converting WAV to FLAC file',
+                'wav_file': self.wav_file,
+                'flac_file': self.flac_file,
+            })
+
+            with self.__tracer.span('audio.encode'):
+                os.system(self.flac_cmd)
+                os.remove(self.wav_file)
 
         self.__logger.debug({
             'msg_type': 'Converted WAV to FLAC file',
@@ -82,5 +272,7 @@ class AudioSource(object):
             'flac_file': self.flac_file,
         })
 
+        return True
+
 # vim:sw=4:ts=4:et:
 
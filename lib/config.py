@@ -5,11 +5,37 @@ from constants import Constants
 
 import json
 import os
+import re
 import threading
+import traceback
+import types
+import weakref
 
 class ConfigError(Exception):
     pass
 
+class ConfigSection(object):
+    """
+    Read-only view of a configuration section, whose options can be read as
+    attributes (e.g. Config.get_config().mpd.port). Missing options are None
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __slots__ = ('_ConfigSection__name', '_ConfigSection__values')
+
+    def __init__(self, name, values):
+        object.__setattr__(self, '_ConfigSection__name', name)
+        object.__setattr__(self, '_ConfigSection__values', types.MappingProxyType(values))
+
+    def __getattr__(self, option):
+        return self.__values.get(option)
+
+    def __setattr__(self, option, value):
+        raise AttributeError('The configuration is read-only')
+
+    def __repr__(self):
+        return 'ConfigSection(%s, %s)' % (self.__name, dict(self.__values))
+
 class Config(object):
     """
     Configuration parser for Armando main.conf format
@@ -18,12 +44,106 @@ class Config(object):
 
     __config = None
     __config_lock = threading.RLock()
+    __rcfile = None
+    __subscribers = {}
+    __subscribers_lock = threading.Lock()
+
+    # Types of the known options. Options not listed here are strings,
+    # except enabled, which is a boolean in any section
+    __schema = {
+        'audio': {
+            'record_seconds': int,
+            'wav_file': str,
+            'flac_file': str,
+            'record_cmd': str,
+            'flac_cmd': str,
+            'streaming': bool,
+            'stream_record_cmd': str,
+            'stream_flac_cmd': str,
+            'vad': bool,
+            'vad_record_cmd': str,
+            'vad_flac_cmd': str,
+            'vad_window_ms': int,
+            'vad_energy_threshold': float,
+            'vad_zcr_threshold': float,
+            'vad_min_speech': float,
+            'vad_trailing_silence': float,
+            'vad_start_timeout': float,
+            'vad_max_seconds': float,
+        },
+        'hue': {
+            'bridge': str,
+            'lightbulbs': list,
+        },
+        'lastfm': {
+            'api_key': str,
+            'api_secret': str,
+            'session_key': str,
+            'secret_key': str,
+            'max_attempts': int,
+        },
+        'logger': {
+            'logfile': str,
+            'loglevel': str,
+            'format': str,
+            'mode': str,
+            'queue_size': int,
+            'overflow': str,
+            'batch_size': int,
+            'flush_interval': float,
+            'sample_rate': int,
+            'max_field_bytes': int,
+            'sink': str,
+            'segment_bytes': int,
+            'segment_seconds': float,
+            'max_bytes': int,
+            'compress': bool,
+        },
+        'metrics': {
+            'host': str,
+            'port': int,
+        },
+        'mpd': {
+            'host': str,
+            'port': int,
+        },
+        'rules': {
+            'cache': bool,
+            'cache_dir': str,
+            'streaming': bool,
+            'watch': bool,
+            'watch_interval': float,
+            'match_cache_size': int,
+            'approximate': bool,
+            'approximate_threshold': float,
+            'confidence_threshold': float,
+            'hit_stats': bool,
+            'stats_file': str,
+            'stats_save_interval': float,
+            'resolution': str,
+            'warm_plugins': bool,
+            'shell_workers': int,
+            'shell_timeout': float,
+            'action_workers': int,
+        },
+        'tracing': {
+            'output': str,
+            'buffer_size': int,
+        },
+        'speech': {
+            'api_key': str,
+            'languages': list,
+        },
+    }
+
+    __true_values = ('1', 'true', 'yes', 'on')
+    __false_values = ('0', 'false', 'no', 'off')
 
     ######
     # Private methods
     ######
 
-    def __parse_rc_file(self, rcfile):
+    def __parse_rc_file(self, rcfile, values):
         parser = ConfigParser()
         with open(rcfile) as fp:
             parser.read_file(fp)
@@ -38,7 +158,30 @@ class Config(object):
             for key, value in parser.items(section):
                 key = ('%s.%s' % (section, key)).lower()
                 value = Constants.expand_value(value)
-                self.config[key] = value
+                values[key] = value
+
+    @classmethod
+    def __coerce_value(cls, key, value):
+        " Convert the raw string [value] of option [key] to the type declared in the schema "
+
+        section, option = key.split('.', 1)
+        value_type = bool if option == 'enabled' else cls.__schema.get(section, {}).get(option, str)
+
+        if value_type is str:
+            return value
+        if value_type is list:
+            return tuple(_ for _ in re.split(r'\s*,\s*', value.strip()) if _)
+        if value_type is bool:
+            if value.lower() in cls.__true_values:
+                return True
+            if value.lower() in cls.__false_values:
+                return False
+            raise ConfigError('Invalid boolean value [%s] for option [%s]' % (value, key))
+
+        try:
+            return value_type(value)
+        except ValueError as e:
+            raise ConfigError('Invalid %s value [%s] for option [%s]' % (value_type.__name__, value, key))
 
     def __init__(self, rcfile=None):
         """
@@ -47,27 +190,48 @@ class Config(object):
             which can be locally overridden by __PWD__/main.conf)
         """
 
-        self.config = {}
+        values = {}
         rcfile_found = False
 
         # If no rcfile is provided, we read __BASEDIR__/main.conf,
         # which can be overriden by your local share/YourProject/main.conf
         if rcfile is None:
             try:
-                self.__parse_rc_file(Armando.get_base_dir() + os.sep + 'main.conf')
+                self.__parse_rc_file(Armando.get_base_dir() + os.sep + 'main.conf', values)
                 rcfile_found = True
-                self.__parse_rc_file(os.getcwd() + os.sep + 'main.conf')
+                self.__parse_rc_file(os.getcwd() + os.sep + 'main.conf', values)
             except FileNotFoundError as e:
                 if rcfile_found is False:
                     raise e
         else:
-            self.__parse_rc_file(rcfile)
+            self.__parse_rc_file(rcfile, values)
 
-        if len(self.config.items()) == 0:
+        if len(values.items()) == 0:
             raise RuntimeError( \
                 'No configuration has been loaded - both %s/main.conf and ./main.conf files' \
                 'were not found or are invalid' % (Armando.get_base_dir()))
 
+        # Immutable snapshot of the typed values, built once
+        sections = {}
+        for key, value in values.items():
+            values[key] = self.__coerce_value(key, value)
+            section, option = key.split('.', 1)
+            sections.setdefault(section, {})[option] = values[key]
+
+        for section in self.__schema.keys():
+            sections.setdefault(section, {})
+
+        self.config = types.MappingProxyType(values)
+        self.__sections = dict((name, ConfigSection(name, options)) for (name, options) in sections.items())
+
+    def __getattr__(self, section):
+        " Sections can be read as attributes, e.g. config.mpd.port "
+
+        sections = self.__dict__.get('_Config__sections', {})
+        if section in sections:
+            return sections[section]
+        raise AttributeError('No such configuration section: %s' % section)
+
     ######
     # Public methods
     ######
@@ -75,27 +239,123 @@ class Config(object):
     @classmethod
     def get_config(cls, rcfile=None):
         """
-        Thread-safe singleton to access or initialize the static default configuration object
+        Thread-safe singleton to access or initialize the static default configuration object.
+        Configuration objects are immutable snapshots, so once initialized the current
+        snapshot is returned without locking. Callers that keep a reference to it can
+        subscribe to the changes applied by Config.reload
         """
+        config = cls.__config
+        if config is not None:
+            return config
+
         cls.__config_lock.acquire()
         try:
             if cls.__config is None:
                 cls.__config = Config(rcfile)
+                cls.__rcfile = rcfile
         finally:
             cls.__config_lock.release()
         return cls.__config
 
+    @classmethod
+    def reload(cls, rcfile=None):
+        """
+        Read the configuration again and atomically publish the new snapshot, then
+        notify the subscribers of the changed options (see Config.subscribe). The
+        current snapshot is left untouched if the configuration can't be loaded.
+        rcfile -- Configuration file (default: the file the configuration was loaded
+            from, i.e. __BASEDIR__/main.conf overridden by __PWD__/main.conf)
+        Return the list of the changed option names
+        """
+
+        cls.__config_lock.acquire()
+        try:
+            rcfile = rcfile or cls.__rcfile
+            config = Config(rcfile)
+            old_config, cls.__config, cls.__rcfile = cls.__config, config, rcfile
+
+            old_values = old_config.config if old_config else {}
+            changed = sorted(key for key in set(old_values.keys()) | set(config.config.keys())
+                if old_values.get(key) != config.config.get(key))
+
+            # Notified under the lock, so that subscribers get the changes in order
+            for key in changed:
+                cls.__notify(key, old_values.get(key), config.config.get(key))
+        finally:
+            cls.__config_lock.release()
+
+        return changed
+
+    @classmethod
+    def subscribe(cls, key, callback):
+        """
+        Register [callback] to be invoked as callback(key, old_value, new_value) whenever
+        the option [key] changes on reload.
+        key -- Option name (e.g. mpd.host) or section name (e.g. mpd) for all its options
+        callback -- The callback is weakly referenced, so that subscribing doesn't keep
+            objects alive: pass a bound method or a function that outlives the subscription
+        """
+
+        try:
+            ref = weakref.WeakMethod(callback)
+        except TypeError:
+            ref = weakref.ref(callback)
+
+        with cls.__subscribers_lock:
+            cls.__subscribers.setdefault(key.lower(), []).append(ref)
+
+    @classmethod
+    def unsubscribe(cls, key, callback):
+        " Remove a callback registered through Config.subscribe "
+
+        with cls.__subscribers_lock:
+            refs = cls.__subscribers.get(key.lower(), [])
+            refs[:] = [ref for ref in refs if ref() is not None and ref() != callback]
+
+    @classmethod
+    def __notify(cls, key, old_value, new_value):
+        callbacks = []
+
+        with cls.__subscribers_lock:
+            for subscription in (key, key.split('.', 1)[0]):
+                refs = cls.__subscribers.get(subscription, [])
+                # Drop the subscriptions of the objects that don't exist anymore
+                refs[:] = [ref for ref in refs if ref() is not None]
+                callbacks += [ref() for ref in refs]
+
+        for callback in callbacks:
+            if callback is None:
+                continue
+
+            try:
+                callback(key, old_value, new_value)
+            except Exception as e:
+                from logger import Logger
+                Logger.get_logger(__name__).error({
+                    'msg_type': 'Configuration change subscriber failed',
+                    'key': key,
+                    'exception': str(e),
+                    'traceback': traceback.format_exc(),
+                })
+
     def get(self, attr):
         """
-        Configuration getter
+        Configuration getter. Values are typed according to the options schema
+        (e.g. mpd.port is an int and speech.languages a tuple of strings)
         attr -- Attribute name - note that we are case insensitive when it comes to attribute names
         """
-        attr = attr.lower()
-        return self.config[attr] if attr in self.config else None
+        try:
+            return self.config[attr]
+        except KeyError:
+            return self.config.get(attr.lower())
+
+    def get_section(self, section):
+        " Return the read-only ConfigSection [section], empty if the section doesn't exist "
+        return self.__sections.get(section.lower()) or ConfigSection(section.lower(), {})
 
     def dump(self):
         " Dump the configuration object in JSON format "
-        return json.dumps(self.config)
+        return json.dumps(dict(self.config))
 
 # vim:sw=4:ts=4:et:
 
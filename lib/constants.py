@@ -14,14 +14,29 @@ class Constants(object):
         '__SHAREDIR__'  : Armando.get_share_dir,
     }
 
+    # Constant values, resolved once on first use
+    __constants = None
+
+    @classmethod
+    def get_constants(cls):
+        " Return the map of the constants to their values "
+
+        if cls.__constants is None:
+            cls.__constants = dict((constant, expand_func())
+                for (constant, expand_func) in cls.__constants_func_map.items())
+        return cls.__constants
+
     @classmethod
     def expand_value(cls, value):
         """
         Expand the constants contained in a certain string value
         value -- The value which contains potential constant references to be expanded
         """
-        for constant, expand_func in cls.__constants_func_map.items():
-            value = value.replace(constant, expand_func())
+        if '__' not in value:
+            return value
+
+        for constant, constant_value in cls.get_constants().items():
+            value = value.replace(constant, constant_value)
         return value
 
 # vim:sw=4:ts=4:et:
@@ -1,9 +1,10 @@
-import re
 import threading
 
 from config import Config
 from logger import Logger
+from metrics import MetricsRegistry
 from phue import Bridge
+from tracing import Tracer
 
 class Hue(object):
     """
@@ -23,14 +24,18 @@ class Hue(object):
         """
         self.__config = Config.get_config()
         self.__logger = Logger.get_logger(__name__)
+        self.__tracer = Tracer.get_tracer()
+
+        metrics = MetricsRegistry.get_registry()
+        self.__commands_counter = metrics.counter('armando_hue_commands_total',
+            'Commands sent to the Hue bridge', ('command',))
+        self.__errors_counter = metrics.counter('armando_hue_errors_total', 'Hue commands that failed', ('command',))
+        self.__command_seconds = metrics.histogram('armando_hue_command_seconds', 'Duration of the Hue commands')
 
         self.bridge_address = self.__config.get('hue.bridge')
-        self.lightbulbs = self.__config.get('hue.lightbulbs')
+        self.lightbulbs = list(self.__config.get('hue.lightbulbs') or [])
         self.connected = False
-
-        if self.lightbulbs:
-            m = re.split('\s*,\s*', self.lightbulbs)
-            self.lightbulbs = m or [self.lightbulbs]
+        Config.subscribe('hue', self.__on_config_change)
 
         self.__logger.info({
             'msg_type': 'Hue bridge started',
@@ -52,6 +57,18 @@ class Hue(object):
             cls.__hue_lock.release()
         return cls.__hue
 
+    def __on_config_change(self, key, old_value, new_value):
+        " Apply the changes to the [hue] settings - the bridge is connected again on the next command "
+        self.__config = Config.get_config()
+        self.bridge_address = self.__config.get('hue.bridge')
+        self.lightbulbs = list(self.__config.get('hue.lightbulbs') or [])
+        self.connected = False
+
+    def __command(self, command):
+        " Count and time a command sent to the bridge "
+        self.__commands_counter.labels(command).inc()
+        return self.__command_seconds.time(errors_counter=self.__errors_counter.labels(command))
+
     def connect(self):
         " Connect to the Philips Hue bridge "
 
@@ -62,14 +79,15 @@ class Hue(object):
             'msg_type': 'Connecting to the Hue bridge',
         })
 
-        self.bridge = Bridge(self.bridge_address)
-        self.bridge.connect()
-        self.bridge.get_api()
+        with self.__tracer.span('hue.connect', bridge=self.bridge_address), self.__command('connect'):
+            self.bridge = Bridge(self.bridge_address)
+            self.bridge.connect()
+            self.bridge.get_api()
 
-        if not self.lightbulbs:
-            self.lightbulbs = []
-            for light in self.bridge.lights:
-                self.lightbulbs.append(light.name)
+            if not self.lightbulbs:
+                self.lightbulbs = []
+                for light in self.bridge.lights:
+                    self.lightbulbs.append(light.name)
 
         self.__logger.info({
             'msg_type': 'Connected to the Hue bridge',
@@ -94,10 +112,11 @@ class Hue(object):
             'on': on,
         })
 
-        for light in self.lightbulbs:
-            self.bridge.set_light(light, 'on', on)
-            if on:
-                self.bridge.set_light(light, 'bri', 255)
+        with self.__tracer.span('hue.set_on', on=on), self.__command('set_on'):
+            for light in self.lightbulbs:
+                self.bridge.set_light(light, 'on', on)
+                if on:
+                    self.bridge.set_light(light, 'bri', 255)
         return self
 
     def set_bri(self, bri):
@@ -111,15 +130,16 @@ class Hue(object):
             'brightness': bri,
         })
 
-        if bri == 0:
-            for light in self.lightbulbs:
-                self.bridge.set_light(light, 'on', False)
-        else:
-            for light in self.lightbulbs:
-                if not self.bridge.get_light(light, 'on'):
-                    self.bridge.set_light(light, 'on', True)
+        with self.__tracer.span('hue.set_bri', brightness=bri), self.__command('set_bri'):
+            if bri == 0:
+                for light in self.lightbulbs:
+                    self.bridge.set_light(light, 'on', False)
+            else:
+                for light in self.lightbulbs:
+                    if not self.bridge.get_light(light, 'on'):
+                        self.bridge.set_light(light, 'on', True)
 
-        self.bridge.set_light(self.lightbulbs, 'bri', bri)
+            self.bridge.set_light(self.lightbulbs, 'bri', bri)
         return self
 
     def set_sat(self, sat):
@@ -133,7 +153,8 @@ class Hue(object):
             'saturation': sat,
         })
 
-        self.bridge.set_light(self.lightbulbs, 'sat', sat)
+        with self.__tracer.span('hue.set_sat', saturation=sat), self.__command('set_sat'):
+            self.bridge.set_light(self.lightbulbs, 'sat', sat)
         return self
 
     def set_hue(self, hue):
@@ -147,7 +168,8 @@ class Hue(object):
             'saturation': hue,
         })
 
-        self.bridge.set_light(self.lightbulbs, 'hue', hue)
+        with self.__tracer.span('hue.set_hue', hue=hue), self.__command('set_hue'):
+            self.bridge.set_light(self.lightbulbs, 'hue', hue)
         return self
 
 # vim:sw=4:ts=4:et:
@@ -7,6 +7,8 @@ import xml.dom.minidom
 
 from config import Config
 from logger import Logger
+from metrics import MetricsRegistry
+from tracing import Tracer
 
 class LastFM(object):
     """
@@ -25,15 +27,24 @@ class LastFM(object):
         """
         self.__config = Config.get_config()
         self.__logger = Logger.get_logger(__name__)
+        self.__tracer = Tracer.get_tracer()
+
+        metrics = MetricsRegistry.get_registry()
+        self.__calls_counter = metrics.counter('armando_lastfm_calls_total',
+            'Last.FM API requests, by method', ('method',))
+        self.__errors_counter = metrics.counter('armando_lastfm_errors_total',
+            'Last.FM API requests that failed or returned an error')
+        self.__call_seconds = metrics.histogram('armando_lastfm_call_seconds',
+            'Duration of the Last.FM API requests')
 
         self.api_key = self.__config.get('lastfm.api_key')
         self.api_secret = self.__config.get('lastfm.api_secret')
         self.session_key = self.__config.get('lastfm.secret_key')
         self.max_attempts = self.__config.get('lastfm.max_attempts') or self.__default_max_attempts
 
-        (self.api_key and self.api_secret and self.sessionKey) \
-            or raise AttributeError('[lastfm.api_key], [lastfm.api_secret] and' \
-            '[lastfm.secret_key] must all be specified in your configuration')
+        if not (self.api_key and self.api_secret and self.session_key):
+            raise AttributeError('[lastfm.api_key], [lastfm.api_secret] and ' \
+                '[lastfm.secret_key] must all be specified in your configuration')
 
     def __get_api_signature(self, method, args = {}) :
         signature = ('api_key%s' % self.api_key)
@@ -53,8 +64,11 @@ class LastFM(object):
         attempts = 0
 
         while stop_trying is False:
-            www = urllib.urlopen('http://ws.audioscrobbler.com/2.0/', data = urllib.urlencode(args))
-            response = www.read()
+            self.__calls_counter.labels(method).inc()
+            with self.__tracer.span('lastfm.api_call', method=method, attempt=attempts + 1), \
+                    self.__call_seconds.time(errors_counter=self.__errors_counter):
+                www = urllib.urlopen('http://ws.audioscrobbler.com/2.0/', data = urllib.urlencode(args))
+                response = www.read()
             attempts += 1
 
             try:
@@ -62,6 +76,7 @@ class LastFM(object):
                 errors = document.getElementsByTagName('error')
 
                 if len(errors) > 0:
+                    self.__errors_counter.inc()
                     code = int(errors[0].getAttribute('code'))
                     self.__logger.error({
                         'msg_type'  : 'Error while invoking Last.FM API',
@@ -77,7 +92,7 @@ class LastFM(object):
                     else:
                         stop_trying = True
                 else:
-                    self.__logger..info({
+                    self.__logger.info({
                         'msg_type'  : 'API call succeeded',
                         'method'   : method,
                         'args'     : json.dumps(args),
@@ -87,8 +102,9 @@ class LastFM(object):
                     stop_trying = True
                     break
             except Exception as e:
+                self.__errors_counter.inc()
                 tb = traceback.format_exc()
-                self.__logger..error({
+                self.__logger.error({
                     'msg_type'   : 'Error while parsing server response',
                     'method'    : method,
                     'args'      : args,
@@ -104,7 +120,7 @@ class LastFM(object):
                     stop_trying = True
             finally:
                 if stop_trying and attempts >= self.max_attempts:
-                    self.__logger..info({
+                    self.__logger.info({
                         'msg_type'  : 'Giving up API call',
                         'attempts' : attempts,
                         'method'   : method,
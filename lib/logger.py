@@ -1,10 +1,502 @@
 from __init__ import Armando
 from config import Config
 
+import atexit
+import collections
+import gzip
 import json
 import logging
 import os
+import re
+import shutil
 import threading
+import time
+
+class SegmentedLogHandler(logging.Handler):
+    """
+    Log handler writing newline-delimited records into bounded segments:
+    the active segment is the log file itself, which is closed and renamed
+    to <logfile>.<sequence number> once it reaches segment_bytes or it is
+    older than segment_seconds (counted from its first record, so that the age
+    of the active segment survives restarts). Closed segments are gzip-compressed in the
+    background, and the oldest segments are removed so that the log takes
+    at most max_bytes on disk. Records are written as
+    "<timestamp> <level> <message>" lines, which SegmentedLogReader can
+    stream and filter across the segments.
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __default_segment_bytes = 1024 * 1024
+    __default_segment_seconds = 24 * 60 * 60
+    __default_max_bytes = 32 * 1024 * 1024
+    __log_format = '%(created).3f %(levelname)s %(message)s'
+
+    def __init__(self, logfile, segment_bytes=None, segment_seconds=None, max_bytes=None, compress=None):
+        """
+        logfile -- Active segment path, closed segments are stored next to it
+        segment_bytes -- Maximum size of a segment (default: config[logger.segment_bytes] or 1 MB)
+        segment_seconds -- Maximum age of a segment (default: config[logger.segment_seconds] or 1 day)
+        max_bytes -- Maximum disk usage of the log, including the active segment
+            (default: config[logger.max_bytes] or 32 MB)
+        compress -- Whether the closed segments are compressed (default: config[logger.compress] or True)
+        """
+        super(SegmentedLogHandler, self).__init__()
+        self.setFormatter(logging.Formatter(self.__log_format))
+
+        config = Config.get_config()
+        self.logfile = logfile
+        self.segment_bytes = int(segment_bytes or config.get('logger.segment_bytes') or self.__default_segment_bytes)
+        self.segment_seconds = float(segment_seconds or config.get('logger.segment_seconds')
+            or self.__default_segment_seconds)
+        self.max_bytes = int(max_bytes or config.get('logger.max_bytes') or self.__default_max_bytes)
+        self.compress = compress if compress is not None else config.get('logger.compress') is not False
+
+        self.__stream = None
+        self.__size = 0
+        self.__opened = 0
+        self.__next_sequence = max([sequence for (sequence, path) in self.get_segments(logfile)] or [0]) + 1
+        self.__maintenance_lock = threading.Lock()
+
+        # Segments left uncompressed by a previous run
+        self.__start_maintenance()
+
+    @classmethod
+    def get_segments(cls, logfile):
+        " Return the closed segments of [logfile] as a list of (sequence number, path), oldest first "
+
+        logs_dir = os.path.dirname(os.path.abspath(logfile))
+        segment_regex = re.compile(r'^%s\.(\d+)(\.gz)?$' % re.escape(os.path.basename(logfile)))
+        segments = {}
+
+        if not os.path.isdir(logs_dir):
+            return []
+
+        for filename in os.listdir(logs_dir):
+            m = segment_regex.match(filename)
+            if m:
+                sequence = int(m.group(1))
+                # If both exist, the compression of the segment is still in progress
+                if sequence not in segments or not m.group(2):
+                    segments[sequence] = logs_dir + os.sep + filename
+
+        return sorted(segments.items())
+
+    def __open(self):
+        logs_dir = os.path.dirname(os.path.abspath(self.logfile))
+        if not os.path.isdir(logs_dir):
+            os.makedirs(logs_dir)
+
+        self.__stream = open(self.logfile, 'ab')
+        self.__size = self.__stream.tell()
+        self.__opened = self.__get_first_record_time() if self.__size else time.time()
+
+    def __get_first_record_time(self):
+        """
+        Return the timestamp of the first record of the active segment, left by
+        a previous run. If it can't be read the segment is rotated at the first write
+        """
+
+        try:
+            with open(self.logfile, 'rb') as fp:
+                return float(fp.readline().split(b' ', 1)[0])
+        except (OSError, ValueError) as e:
+            return 0
+
+    def __rotate(self):
+        self.__stream.close()
+        self.__stream = None
+
+        os.rename(self.logfile, '%s.%06d' % (self.logfile, self.__next_sequence))
+        self.__next_sequence += 1
+        self.__start_maintenance()
+
+    def __start_maintenance(self):
+        threading.Thread(target=self.__maintenance, name='SegmentedLogMaintenance', daemon=True).start()
+
+    def __maintenance(self):
+        " Compress the closed segments and remove the oldest ones beyond max_bytes "
+
+        with self.__maintenance_lock:
+            segments = self.get_segments(self.logfile)
+
+            for (i, (sequence, path)) in enumerate(segments):
+                if self.compress and not path.endswith('.gz'):
+                    try:
+                        with open(path, 'rb') as src, gzip.open(path + '.gz.tmp', 'wb') as dst:
+                            shutil.copyfileobj(src, dst)
+                        os.replace(path + '.gz.tmp', path + '.gz')
+                        os.remove(path)
+                        segments[i] = (sequence, path + '.gz')
+                    except OSError as e:
+                        self.__remove(path + '.gz.tmp')
+
+            # Room is kept for the active segment to grow up to segment_bytes
+            total = max(self.segment_bytes, os.path.getsize(self.logfile) if os.path.isfile(self.logfile) else 0)
+            sizes = [os.path.getsize(path) for (sequence, path) in segments]
+            total += sum(sizes)
+
+            for ((sequence, path), size) in zip(segments, sizes):
+                if total <= self.max_bytes:
+                    break
+                self.__remove(path)
+                total -= size
+
+    @classmethod
+    def __remove(cls, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            pass
+
+    def __write(self, data):
+        if self.__stream is None:
+            self.__open()
+
+        if self.__size and (self.__size + len(data) > self.segment_bytes
+                or time.time() - self.__opened >= self.segment_seconds):
+            self.__rotate()
+            self.__open()
+
+        self.__stream.write(data)
+        self.__size += len(data)
+
+    def __format_line(self, record):
+        return (self.format(record).replace('\n', '\\n') + '\n').encode('utf-8')
+
+    def emit(self, record):
+        try:
+            self.__write(self.__format_line(record))
+            self.__stream.flush()
+        except Exception as e:
+            self.handleError(record)
+
+    def emit_batch(self, records):
+        " Write [records] with a single flush, used by the AsyncLogWriter "
+
+        self.acquire()
+        try:
+            for record in records:
+                try:
+                    self.__write(self.__format_line(record))
+                except Exception as e:
+                    self.handleError(record)
+            if self.__stream:
+                self.__stream.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.__stream:
+                self.__stream.close()
+                self.__stream = None
+        finally:
+            self.release()
+        super(SegmentedLogHandler, self).close()
+
+class SegmentedLogReader(object):
+    """
+    Reader for the logs written by SegmentedLogHandler, which streams the
+    records across the closed (and compressed) segments and the active one
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __levels = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+    def __init__(self, logfile=None):
+        """
+        logfile -- Active segment path (default: config[logger.logfile] or __LOGSDIR__/default.log)
+        """
+        self.logfile = logfile or Config.get_config().get('logger.logfile') or \
+            Armando.get_logs_dir() + os.sep + 'default.log'
+
+    def get_segments(self):
+        " Return the paths of the segments, oldest first "
+
+        paths = [path for (sequence, path) in SegmentedLogHandler.get_segments(self.logfile)]
+        if os.path.isfile(self.logfile):
+            paths.append(self.logfile)
+        return paths
+
+    def __iter__(self):
+        return self.read()
+
+    def __read_lines(self, path):
+        try:
+            fp = gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') \
+                else open(path, encoding='utf-8')
+        except FileNotFoundError as e:
+            # The segment was compressed or removed in the meantime
+            if path.endswith('.gz') or not os.path.isfile(path + '.gz'):
+                return
+            fp = gzip.open(path + '.gz', 'rt', encoding='utf-8')
+
+        with fp:
+            for line in fp:
+                yield line
+
+    def read(self, since=None, until=None, level=None, module=None, msg_type=None, contains=None, match=None):
+        """
+        Generator of the log records matching all the filters, oldest first, as
+        dictionaries with the logged fields plus 'time' (UNIX timestamp) and 'level'
+        since -- Minimum timestamp of the records
+        until -- Maximum timestamp of the records
+        level -- Minimum level name (e.g. WARNING)
+        module -- Module name of the records
+        msg_type -- Message type of the records
+        contains -- Substring the raw record line must contain (cheapest filter)
+        match -- Function taking a record and returning True if it should be returned
+        """
+
+        levels = self.__levels[self.__levels.index(level.upper()):] if level else None
+
+        for path in self.get_segments():
+            # The last record of a segment is never newer than the segment itself
+            try:
+                if since and os.path.getmtime(path) < since:
+                    continue
+            except OSError as e:
+                pass
+
+            for line in self.__read_lines(path):
+                if contains and contains not in line:
+                    continue
+
+                try:
+                    (created, record_level, message) = line.rstrip('\n').split(' ', 2)
+                    created = float(created)
+                except ValueError as e:
+                    continue
+
+                if since and created < since:
+                    continue
+                if until and created > until:
+                    return
+                if levels and record_level not in levels:
+                    continue
+
+                try:
+                    record = json.loads(message)
+                    if not isinstance(record, dict):
+                        raise ValueError
+                except ValueError as e:
+                    record = { 'msg': message }
+
+                if module and record.get('module') != module:
+                    continue
+                if msg_type and record.get('msg_type') != msg_type:
+                    continue
+
+                record['time'] = created
+                record['level'] = record_level
+
+                if match and not match(record):
+                    continue
+                yield record
+
+class AsyncLogWriter(threading.Thread):
+    """
+    Background writer for the asynchronous logging mode. Callers only append
+    the raw records to a bounded queue, while this thread serializes them and
+    writes them in batches to the handlers of the root logger, so that log I/O
+    never runs on the calling thread. When the queue is full, records are handled
+    according to the overflow policy:
+        drop -- New records are dropped
+        block -- Callers wait until the writer makes room
+        sample -- Once the queue is half full, only one out of sample_rate
+            records is kept, and new records are dropped when it is full
+    The queue is flushed when the process exits.
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __writer = None
+    __writer_lock = threading.RLock()
+    __default_queue_size = 10000
+    __default_batch_size = 256
+    __default_flush_interval = 0.5
+    __default_sample_rate = 10
+    __overflow_policies = ('drop', 'block', 'sample')
+
+    def __init__(self, queue_size=None, overflow=None, batch_size=None, flush_interval=None, sample_rate=None):
+        """
+        queue_size -- Maximum number of queued records (default: config[logger.queue_size] or 10000)
+        overflow -- Overflow policy, drop, block or sample (default: config[logger.overflow] or drop)
+        batch_size -- Maximum number of records written at once (default: config[logger.batch_size] or 256)
+        flush_interval -- Maximum number of seconds a record waits in the queue
+            (default: config[logger.flush_interval] or 0.5)
+        sample_rate -- One record out of sample_rate is kept by the sample policy
+            when the queue is half full (default: config[logger.sample_rate] or 10)
+        """
+        super(AsyncLogWriter, self).__init__(name='AsyncLogWriter')
+        self.daemon = True
+
+        config = Config.get_config()
+        self.queue_size = int(queue_size or config.get('logger.queue_size') or self.__default_queue_size)
+        self.overflow = (overflow or config.get('logger.overflow') or 'drop').lower()
+        self.batch_size = int(batch_size or config.get('logger.batch_size') or self.__default_batch_size)
+        self.flush_interval = float(flush_interval or config.get('logger.flush_interval') or self.__default_flush_interval)
+        self.sample_rate = int(sample_rate or config.get('logger.sample_rate') or self.__default_sample_rate)
+        self.max_field_bytes = Logger.get_max_field_bytes(config)
+
+        if self.overflow not in self.__overflow_policies:
+            raise AttributeError('Invalid log overflow policy [%s] - valid values: [%s]'
+                % (self.overflow, ', '.join(self.__overflow_policies)))
+
+        # deque appends and pops are atomic, so callers never take a lock
+        # unless they have to wait for room in the queue (block policy)
+        self.__queue = collections.deque()
+        self.__wakeup = threading.Event()
+        self.__room = threading.Condition()
+        self.__stopped = False
+        self.__sampled = 0
+        self.dropped = 0
+        self.__reported_dropped = 0
+
+        Config.subscribe('logger.max_field_bytes', self.__on_config_change)
+
+    def __on_config_change(self, key, old_value, new_value):
+        " Apply a new field size limit to the records written from now on "
+        self.max_field_bytes = Logger.get_max_field_bytes()
+
+    @classmethod
+    def get_writer(cls):
+        """
+        Thread-safe singleton to access or initialize (and start) the static default log writer
+        """
+        cls.__writer_lock.acquire()
+        try:
+            if cls.__writer is None:
+                cls.__writer = AsyncLogWriter()
+                cls.__writer.start()
+                atexit.register(cls.__writer.stop)
+        finally:
+            cls.__writer_lock.release()
+        return cls.__writer
+
+    def enqueue(self, record):
+        """
+        Queue a record as a tuple (created, level, module_name, msg). The lazy
+        fields of msg are evaluated by the writer thread (see Logger.log).
+        Return False if the record was dropped by the overflow policy
+        """
+
+        queue = self.__queue
+
+        if len(queue) >= self.queue_size:
+            if self.overflow != 'block' or self.__stopped:
+                self.dropped += 1
+                return False
+
+            self.__wakeup.set()
+            with self.__room:
+                while len(queue) >= self.queue_size and not self.__stopped:
+                    self.__room.wait(self.flush_interval)
+        elif self.overflow == 'sample' and len(queue) >= self.queue_size // 2:
+            self.__sampled += 1
+            if self.__sampled % self.sample_rate:
+                self.dropped += 1
+                return False
+
+        queue.append(record)
+        if len(queue) >= self.batch_size:
+            self.__wakeup.set()
+        return True
+
+    def flush(self, timeout=None):
+        " Wait until the records queued so far are written. Return False on timeout "
+
+        if not self.is_alive():
+            self.__write_queued()
+            return True
+
+        marker = threading.Event()
+        self.__queue.append(marker)
+        self.__wakeup.set()
+        return marker.wait(timeout)
+
+    def stop(self, timeout=5):
+        " Write the queued records and stop the writer "
+
+        self.flush(timeout)
+        self.__stopped = True
+        self.__wakeup.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while not self.__stopped:
+            self.__wakeup.wait(self.flush_interval)
+            self.__wakeup.clear()
+            self.__write_queued()
+
+        self.__write_queued()
+
+    def __write_queued(self):
+        queue = self.__queue
+
+        while queue:
+            batch = []
+            markers = []
+
+            while queue and len(batch) < self.batch_size:
+                record = queue.popleft()
+                if isinstance(record, threading.Event):
+                    markers.append(record)
+                else:
+                    batch.append(self.__make_record(*record))
+
+            if self.dropped > self.__reported_dropped:
+                batch.append(self.__make_record(time.time(), logging.WARNING, __name__, {
+                    'msg_type': 'Log records dropped by the overflow policy',
+                    'overflow': self.overflow,
+                    'dropped': self.dropped - self.__reported_dropped,
+                }))
+                self.__reported_dropped = self.dropped
+
+            self.__emit(batch)
+
+            with self.__room:
+                self.__room.notify_all()
+            for marker in markers:
+                marker.set()
+
+    def __make_record(self, created, level, module_name, msg):
+        msg = Logger.render(msg, module_name, self.max_field_bytes)
+        record = logging.LogRecord(module_name, level, __file__, 0, json.dumps(msg), None, None)
+        record.created = created
+        record.msecs = (created - int(created)) * 1000
+        return record
+
+    @classmethod
+    def __emit(cls, records):
+        " Write [records] to the root logger handlers, with one write and flush per batch for streams "
+
+        if not records:
+            return
+
+        for handler in logging.getLogger().handlers:
+            handler_records = [_ for _ in records if _.levelno >= handler.level]
+            if not handler_records:
+                continue
+
+            if isinstance(handler, SegmentedLogHandler):
+                handler.emit_batch(handler_records)
+                continue
+
+            if not isinstance(handler, logging.StreamHandler) or handler.stream is None:
+                for record in handler_records:
+                    handler.handle(record)
+                continue
+
+            handler.acquire()
+            try:
+                handler.stream.write(''.join(handler.format(_) + handler.terminator for _ in handler_records))
+                handler.flush()
+            except Exception as e:
+                handler.handleError(handler_records[0])
+            finally:
+                handler.release()
 
 class Logger(object):
     """
@@ -15,6 +507,13 @@ class Logger(object):
     __loggers = {}
     __loggers_lock = threading.RLock()
     __default_log_format = '[%(asctime)-15s] %(message)s'
+    __default_max_field_bytes = 4096
+    __logfunc_levels = {
+        logging.debug: logging.DEBUG,
+        logging.info: logging.INFO,
+        logging.warning: logging.WARNING,
+        logging.error: logging.ERROR,
+    }
 
     def __get_logfile_name(self):
         return self.__config.get('logger.logfile') or \
@@ -34,6 +533,12 @@ class Logger(object):
             raise AttributeError('Invalid log level option [%s] - valid values: [DEBUG, INFO, WARNING, ERROR]' \
                 % loglevel)
 
+    @classmethod
+    def get_max_field_bytes(cls, config=None):
+        " Return the maximum size in bytes of a logged string field, 0 for no limit (config[logger.max_field_bytes]) "
+        max_field_bytes = (config or Config.get_config()).get('logger.max_field_bytes')
+        return cls.__default_max_field_bytes if max_field_bytes is None else max_field_bytes
+
     def __get_log_format(self):
         logformat = self.__config.get('logger.format')
         if not logformat:
@@ -70,21 +575,99 @@ class Logger(object):
         self.loglevel = self.__get_loglevel()
         self.logformat = self.__get_log_format()
         self.logfile = self.__get_logfile_name()
+        self.max_field_bytes = self.get_max_field_bytes(self.__config)
+
+        sink = (self.__config.get('logger.sink') or 'file').lower()
+        if sink == 'segments':
+            # The handler is only created by the first logger
+            if not logging.root.handlers:
+                logging.basicConfig(
+                    handlers = [SegmentedLogHandler(self.logfile)],
+                    level = self.loglevel
+                )
+        elif sink == 'file':
+            logging.basicConfig(
+                filename = self.logfile,
+                level = self.loglevel,
+                format = self.logformat
+            )
+        else:
+            raise AttributeError('Invalid log sink option [%s] - valid values: [file, segments]' % sink)
+
+        # Asynchronous mode: records are written by the AsyncLogWriter thread
+        mode = (self.__config.get('logger.mode') or 'sync').lower()
+        self.__writer = AsyncLogWriter.get_writer() if mode == 'async' else None
 
-        logging.basicConfig(
-            filename = self.logfile,
-            level = self.loglevel,
-            format = self.logformat
-        )
+        Config.subscribe('logger.loglevel', self.__on_config_change)
+        Config.subscribe('logger.max_field_bytes', self.__on_config_change)
+
+    def __on_config_change(self, key, old_value, new_value):
+        """
+        Apply a new log level or field size limit. The log file and format are
+        set up once by the first logger, and changing them requires a restart
+        """
+        self.__config = Config.get_config()
+        self.loglevel = self.__get_loglevel()
+        self.max_field_bytes = self.get_max_field_bytes(self.__config)
+        logging.getLogger().setLevel(self.loglevel)
+
+    @classmethod
+    def render(cls, msg, module_name, max_field_bytes=0):
+        """
+        Return a copy of the record msg, ready to be dumped as JSON, with the
+        module name, the lazy fields evaluated and the string fields longer than
+        max_field_bytes truncated. The caller's dictionary is not modified
+        """
+
+        record = {}
+        for key, value in msg.items():
+            if callable(value):
+                try:
+                    value = value()
+                except Exception as e:
+                    value = '<%s: %s>' % (type(e).__name__, e)
+
+            if max_field_bytes and isinstance(value, str) and len(value) > max_field_bytes // 4:
+                value = cls.__truncate(value, max_field_bytes)
+            record[key] = value
+
+        record['module'] = module_name
+        return record
+
+    @classmethod
+    def __truncate(cls, value, max_field_bytes):
+        data = value.encode('utf-8')
+        if len(data) <= max_field_bytes:
+            return value
+
+        return '%s... [%d bytes truncated]' % (
+            data[:max_field_bytes].decode('utf-8', 'ignore'), len(data) - max_field_bytes)
 
     def log(self, msg, logfunc=logging.info):
         """
-        Default log function
-        msg -- Message to be logged, as a key-value dictionary. It will be logged in JSON format
+        Default log function. Nothing is evaluated nor serialized if the log
+        level of msg is not enabled
+        msg -- Message to be logged, as a key-value dictionary. It will be logged in JSON format.
+            Expensive fields can be passed as callables (e.g. 'response': lambda: str(response)),
+            which are evaluated only if the record is emitted. String fields longer than
+            config[logger.max_field_bytes] (default: 4096, 0 for no limit) are truncated
         logfunc -- Function that will log msg (default: logging.info)
         """
-        msg['module'] = self.module_name
-        logfunc(json.dumps(msg))
+        level = self.__logfunc_levels.get(logfunc, logging.INFO)
+        if not logging.root.isEnabledFor(level):
+            return
+
+        if self.__writer:
+            self.__writer.enqueue((time.time(), level, self.module_name, dict(msg)))
+            return
+
+        logfunc(json.dumps(self.render(msg, self.module_name, self.max_field_bytes)))
+
+    def flush(self, timeout=None):
+        " Wait for the queued records to be written, in asynchronous mode "
+        if self.__writer:
+            return self.__writer.flush(timeout)
+        return True
 
     def debug(self, msg):
         " Debug logger function. msg must be a key-value dictionary, will be dumped as JSON "
@@ -0,0 +1,86 @@
+import collections
+import threading
+
+class MatchCache(object):
+    """
+    Bounded LRU cache of resolved utterances. Utterances are normalized before
+    being used as keys, so commands differing only in case share the same entry
+    (unless some patterns are case sensitive). Whitespaces are part of the key,
+    as anchors, repeated spaces and the attributes values depend on them. Each entry is bound to the rule set it was computed on, and
+    it is never returned for a different rule set.
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    def __init__(self, max_size):
+        """
+        max_size -- Maximum number of cached utterances, the least recently
+            used entries are evicted first
+        """
+        self.max_size = int(max_size)
+        self.hits = 0
+        self.misses = 0
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def normalize(cls, string, casefold=True):
+        """
+        Return the cache key for [string]. The key is case-folded for ASCII
+        strings only: case-folding may change the length of non-ASCII strings,
+        and it doesn't always agree with the case insensitive matching of the
+        regular expressions
+        casefold -- If False the key is never case-folded, for the rule sets
+            whose patterns aren't all case insensitive
+        """
+
+        if not casefold:
+            return string
+
+        try:
+            string.encode('ascii')
+        except UnicodeError:
+            return string
+
+        return string.casefold()
+
+    def get(self, key, rule_set):
+        " Return the value cached for [key] on [rule_set], or None "
+
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or entry[0] is not rule_set:
+                self.misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, rule_set, value):
+        " Store [value] for [key] as computed on [rule_set] "
+
+        with self.__lock:
+            self.__entries[key] = (rule_set, value)
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def clear(self):
+        " Drop all the cached entries "
+
+        with self.__lock:
+            self.__entries.clear()
+
+    def get_stats(self):
+        " Return the cache size and hit/miss counters "
+
+        with self.__lock:
+            return {
+                'size': len(self.__entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+# vim:sw=4:ts=4:et:
@@ -0,0 +1,362 @@
+import bisect
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from config import Config
+from logger import Logger
+
+class Metric(object):
+    """
+    Base class of the metrics. A metric declared with label names holds one
+    child per combination of label values, returned by labels(). Metric types
+    implement _get_samples, returning the samples of an unlabelled metric as
+    [(name suffix, extra labels, value)]
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self.__children = {}
+
+    def labels(self, *values):
+        " Return the child metric for the label [values], in the order of the label names "
+
+        child = self.__children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise AttributeError('Metric %s expects the labels %s' % (self.name, self.label_names))
+
+            with self._lock:
+                child = self.__children.get(values)
+                if child is None:
+                    child = self.__children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        return self.__class__(self.name, self.documentation)
+
+    def get_samples(self):
+        " Return the samples of the metric as [(name, labels, value)] "
+
+        if not self.label_names:
+            return [(self.name + suffix, labels, value) for (suffix, labels, value) in self._get_samples()]
+
+        with self._lock:
+            children = sorted(self.__children.items())
+
+        samples = []
+        for (values, child) in children:
+            labels = list(zip(self.label_names, values))
+            samples += [(self.name + suffix, labels + extra_labels, value)
+                for (suffix, extra_labels, value) in child._get_samples()]
+        return samples
+
+class Counter(Metric):
+    """
+    Monotonically increasing counter
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        super(Counter, self).__init__(name, documentation, label_names)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def _get_samples(self):
+        return [('', [], self.value)]
+
+class Gauge(Metric):
+    """
+    Value that can go up and down
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, label_names=()):
+        super(Gauge, self).__init__(name, documentation, label_names)
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def _get_samples(self):
+        return [('', [], self.value)]
+
+class HistogramTimer(object):
+    """
+    Context manager observing the elapsed time in seconds on a histogram,
+    and optionally counting the blocks that raised an exception
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __slots__ = ('histogram', 'errors_counter', 'start')
+
+    def __init__(self, histogram, errors_counter=None):
+        self.histogram = histogram
+        self.errors_counter = errors_counter
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.histogram.observe(time.monotonic() - self.start)
+        if exc_type is not None and self.errors_counter is not None:
+            self.errors_counter.inc()
+        return False
+
+class Histogram(Metric):
+    """
+    Distribution of the observed values over fixed buckets
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    type = 'histogram'
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, label_names=(), buckets=None):
+        """
+        buckets -- Sorted upper bounds of the buckets (default: Histogram.default_buckets,
+            latencies in seconds). The +Inf bucket is implicit
+        """
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+        self.__counts = [0] * (len(self.buckets) + 1)
+        self.__sum = 0
+
+    def _new_child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.__counts[i] += 1
+            self.__sum += value
+
+    def time(self, errors_counter=None):
+        """
+        Return a context manager observing the time spent in its block, in seconds
+        errors_counter -- Counter incremented if the block raises an exception
+        """
+        return HistogramTimer(self, errors_counter)
+
+    def _get_samples(self):
+        with self._lock:
+            counts = list(self.__counts)
+            total = self.__sum
+
+        samples = []
+        cumulative = 0
+        for (bound, count) in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append(('_bucket', [('le', '+Inf' if bound == float('inf') else repr(float(bound)))], cumulative))
+
+        samples.append(('_sum', [], total))
+        samples.append(('_count', [], cumulative))
+        return samples
+
+class MetricsRegistry(object):
+    """
+    Registry of the runtime metrics of the platform, exported in the Prometheus
+    text format. The default registry is created on first use, and the daemon
+    entry point serves it over HTTP through MetricsRegistry.start_server if
+    config[metrics.enabled] is set, on config[metrics.host]:config[metrics.port]
+    (default: 127.0.0.1:9108), e.g. curl http://127.0.0.1:9108/metrics
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __registry = None
+    __registry_lock = threading.RLock()
+    __server = None
+
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def get_registry(cls):
+        """
+        Thread-safe singleton to access or initialize the static default metrics registry
+        """
+        registry = cls.__registry
+        if registry is not None:
+            return registry
+
+        cls.__registry_lock.acquire()
+        try:
+            if cls.__registry is None:
+                cls.__registry = MetricsRegistry()
+        finally:
+            cls.__registry_lock.release()
+        return cls.__registry
+
+    @classmethod
+    def start_server(cls):
+        """
+        Serve the default registry over HTTP if config[metrics.enabled] is set,
+        to be called once by the daemon entry point. Return the MetricsServer,
+        or None if the metrics are disabled or the server couldn't start (see serve)
+        """
+
+        with cls.__registry_lock:
+            if cls.__server is None and Config.get_config().get('metrics.enabled'):
+                cls.__server = cls.get_registry().serve()
+        return cls.__server
+
+    def serve(self, host=None, port=None):
+        """
+        Serve the registry over HTTP on a new MetricsServer and return it. If the
+        address can't be bound (e.g. the port is already in use) a warning is
+        logged, the metrics are still collected and None is returned
+        """
+
+        try:
+            server = MetricsServer(self, host=host, port=port)
+        except OSError as e:
+            Logger.get_logger(__name__).warning({
+                'msg_type': 'Unable to start the metrics server',
+                'host': host or Config.get_config().get('metrics.host'),
+                'port': port if port is not None else Config.get_config().get('metrics.port'),
+                'error': str(e),
+            })
+            return None
+
+        server.start()
+        return server
+
+    def __register(self, metric_class, name, *args, **kwargs):
+        with self.__lock:
+            metric = self.__metrics.get(name)
+            if metric is None:
+                metric = self.__metrics[name] = metric_class(name, *args, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise AttributeError('Metric %s is already registered as a %s' % (name, metric.type))
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        " Return the counter [name], registered if it doesn't exist yet "
+        return self.__register(Counter, name, documentation, label_names)
+
+    def gauge(self, name, documentation, label_names=()):
+        " Return the gauge [name], registered if it doesn't exist yet "
+        return self.__register(Gauge, name, documentation, label_names)
+
+    def histogram(self, name, documentation, label_names=(), buckets=None):
+        " Return the histogram [name], registered if it doesn't exist yet "
+        return self.__register(Histogram, name, documentation, label_names, buckets=buckets)
+
+    def get_metric(self, name):
+        return self.__metrics.get(name)
+
+    @classmethod
+    def __format_value(cls, value):
+        if value == float('inf'):
+            return '+Inf'
+        if isinstance(value, float) and not value.is_integer():
+            return repr(value)
+        return str(int(value)) if isinstance(value, (int, float, bool)) else str(value)
+
+    @classmethod
+    def __format_labels(cls, labels):
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+            .replace('"', '\\"').replace('\n', '\\n')) for (name, value) in labels)
+
+    def dump(self):
+        " Return the metrics in the Prometheus text exposition format "
+
+        with self.__lock:
+            metrics = sorted(self.__metrics.items())
+
+        lines = []
+        for (name, metric) in metrics:
+            lines.append('# HELP %s %s' % (name, metric.documentation.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (name, metric.type))
+            for (sample_name, labels, value) in metric.get_samples():
+                lines.append('%s%s %s' % (sample_name, self.__format_labels(labels), self.__format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+class MetricsServer(threading.Thread):
+    """
+    Local HTTP listener serving the metrics of a registry on /metrics
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __default_host = '127.0.0.1'
+    __default_port = 9108
+
+    def __init__(self, registry, host=None, port=None):
+        """
+        registry -- MetricsRegistry to serve
+        host -- Listen address (default: config[metrics.host] or 127.0.0.1)
+        port -- Listen port, 0 for any free port (default: config[metrics.port] or 9108)
+        """
+        super(MetricsServer, self).__init__(name='MetricsServer')
+        self.daemon = True
+
+        config = Config.get_config()
+        self.__logger = Logger.get_logger(__name__)
+        self.registry = registry
+        self.host = host or config.get('metrics.host') or self.__default_host
+        self.port = port if port is not None else (config.get('metrics.port') or self.__default_port)
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ('/', '/metrics'):
+                    handler.send_error(404)
+                    return
+
+                content = registry.dump().encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                handler.send_header('Content-Length', str(len(content)))
+                handler.end_headers()
+                handler.wfile.write(content)
+
+            def log_message(handler, format, *args):
+                pass
+
+        class MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = MetricsHTTPServer((self.host, self.port), MetricsRequestHandler)
+        self.port = self.server.server_address[1]
+
+    def run(self):
+        self.__logger.info({
+            'msg_type': 'Metrics server started',
+            'host': self.host,
+            'port': self.port,
+        })
+
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# vim:sw=4:ts=4:et:
@@ -1,6 +1,8 @@
 from config import Config
 from logger import Logger
+from metrics import MetricsRegistry
 from music import Track
+from tracing import Tracer
 
 import re
 import socket
@@ -22,9 +24,27 @@ class MPD(object):
         """
         self.__config = Config.get_config()
         self.__logger = Logger.get_logger(__name__)
+        self.__tracer = Tracer.get_tracer()
+
+        metrics = MetricsRegistry.get_registry()
+        self.__commands_counter = metrics.counter('armando_mpd_commands_total',
+            'Commands sent to MPD', ('command',))
+        self.__errors_counter = metrics.counter('armando_mpd_errors_total',
+            'MPD commands that failed, including the connection failures')
+        self.__connections_counter = metrics.counter('armando_mpd_connections_total',
+            'Connections opened to MPD')
+        self.__bytes_counter = metrics.counter('armando_mpd_response_bytes_total', 'Bytes received from MPD')
+        self.__command_seconds = metrics.histogram('armando_mpd_command_seconds', 'Duration of the MPD commands')
 
         self.host = self.__config.get('mpd.host')
-        self.port = int(self.__config.get('mpd.port'))
+        self.port = self.__config.get('mpd.port')
+        Config.subscribe('mpd', self.__on_config_change)
+
+    def __on_config_change(self, key, old_value, new_value):
+        " Apply the changes to the [mpd] settings, used by the next server command "
+        self.__config = Config.get_config()
+        self.host = self.__config.get('mpd.host')
+        self.port = self.__config.get('mpd.port')
 
     @classmethod
     def get_mpd(cls):
@@ -49,25 +69,36 @@ class MPD(object):
             'cmd': cmd,
         })
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((self.host, self.port))
-
-        try:
-            sock.sendall(("%s\n" % cmd).encode())
-            response = sock.recv(4096)
-
-            if type(response).__name__ != 'str':
-                # Broken compatibility between Python 2 and Python 3 :(
-                response = response.decode()
-
-            # End-of-message protocol for MPD
-            while not re.search('\r?\nOK\r?\n\s*$', response):
-                next_chunck = sock.recv(4096)
-                if type(next_chunck).__name__ != 'str':
-                    next_chunck = next_chunck.decode()
-                response += next_chunck
-        finally:
-            sock.close()
+        self.__commands_counter.labels(cmd.split(' ', 1)[0]).inc()
+
+        with self.__tracer.span('mpd.command', cmd=cmd) as span, \
+                self.__command_seconds.time(errors_counter=self.__errors_counter):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.__connections_counter.inc()
+            sock.connect((self.host, self.port))
+
+            try:
+                sock.sendall(("%s\n" % cmd).encode())
+                response = sock.recv(4096)
+                # Raw bytes received, before decoding
+                response_bytes = len(response)
+
+                if type(response).__name__ != 'str':
+                    # Broken compatibility between Python 2 and Python 3 :(
+                    response = response.decode()
+
+                # End-of-message protocol for MPD
+                while not re.search('\r?\nOK\r?\n\s*$', response):
+                    next_chunck = sock.recv(4096)
+                    response_bytes += len(next_chunck)
+                    if type(next_chunck).__name__ != 'str':
+                        next_chunck = next_chunck.decode()
+                    response += next_chunck
+            finally:
+                sock.close()
+
+            span.set('response_bytes', response_bytes)
+            self.__bytes_counter.inc(response_bytes)
 
         self.__logger.info({
             'msg_type': 'Received response from MPD server',
@@ -0,0 +1,358 @@
+import collections
+import re
+
+class AhoCorasick(object):
+    """
+    Aho-Corasick automaton, used to find all the occurrences of a set of
+    keywords in a string with a single scan
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    def __init__(self, keywords):
+        """
+        keywords -- List of keywords to be indexed. Keywords are identified by
+            their index in this list
+        """
+        self.__goto = [{}]
+        self.__fail = [0]
+        self.__output = [set()]
+
+        for keyword_id, keyword in enumerate(keywords):
+            self.__add_keyword(keyword_id, keyword)
+        self.__build_fail_links()
+
+    def __add_keyword(self, keyword_id, keyword):
+        state = 0
+
+        for c in keyword:
+            if c not in self.__goto[state]:
+                self.__goto.append({})
+                self.__fail.append(0)
+                self.__output.append(set())
+                self.__goto[state][c] = len(self.__goto)-1
+            state = self.__goto[state][c]
+
+        self.__output[state].add(keyword_id)
+
+    def __build_fail_links(self):
+        queue = collections.deque(self.__goto[0].values())
+
+        while queue:
+            state = queue.popleft()
+
+            for c, next_state in self.__goto[state].items():
+                queue.append(next_state)
+                fail_state = self.__fail[state]
+
+                while fail_state and c not in self.__goto[fail_state]:
+                    fail_state = self.__fail[fail_state]
+
+                self.__fail[next_state] = self.__goto[fail_state].get(c, 0)
+                self.__output[next_state] |= self.__output[self.__fail[next_state]]
+
+    def search(self, string):
+        " Return the set of the IDs of the keywords found in [string] "
+
+        goto = self.__goto
+        fail = self.__fail
+        output = self.__output
+        found = set()
+        state = 0
+
+        for c in string:
+            while state and c not in goto[state]:
+                state = fail[state]
+
+            state = goto[state].get(c, 0)
+            if output[state]:
+                found |= output[state]
+
+        return found
+
+    def search_many(self, strings):
+        """
+        Return, for each of [strings], the set of the IDs of the keywords it
+        contains. Keywords never span across strings. The scan is shared among
+        the strings: repeated strings are only scanned once, and each string
+        resumes the automaton from the state reached at the end of the prefix
+        it shares with the previous one - the N-best hypotheses of an utterance
+        usually differ only in a few words
+        """
+
+        goto = self.__goto
+        fail = self.__fail
+        output = self.__output
+        found_by_string = {}
+        found = []
+
+        # Automaton state and keywords found after each character of the previous string
+        previous = ''
+        previous_states = [0]
+        previous_found = [frozenset()]
+
+        for string in strings:
+            if string in found_by_string:
+                found.append(set(found_by_string[string]))
+                continue
+
+            prefix_len = 0
+            max_prefix_len = min(len(string), len(previous))
+            while prefix_len < max_prefix_len and string[prefix_len] == previous[prefix_len]:
+                prefix_len += 1
+
+            states = previous_states[:prefix_len+1]
+            found_so_far = previous_found[:prefix_len+1]
+            state = states[-1]
+            string_found = found_so_far[-1]
+
+            for c in string[prefix_len:]:
+                while state and c not in goto[state]:
+                    state = fail[state]
+
+                state = goto[state].get(c, 0)
+                if output[state] and not output[state] <= string_found:
+                    string_found = string_found | output[state]
+
+                states.append(state)
+                found_so_far.append(string_found)
+
+            found_by_string[string] = string_found
+            found.append(set(string_found))
+            previous, previous_states, previous_found = string, states, found_so_far
+
+        return found
+
+class PatternMatcher(object):
+    """
+    Compiled matching engine for the patterns defined in rules.xml.
+    Patterns are compiled once and, where their group indexes allow it, batched
+    into combined regular expressions, so a single regex run evaluates a whole
+    batch of patterns with exactly the same semantics as one re.search per pattern.
+    The literal words required by each pattern are indexed in an Aho-Corasick
+    automaton, so that only the patterns whose literals all appear in the string
+    are evaluated.
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __default_batch_size = 32
+
+    # Patterns using back references, conditional groups, named groups or
+    # global inline flags can't be embedded in a combined expression without
+    # changing their meaning - they are evaluated on their own
+    __unbatchable_regex = re.compile(r'\\[1-9]|\(\?P|\(\?\(|\(\?[aiLmsux-]+\)')
+
+    def __init__(self, patterns, batch_size=None, previous=None):
+        """
+        patterns -- List of Pattern objects, in the order they should be matched
+        batch_size -- Maximum number of patterns combined into a single expression (default: 32)
+        previous -- Previous PatternMatcher, whose compiled combined expressions
+            are reused for the batches that didn't change
+        """
+        self.__patterns = list(patterns)
+        self.__batch_size = batch_size or self.__default_batch_size
+        self.__batches = []
+        self.__compiled_batches = {}
+        self.__previous_batches = previous.__compiled_batches if previous else {}
+        self.__build_batches()
+        self.__build_literals_index()
+        self.__previous_batches = None
+
+    def __build_literals_index(self):
+        """
+        Build the keyword automaton over the patterns literals.
+        self.__literal_patterns maps each literal ID to the indexes of the patterns requiring it,
+        self.__required_literals holds the number of literals required by each pattern and
+        self.__unfiltered_patterns the indexes of the patterns without any required literal
+        """
+
+        literals = []
+        literal_ids = {}
+        self.__literal_patterns = []
+        self.__required_literals = []
+        self.__unfiltered_patterns = set()
+
+        for pattern_index, pattern in enumerate(self.__patterns):
+            pattern_literals = pattern.get_literals()
+            self.__required_literals.append(len(pattern_literals))
+            if not pattern_literals:
+                self.__unfiltered_patterns.add(pattern_index)
+
+            for literal in pattern_literals:
+                if literal not in literal_ids:
+                    literal_ids[literal] = len(literals)
+                    literals.append(literal)
+                    self.__literal_patterns.append([])
+                self.__literal_patterns[literal_ids[literal]].append(pattern_index)
+
+        self.__literals_index = AhoCorasick(literals)
+
+    def __is_batchable(self, pattern):
+        return not self.__unbatchable_regex.search(pattern.get_match())
+
+    def __build_batches(self):
+        self.__patterns_index = dict((id(pattern), i) for i, pattern in enumerate(self.__patterns))
+        batch = []
+
+        for pattern in self.__patterns:
+            if not self.__is_batchable(pattern):
+                self.__add_batch(batch)
+                self.__add_batch([pattern])
+                batch = []
+                continue
+
+            batch.append(pattern)
+            if len(batch) >= self.__batch_size:
+                self.__add_batch(batch)
+                batch = []
+
+        self.__add_batch(batch)
+
+    def __add_batch(self, patterns):
+        r"""
+        A batch is a tuple (regex, [(pattern, group_offset, pattern_index), ...], combined). Each pattern in
+        a combined batch is wrapped into (?:(?=[\s\S]*?(pattern))|), which scans the
+        string the same way re.search does and never fails, so every pattern in the
+        batch gets evaluated in a single match() call starting at position 0.
+        group_offset maps the pattern's own group indexes to the combined ones.
+        """
+
+        if not patterns:
+            return
+
+        if len(patterns) == 1:
+            self.__batches.append((patterns[0].get_regex(),
+                [(patterns[0], 0, self.__patterns_index[id(patterns[0])])], False))
+            return
+
+        members = []
+        chunks = []
+        group_offset = 0
+
+        for pattern in patterns:
+            members.append((pattern, group_offset + 1, self.__patterns_index[id(pattern)]))
+            chunks.append(r'(?:(?=[\s\S]*?(%s))|)' % pattern.get_match())
+            group_offset += 1 + pattern.get_regex().groups
+
+        source = ''.join(chunks)
+        regex = self.__previous_batches.get(source)
+
+        if regex is None:
+            try:
+                regex = re.compile(source, re.IGNORECASE)
+            except re.error:
+                for pattern in patterns:
+                    self.__add_batch([pattern])
+                return
+
+        self.__compiled_batches[source] = regex
+        self.__batches.append((regex, members, True))
+
+    def get_patterns(self):
+        return self.__patterns
+
+    def get_candidates(self, string):
+        """
+        Return the set of indexes of the patterns whose required literals all
+        appear in [string]. The prefilter is only applied on ASCII strings, as
+        case insensitive matching of non-ASCII characters doesn't map 1:1 to
+        lowercase comparison - all the patterns are candidates otherwise.
+        """
+
+        return self.get_candidates_many([string])[0]
+
+    def get_candidates_many(self, strings):
+        """
+        Return the candidate patterns (see get_candidates) for each of [strings],
+        sharing the scan for the patterns literals among them (see AhoCorasick.search_many)
+        """
+
+        ascii_strings = []
+        for string in strings:
+            try:
+                string.encode('ascii')
+                ascii_strings.append(string.lower())
+            except UnicodeError:
+                ascii_strings.append(None)
+
+        found_literals = iter(self.__literals_index.search_many([_ for _ in ascii_strings if _ is not None]))
+        candidates_list = []
+
+        for string in ascii_strings:
+            if string is None:
+                candidates_list.append(set(range(len(self.__patterns))))
+                continue
+
+            candidates = set(self.__unfiltered_patterns)
+            hits = {}
+
+            for literal_id in next(found_literals):
+                for pattern_index in self.__literal_patterns[literal_id]:
+                    hits[pattern_index] = hits.get(pattern_index, 0) + 1
+                    if hits[pattern_index] == self.__required_literals[pattern_index]:
+                        candidates.add(pattern_index)
+
+            candidates_list.append(candidates)
+        return candidates_list
+
+    def match(self, string, spans=False, candidates=None):
+        """
+        Match [string] against all the patterns and return the list of matched
+        patterns as [{ 'id': pattern_id, 'attributes': { ... } }, ...], in the
+        same order the patterns were provided
+        spans -- If True, each match also reports the position of its attributes
+            in [string] as 'spans': { name: (start, end), ... }
+        candidates -- Candidate patterns for [string], if already computed (see get_candidates_many)
+        """
+
+        matches = []
+        if candidates is None:
+            candidates = self.get_candidates(string)
+
+        if not candidates:
+            return matches
+
+        for regex, members, combined in self.__batches:
+            batch_candidates = [_ for _ in members if _[2] in candidates]
+            if not batch_candidates:
+                continue
+
+            if combined and len(batch_candidates) == 1:
+                # Cheaper to run the only candidate pattern on its own
+                pattern = batch_candidates[0][0]
+                regex, members, combined = pattern.get_regex(), [(pattern, 0, None)], False
+
+            if combined:
+                m = regex.match(string)
+            else:
+                m = regex.search(string)
+
+            if not m:
+                continue
+
+            for pattern, group_offset, pattern_index in members:
+                if combined and (pattern_index not in candidates or m.start(group_offset) < 0):
+                    continue
+
+                match = {
+                    'id': pattern.get_id(),
+                    'attributes': {},
+                }
+
+                if spans:
+                    match['spans'] = {}
+
+                for attribute in pattern.get_attributes():
+                    group = group_offset + attribute['regex_index']
+                    attribute_match = m.group(group)
+                    if attribute_match:
+                        value = attribute_match.strip()
+                        match['attributes'][attribute['name']] = value
+
+                        if spans:
+                            start = m.start(group) + len(attribute_match) - len(attribute_match.lstrip())
+                            match['spans'][attribute['name']] = (start, start + len(value))
+
+                matches.append(match)
+        return matches
+
+# vim:sw=4:ts=4:et:
@@ -0,0 +1,120 @@
+import threading
+
+from logger import Logger
+
+# Plugins available to the Python actions, as (module, class, singleton accessor).
+# Plugins with a singleton accessor also get their singleton bound under the
+# lowercase class name (e.g. mpd for MPD.get_mpd)
+PLUGINS = [
+    ('hue', 'Hue', 'get_hue'),
+    ('lastfm', 'LastFM', None),
+    ('mpd', 'MPD', 'get_mpd'),
+    ('music', 'Track', None),
+    ('speechrecognition', 'SpeechRecognition', None),
+]
+
+class PluginRegistry(object):
+    """
+    Registry of the Armando plugins available to the Python actions in rules.xml.
+    Plugins are declared in PLUGINS, or registered by other projects through
+    register(). A plugin module is only imported the first time an action
+    references it, and plugins exposing a singleton accessor (e.g. MPD.get_mpd)
+    also get their singleton bound under the lowercase class name (e.g. mpd),
+    created once and shared by all the actions.
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __registry = None
+    __registry_lock = threading.RLock()
+
+    def __init__(self, plugins=None):
+        """
+        plugins -- List of the plugins as (module, class, singleton accessor or None)
+            (default: PLUGINS)
+        """
+        self.__logger = Logger.get_logger(__name__)
+        self.__lock = threading.RLock()
+
+        # name -> { 'module', 'class', 'accessor' }, where name is either a plugin
+        # class name or the name its singleton is bound to
+        self.__plugins = {}
+        self.__loaded = {}
+
+        for (module_name, class_name, accessor) in (PLUGINS if plugins is None else plugins):
+            self.register(module_name, class_name, accessor)
+
+    @classmethod
+    def get_registry(cls):
+        """
+        Thread-safe singleton to access or initialize the static default plugin registry
+        """
+        cls.__registry_lock.acquire()
+        try:
+            if cls.__registry is None:
+                cls.__registry = PluginRegistry()
+        finally:
+            cls.__registry_lock.release()
+        return cls.__registry
+
+    def register(self, module_name, class_name, accessor=None):
+        """
+        Make the class [class_name] of the module [module_name] available to the actions.
+        accessor -- Name of the classmethod returning the plugin singleton, if any,
+            bound under the lowercase class name
+        """
+
+        plugin = {
+            'module': module_name,
+            'class': class_name,
+            'accessor': accessor,
+        }
+
+        with self.__lock:
+            self.__plugins[class_name] = plugin
+            if accessor:
+                self.__plugins[class_name.lower()] = plugin
+
+    def get_plugin_names(self):
+        " Return the names that actions can use to reference the plugins "
+        return set(self.__plugins.keys())
+
+    def get_referenced_plugins(self, names):
+        " Return the plugin names among [names] (e.g. the names used by an action code) "
+        return [_ for _ in names if _ in self.__plugins]
+
+    def load(self, name):
+        """
+        Return the object bound to the plugin name [name]: the plugin class for
+        class names, the plugin singleton for lowercase names. The plugin module
+        is imported, and the singleton created, only the first time
+        """
+
+        if name in self.__loaded:
+            return self.__loaded[name]
+
+        with self.__lock:
+            if name not in self.__loaded:
+                plugin = self.__plugins[name]
+                plugin_class = getattr(__import__(plugin['module']), plugin['class'])
+
+                if name == plugin['class']:
+                    self.__loaded[name] = plugin_class
+                else:
+                    self.__loaded[name] = getattr(plugin_class, plugin['accessor'])()
+
+                self.__logger.debug({
+                    'msg_type': 'Plugin loaded',
+                    'plugin': name,
+                    'module': plugin['module'],
+                })
+
+        return self.__loaded[name]
+
+    def bind(self, names, namespace):
+        " Load the plugins [names] and bind them into the [namespace] dictionary "
+
+        for name in names:
+            if name not in namespace:
+                namespace[name] = self.load(name)
+
+# vim:sw=4:ts=4:et:
@@ -1,8 +1,18 @@
+import ast
+import io
+import itertools
+import multiprocessing
 import os
 import re
+import threading
+import tokenize
 
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 from xml.dom import minidom
+from xml.etree import ElementTree
 from __armando__ import Armando
+from approximatematcher import ApproximateMatcher
 
 ###
 Armando.initialize()
@@ -10,6 +20,15 @@ Armando.initialize()
 
 from config import Config
 from logger import Logger
+from matchcache import MatchCache
+from patternmatcher import PatternMatcher
+from plugins import PluginRegistry
+from rulescache import RulesCache
+from rulesstats import RulesStats
+from ruleswatcher import RulesWatcher
+from shellexecutor import ShellExecutor, ShellResult
+from metrics import MetricsRegistry
+from tracing import Tracer
 
 class Pattern(object):
     """
@@ -17,9 +36,15 @@ class Pattern(object):
     @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
     """
 
+    __quantifier_regex = re.compile(r'[*+?]|\{\d*(,\d*)?\}')
+    __case_sensitive_regex = re.compile(r'\(\?[aiLmsux]*-[imsx]*i[imsx]*:')
+    __escape_regex = re.compile(r'\\(x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|N\{[^}]*\}|[0-9]{1,3}|.)?', re.DOTALL)
+
     def __init__(self, id, match):
         self.__id = id
+        self.__source = match
         self.__build_match(match)
+        self.__extract_literals()
 
     def __build_match(self, match_content):
         " Extract keywords and replace them with (.+?) in the regex "
@@ -40,46 +65,335 @@ class Pattern(object):
             m = re.search(regex, tmp_content)
 
         self.__match = match_content.strip()
+        self.__regex = re.compile(self.__match, re.IGNORECASE)
         self.__attributes = attributes
 
+        for attribute in attributes:
+            if attribute['regex_index'] > self.__regex.groups:
+                raise AttributeError('The attribute [%s] of the pattern [%s] references the group %d, '
+                    'but the pattern has only %d groups' % (attribute['name'], self.__id,
+                    attribute['regex_index'], self.__regex.groups))
+
+    @classmethod
+    def __skip_group(cls, regex, i):
+        " Return the index right after the group or character class starting at regex[i] "
+
+        depth = 0
+        in_class = False
+
+        while i < len(regex):
+            c = regex[i]
+            if c == '\\':
+                i += 2
+                continue
+
+            if in_class:
+                if c == ']':
+                    in_class = False
+                    if depth == 0:
+                        return i+1
+            elif c == '[':
+                in_class = True
+                # A leading ] (or ^]) is part of the class
+                if regex[i+1:i+2] == '^':
+                    i += 1
+                if regex[i+1:i+2] == ']':
+                    i += 1
+            elif c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+                if depth == 0:
+                    return i+1
+
+            i += 1
+        return i
+
+    def __extract_literals(self):
+        r"""
+        Extract the literal words that any string matched by this pattern must
+        contain (e.g. "play" and "music" for "play\s*.*music\s*(artist (.*))?").
+        The extraction is conservative: groups, character classes, escapes and
+        quantified characters break the literal runs, and patterns with top-level
+        alternations or verbose flags have no required literals at all.
+        """
+
+        regex = self.__match
+        runs = ['']
+        i = 0
+
+        while i < len(regex):
+            c = regex[i]
+            m = self.__quantifier_regex.match(regex, i)
+
+            if m:
+                # The quantified character is optional or repeated - drop it
+                runs[-1] = runs[-1][:-1]
+                runs.append('')
+                i = m.end()
+            elif c == '|' or re.match(r'\(\?[aiLmsux]*x', regex[i:]):
+                self.__literals = []
+                return
+            elif c in '([':
+                runs.append('')
+                i = self.__skip_group(regex, i)
+            elif c == '\\':
+                m = self.__escape_regex.match(regex, i)
+                escaped = m.group(1) or ''
+                runs.append(escaped if not escaped.isalnum() else '')
+                i = m.end()
+            elif c in '.^$':
+                runs.append('')
+                i += 1
+            else:
+                runs[-1] += c
+                i += 1
+
+        literals = []
+        for run in runs:
+            for word in re.findall('[A-Za-z0-9]+', run):
+                word = word.lower()
+                if word not in literals:
+                    literals.append(word)
+
+        self.__literals = literals
+
     def get_id(self):
         return self.__id
 
     def get_match(self):
         return self.__match
 
+    def get_source(self):
+        " Return the match content as defined in rules.xml "
+        return self.__source
+
+    def get_regex(self):
+        " Return the compiled (case insensitive) regular expression for this pattern "
+        return self.__regex
+
     def get_attributes(self):
         return self.__attributes
 
+    def get_literals(self):
+        " Return the lowercase literal words required by this pattern "
+        return self.__literals
+
+    def is_case_sensitive(self):
+        " Return True if part of the pattern is matched case sensitively, e.g. through (?-i:...) "
+        return self.__case_sensitive_regex.search(self.__match) is not None
+
+    def search(self, string):
+        """
+        Match [string] against this pattern alone. Return the dictionary of the
+        extracted attributes, or None if the string doesn't match
+        """
+
+        m = self.__regex.search(string)
+        if not m:
+            return None
+
+        attributes = {}
+        for attribute in self.__attributes:
+            attribute_match = m.group(attribute['regex_index'])
+            if attribute_match:
+                attributes[attribute['name']] = attribute_match.strip()
+        return attributes
+
 class Action(object):
     """
-    Model for actions defined in rules.xml
+    Model for actions defined in rules.xml.
+    Python actions are compiled once into a code object: the $$key$$ placeholders
+    in their string literals are replaced by references to the variables
+    _arg_key, which are bound to the action arguments on every run, so the
+    code never needs to be templated or parsed again. The plugins referenced by
+    the code (see PluginRegistry) are bound into the shared actions namespace
+    the first time the action runs, or earlier if the plugins are pre-warmed.
     @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
     """
 
-    def __init__(self, id, type, code):
+    __placeholder_regex = re.compile(r'\$\$(.+?)\$\$')
+    __identifier_regex = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+    __namespace = None
+    __namespace_lock = threading.RLock()
+
+    def __init__(self, id, type, code, timeout=None):
+        """
+        id -- Action ID
+        type -- Action type, either python or shell
+        code -- Action code
+        timeout -- Timeout in seconds for shell actions (default: the ShellExecutor timeout)
+        """
         self.__id = id
         self.__type = type
         self.__code = code
+        self.__timeout = float(timeout) if timeout else None
+        self.__compile()
+
+    def __getstate__(self):
+        # Code objects can't be pickled - they are compiled again on load
+        state = self.__dict__.copy()
+        state['_Action__code_object'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__compile()
+
+    def __compile(self):
+        self.__code_object = None
+        self.__arguments = []
+        self.__plugins = []
+        self.__plugins_loaded = False
+
+        if self.get_type() != 'python':
+            return
 
-    def run(self, arguments={}):
-        code = self.get_code()
+        code = self.get_code().strip()
+
+        try:
+            bound_code, self.__arguments = self.__bind_arguments(code)
+            self.__code_object = compile(bound_code, '<action %s>' % self.get_id(), 'eval')
+            names = self.__get_code_names(self.__code_object)
+        except (SyntaxError, ValueError, tokenize.TokenError) as e:
+            # Code that can't be bound (e.g. placeholders outside of string
+            # literals) is templated and evaluated at every run instead
+            self.__code_object = None
+            self.__arguments = []
+            names = set(self.__identifier_regex.findall(code))
+
+        self.__plugins = PluginRegistry.get_registry().get_referenced_plugins(sorted(names))
+
+    @classmethod
+    def __get_code_names(cls, code_object):
+        " Names referenced by a code object and by the code objects nested in it "
+
+        names = set(code_object.co_names)
+        for const in code_object.co_consts:
+            if hasattr(const, 'co_names'):
+                names |= cls.__get_code_names(const)
+        return names
+
+    @classmethod
+    def __bind_arguments(cls, code):
+        """
+        Replace the string literals containing $$key$$ placeholders with
+        expressions referencing the _arg_key variables.
+        Return the new code and the list of placeholders names
+        """
+
+        lines = code.splitlines(True)
+        offsets = [0]
+        for line in lines:
+            offsets.append(offsets[-1] + len(line))
+
+        # Adjacent string literals (implicit concatenation, possibly spanning
+        # several lines) are bound as a single literal
+        runs = []
+        run = []
+        for token in tokenize.generate_tokens(io.StringIO(code).readline):
+            if token.type == tokenize.STRING:
+                run.append(token)
+                continue
+
+            if token.type in (tokenize.NL, tokenize.COMMENT) and run:
+                if cls.__placeholder_regex.search(token.string):
+                    raise ValueError('Placeholder outside of a string literal')
+                continue
+
+            if run:
+                runs.append(run)
+                run = []
+
+            if cls.__placeholder_regex.search(token.string):
+                raise ValueError('Placeholder outside of a string literal')
 
+        if run:
+            runs.append(run)
+
+        replacements = []
+        arguments = []
+
+        for run in runs:
+            if not any(cls.__placeholder_regex.search(token.string) for token in run):
+                continue
+
+            value = ast.literal_eval(' '.join(token.string for token in run))
+            if not isinstance(value, str):
+                raise ValueError('Placeholder in a bytes literal')
+
+            parts = []
+            for i, part in enumerate(cls.__placeholder_regex.split(value)):
+                if i % 2 == 0:
+                    if part:
+                        parts.append(repr(part))
+                else:
+                    if not part.isidentifier():
+                        raise ValueError('Invalid placeholder name "%s"' % part)
+                    if part not in arguments:
+                        arguments.append(part)
+                    parts.append('_arg_' + part)
+
+            replacements.append((
+                offsets[run[0].start[0]-1] + run[0].start[1],
+                offsets[run[-1].end[0]-1] + run[-1].end[1],
+                "''.join((%s,))" % ', '.join(parts)))
+
+        for start, end, expression in reversed(replacements):
+            code = code[:start] + expression + code[end:]
+        return code, arguments
+
+    @classmethod
+    def __get_namespace(cls):
+        " Shared globals for the Python actions "
+
+        with cls.__namespace_lock:
+            if cls.__namespace is None:
+                cls.__namespace = dict(globals())
+        return cls.__namespace
+
+    def load_plugins(self):
+        " Bind the plugins referenced by the action code into the shared actions namespace "
+
+        if self.__plugins_loaded:
+            return
+
+        namespace = self.__get_namespace()
+        with self.__namespace_lock:
+            PluginRegistry.get_registry().bind(self.__plugins, namespace)
+        self.__plugins_loaded = True
+
+    def __fill_placeholders(self, arguments):
+        code = self.get_code()
         for key, value in arguments.items():
-            code = self.get_code().replace('$$%s$$' % key, value)
+            code = code.replace('$$%s$$' % key, value)
+        return code
+
+    def run(self, arguments={}, wait=True):
+        """
+        Run the action.
+        arguments -- Values for the $$key$$ placeholders in the action code
+        wait -- Only for shell actions. If True, wait for the command to terminate
+            and return its ShellResult, otherwise return immediately a Future
+            that resolves to the ShellResult
+        Python actions return the value of the evaluated code
+        """
 
         if self.get_type() == 'shell':
-            os.system(code)
+            future = ShellExecutor.get_executor().submit(self.__fill_placeholders(arguments),
+                timeout=self.__timeout, action_id=self.get_id())
+            return future.result() if wait else future
         elif self.get_type() == 'python':
-            code = code.strip()
+            self.load_plugins()
+            namespace = self.__get_namespace()
 
-            # TODO Make it modular
-            if 'MPD.' in code:
-                from mpd import MPD
-            if 'Hue.' in code:
-                from hue import Hue
+            if self.__code_object is None:
+                return eval(self.__fill_placeholders(arguments).strip(), namespace, {})
 
-            eval(code)
+            # Placeholders without a value are left as they are
+            variables = dict([('_arg_' + _, arguments[_] if _ in arguments else '$$%s$$' % _)
+                for _ in self.__arguments])
+            return eval(self.__code_object, namespace, variables)
         else:
             raise AttributeError('Invalid code type "%s" for action ID %s - either shell or python are accepted' %
                 (self.get_type(), self.get_id()))
@@ -93,56 +407,631 @@ class Action(object):
     def get_code(self):
         return self.__code
 
+    def get_timeout(self):
+        return self.__timeout
+
+    def get_arguments(self):
+        " Return the names of the placeholders bound as variables in the compiled code "
+        return self.__arguments
+
+    def get_plugins(self):
+        " Return the names of the plugins referenced by the action code "
+        return self.__plugins
+
+class RuleSet(object):
+    """
+    Compiled rule set, holding the patterns, actions and rules parsed from
+    rules.xml together with the lookup maps, the pattern matcher and the
+    rules index built on top of them
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __approximate_matcher_lock = threading.Lock()
+
+    def __init__(self, patterns, actions, rules, previous=None):
+        """
+        patterns -- List of Pattern objects
+        actions -- List of Action objects
+        rules -- List of rules, as { 'id': rule_id, 'on': [[pattern_ids], ...], 'then': [action_ids],
+            'after': [[action_ids], ...], 'sequential': bool }, where after holds, for each
+            action in then, the IDs of the actions of the same rule it has to wait for
+        previous -- Previous version of the rule set, if any - its compiled
+            pattern batches are reused by the new matcher when unchanged
+        """
+
+        self.patterns = patterns
+        self.actions = actions
+        self.rules = rules
+
+        self.patterns_map = dict(map(lambda _: (_.get_id(), _), self.patterns))
+        self.actions_map = dict(map(lambda _: (_.get_id(), _), self.actions))
+        self.rules_map = dict(map(lambda _: (_['id'], _), self.rules))
+        self.matcher = PatternMatcher(self.patterns, previous=previous.matcher if previous else None)
+        self.approximate_matcher = None
+        self.case_sensitive = any(_.is_case_sensitive() for _ in self.patterns)
+        self.__build_rules_index()
+        self.__build_rules_dependencies()
+
+    def __build_rules_dependencies(self):
+        """
+        Build self.dependencies, mapping each rule ID to the list of the positions
+        in rule['then'] that each action has to wait for before being run
+        """
+
+        self.dependencies = {}
+
+        for rule in self.rules:
+            action_ids = rule['then']
+            after = rule.get('after') or [[] for _ in action_ids]
+            dependencies = []
+
+            for i, action_id in enumerate(action_ids):
+                deps = set([i-1]) if rule.get('sequential') and i > 0 else set()
+
+                for dep_id in after[i]:
+                    if dep_id not in action_ids:
+                        raise AttributeError('The action [%s] of the rule [%s] depends on [%s], which is not part of the rule' %
+                            (action_id, rule['id'], dep_id))
+                    deps |= set([j for j, _ in enumerate(action_ids) if _ == dep_id and j != i])
+
+                dependencies.append(sorted(deps))
+
+            self.__check_dependencies_cycles(rule['id'], dependencies)
+            self.dependencies[rule['id']] = dependencies
+
+    @classmethod
+    def __check_dependencies_cycles(cls, rule_id, dependencies):
+        done = set()
+        while len(done) < len(dependencies):
+            ready = [i for i, deps in enumerate(dependencies) if i not in done and done.issuperset(deps)]
+            if not ready:
+                raise AttributeError('The actions of the rule [%s] have circular dependencies' % rule_id)
+            done.update(ready)
+
+    def resolve(self, string):
+        """
+        Match [string] against the patterns and resolve the matched rules.
+        Return a tuple (matches, rule_ids), see Rules.pattern_match and
+        Rules.get_rules_by_patterns
+        """
+
+        matches = self.matcher.match(string)
+        return matches, list(self.rules_index.get(frozenset([_['id'] for _ in matches]), []))
+
+    def get_approximate_matcher(self):
+        " Return the approximate matcher over the patterns, built on first use "
+
+        if self.approximate_matcher is None:
+            with self.__approximate_matcher_lock:
+                if self.approximate_matcher is None:
+                    self.approximate_matcher = ApproximateMatcher(self.patterns)
+        return self.approximate_matcher
+
+    def resolve_first(self, string, ranks=None):
+        """
+        Evaluate the patterns one at a time and stop at the first matched pattern
+        that, together with the ones matched before it, satisfies an AND pattern set
+        of a rule. Return a tuple (matches, rule_ids) with the patterns matched so
+        far and the rules satisfied by the last one, see Rules.resolve_first
+        ranks -- List holding, for each pattern index, its position in the
+            evaluation order (default: rules.xml order)
+        """
+
+        candidates = self.matcher.get_candidates(string)
+        matches = []
+        matched = set()
+
+        for pattern_index in sorted(candidates, key=ranks.__getitem__ if ranks else None):
+            pattern = self.patterns[pattern_index]
+            attributes = pattern.search(string)
+            if attributes is None:
+                continue
+
+            matches.append({
+                'id': pattern.get_id(),
+                'attributes': attributes,
+            })
+
+            matched.add(pattern.get_id())
+            rule_ids = []
+
+            for pattern_set in self.pattern_sets.get(pattern.get_id(), []):
+                if pattern_set <= matched:
+                    rule_ids += [_ for _ in self.rules_index[pattern_set] if _ not in rule_ids]
+
+            if rule_ids:
+                return matches, rule_ids
+
+        return matches, []
+
+    def resolve_hypotheses(self, hypotheses, threshold=0):
+        """
+        Resolve the N-best [hypotheses] of an utterance, as [(transcript, confidence), ...]
+        in order of likelihood, and return the first one that resolves to at least one rule
+        (see Rules.resolve_hypotheses)
+        """
+
+        candidates_list = self.matcher.get_candidates_many([_[0] for _ in hypotheses])
+
+        for i, (transcript, confidence) in enumerate(hypotheses):
+            if confidence is not None and confidence < threshold:
+                continue
+
+            matches = self.matcher.match(transcript, candidates=candidates_list[i])
+            rule_ids = list(self.rules_index.get(frozenset([_['id'] for _ in matches]), []))
+
+            if rule_ids:
+                return {
+                    'index': i,
+                    'transcript': transcript,
+                    'confidence': confidence,
+                    'matches': matches,
+                    'rule_ids': rule_ids,
+                }
+
+        return None
+
+    # Worker processes state for Rules.resolve_batch - not name-mangled, as the
+    # worker functions are pickled by name. The forked workers must not use the
+    # Config, Logger, Tracer or MetricsRegistry singletons (see Rules.resolve_batch)
+    _batch_rule_set = None
+
+    @classmethod
+    def _init_batch_worker(cls, rule_set):
+        cls._batch_rule_set = rule_set
+
+    @classmethod
+    def _resolve_batch_item(cls, utterance):
+        matches, rule_ids = cls._batch_rule_set.resolve(utterance)
+        return utterance, matches, rule_ids
+
+    @classmethod
+    def get_pattern(cls, previous, id, match):
+        """
+        Return the pattern [id] from the [previous] rule set if its match is
+        unchanged, or a newly compiled Pattern otherwise
+        """
+
+        pattern = previous.patterns_map.get(id) if previous else None
+        if pattern is None or pattern.get_source() != match:
+            pattern = Pattern(id=id, match=match)
+        return pattern
+
+    @classmethod
+    def get_action(cls, previous, id, type, code, timeout=None):
+        """
+        Return the action [id] from the [previous] rule set if its definition
+        is unchanged, or a new Action otherwise
+        """
+
+        action = previous.actions_map.get(id) if previous else None
+        if action is None or action.get_type() != type or action.get_code() != code \
+                or action.get_timeout() != (float(timeout) if timeout else None):
+            action = Action(id=id, type=type, code=code, timeout=timeout)
+        return action
+
+    def __build_rules_index(self):
+        """
+        Build the inverted index that maps each AND pattern set, as a frozenset
+        of pattern IDs, to the IDs of the rules it satisfies, in rules order, and
+        self.pattern_sets, which maps each pattern ID to the AND sets including it
+        """
+
+        self.rules_index = {}
+        self.pattern_sets = {}
+
+        for rule in self.rules:
+            for pattern_set in set(map(frozenset, rule['on'])):
+                if pattern_set not in self.rules_index:
+                    for pattern_id in pattern_set:
+                        self.pattern_sets.setdefault(pattern_id, []).append(pattern_set)
+                self.rules_index.setdefault(pattern_set, []).append(rule['id'])
+
+class RulesStreamParser(object):
+    """
+    Incremental rules.xml parser. Patterns, actions and rules are built as soon
+    as their elements are closed and the elements are then released, so the
+    whole document is never resident in memory - unlike the minidom parser
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __logger = Logger.get_logger(__name__)
+
+    def __init__(self, config_file, previous=None):
+        """
+        config_file -- Path to the rules XML file
+        previous -- Previously loaded RuleSet, whose unchanged patterns and actions are reused
+        """
+        self.__config_file = config_file
+        self.__previous = previous
+
+    def parse(self):
+        """
+        Parse the rules file and return the (patterns, actions, rules) lists
+        """
+
+        patterns = []
+        actions = []
+        rules = []
+        containers_found = set()
+        items_found = set()
+        app_found = False
+
+        # Stack of (tag, element) for the currently open elements
+        stack = []
+
+        for event, elem in ElementTree.iterparse(self.__config_file, events=('start', 'end')):
+            if event == 'start':
+                stack.append((elem.tag, elem))
+                if elem.tag == 'app':
+                    app_found = True
+                continue
+
+            stack.pop()
+            tags = [_[0] for _ in stack]
+
+            if 'app' not in tags:
+                continue
+
+            if elem.tag in ('patterns', 'actions', 'rules'):
+                containers_found.add(elem.tag)
+                continue
+
+            if elem.tag == 'pattern' and 'patterns' in tags and 'rules' not in tags:
+                patterns.append(self.__parse_pattern(elem, len(patterns)))
+                items_found.add('patterns')
+            elif elem.tag == 'action' and 'actions' in tags and 'rules' not in tags:
+                actions.append(self.__parse_action(elem, len(actions)))
+                items_found.add('actions')
+            elif elem.tag == 'rule' and 'rules' in tags:
+                rules.append(self.__parse_rule(elem, len(rules)))
+                items_found.add('rules')
+            else:
+                continue
+
+            # Release the element and detach it from its parent
+            elem.clear()
+            stack[-1][1].remove(elem)
+
+        if not app_found:
+            raise AttributeError(u'[%s] has no "app" root node' % self.__config_file)
+
+        for container in ('patterns', 'actions', 'rules'):
+            if container not in containers_found:
+                self.__logger.warning({
+                    'msg_type' : 'Configuration warning',
+                    'content'  : '"%s" has no %s node' % (self.__config_file, container)
+                })
+            elif container not in items_found:
+                self.__logger.warning({
+                    'msg_type' : 'Configuration warning',
+                    'content'  : '"%s" has no %s' % (self.__config_file, container)
+                })
+
+        return patterns, actions, rules
+
+    def __parse_pattern(self, elem, index):
+        if not 'id' in elem.attrib:
+            raise AttributeError('Pattern #%d has no ID attribute' % (index+1))
+
+        pattern_id = elem.attrib['id']
+        match = elem.find('.//match')
+        if match is None:
+            raise AttributeError('The pattern [%s] has no match attributes' % pattern_id)
+
+        return RuleSet.get_pattern(self.__previous, pattern_id, match.text or '')
+
+    def __parse_action(self, elem, index):
+        if not 'id' in elem.attrib:
+            raise AttributeError('Action #%d has no ID attribute' % (index+1))
+
+        if not 'type' in elem.attrib:
+            raise AttributeError('Action #%d has no type attribute - either "python" or "shell" is required' % (index+1))
+
+        return RuleSet.get_action(self.__previous, elem.attrib['id'], elem.attrib['type'], elem.text or '',
+            timeout=elem.attrib.get('timeout'))
+
+    @classmethod
+    def __parse_rule(cls, elem, index):
+        if not 'id' in elem.attrib:
+            raise AttributeError('Rule #%d has no ID attribute' % (index+1))
+
+        on_nodes = list(elem.iter('on'))
+        if len(on_nodes) != 1:
+            raise AttributeError('Rule #%d must have exactly one ON node' % (index+1))
+
+        then_nodes = list(elem.iter('then'))
+        if len(then_nodes) != 1:
+            raise AttributeError('Rule #%d must have exactly one THEN node' % (index+1))
+
+        action_ids, after = cls.__parse_then_node(then_nodes[0])
+
+        return {
+            'id': elem.attrib['id'],
+            'on': cls.__parse_on_node(on_nodes[0], []),
+            'then': action_ids,
+            'after': after,
+            'sequential': then_nodes[0].attrib.get('sequential', '').lower() in ('1', 'true', 'yes'),
+        }
+
+    @classmethod
+    def __parse_on_node(cls, node, out_node, in_and = False, in_or = False):
+        " Same logic as Rules.__parse_on_node, on ElementTree elements "
+
+        for child in node:
+            if child.tag == 'pattern':
+                if not 'id' in child.attrib:
+                    raise AttributeError('A rule pattern has no ID attribute')
+
+                if len(out_node) == 0:
+                    out_node.append([child.attrib['id']])
+                else:
+                    if in_and:
+                        out_node[len(out_node)-1].append(child.attrib['id'])
+                    elif in_or:
+                        out_node.append([child.attrib['id']])
+                    else:
+                        raise AttributeError('A rule has multiple patterns specified outside of AND/OR tags')
+            elif child.tag == 'and':
+                if len(out_node) == 0:
+                    out_node.append([])
+                return cls.__parse_on_node(child, out_node, in_and = True, in_or = False)
+            elif child.tag == 'or':
+                return cls.__parse_on_node(child, out_node, in_and = False, in_or = True)
+
+        return out_node
+
+    @classmethod
+    def __parse_then_node(cls, node):
+        " Same logic as Rules.__parse_then_node, on ElementTree elements "
+
+        action_ids = []
+        after = []
+
+        for child in node:
+            if child.tag == 'action':
+                if not 'id' in child.attrib:
+                    raise AttributeError('A rule action has no ID attribute')
+
+            action_ids.append(child.attrib['id'])
+            after.append(re.split(r'\s*,\s*', child.attrib['after'].strip()) if child.attrib.get('after') else [])
+        return action_ids, after
+
 class Rules(object):
     __config = Config.get_config()
     __logger = Logger.get_logger(__name__)
+    __action_pool = None
+    __action_pool_lock = threading.RLock()
+    __default_action_workers = 8
+    # Chunks of utterances per worker read ahead by resolve_batch
+    __batch_read_ahead = 4
+    __resolution_modes = ('full', 'first')
+    # Number of resolved utterances after which the patterns are ranked again by hits
+    __ranking_interval = 1000
 
     """
     Contains the logic to parse and map the rules in rules.xml
     @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
     """
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, use_cache=None, streaming=None, watch=None, match_cache_size=None,
+            approximate=None, hit_stats=None, resolution=None, warm_plugins=None):
+        """
+        config_file -- Path to the rules XML file
+        use_cache -- If True, the compiled rule set is stored to and loaded from the
+            on-disk rules cache (see RulesCache) instead of being parsed at every start.
+            Default: config[rules.cache] or False
+        streaming -- If True, parse the rules file incrementally through RulesStreamParser
+            instead of loading the whole DOM. Default: config[rules.streaming] or False
+        watch -- If True, watch the rules file and reload it whenever it changes
+            (see Rules.watch). Default: config[rules.watch] or False
+        match_cache_size -- Number of case-folded utterances whose matches and rules
+            are kept in an in-memory LRU cache (see MatchCache), 0 to disable it.
+            The first-match resolution doesn't use the cache, as its results depend
+            on the patterns ranking, which changes with the hits.
+            Default: config[rules.match_cache_size] or 0
+        approximate -- If True, pattern_match and resolve fall back to the best
+            approximate match (see Rules.approximate_match) when no pattern matches.
+            Default: config[rules.approximate] or False
+        hit_stats -- If True, count how many times each pattern is matched and persist
+            the counters across restarts (see RulesStats). Default: config[rules.hit_stats] or False
+        resolution -- Resolution mode used by resolve: 'full' matches all the patterns
+            and resolves the rules on the whole set of matched patterns, 'first' stops at
+            the first satisfied rule (see Rules.resolve_first). Default: config[rules.resolution] or 'full'
+        warm_plugins -- If True, load the plugins referenced by the actions (see Rules.warm_plugins)
+            whenever the rules are loaded, instead of at the first run of each action.
+            Default: config[rules.warm_plugins] or False
+        """
+
+        config = Config.get_config()
+        self.__tracer = Tracer.get_tracer()
+
+        metrics = MetricsRegistry.get_registry()
+        utterances_counter = metrics.counter('armando_rules_utterances_total',
+            'Utterances resolved against the rules, by result (match or miss)', ('result',))
+        self.__matches_counter = utterances_counter.labels('match')
+        self.__misses_counter = utterances_counter.labels('miss')
+        self.__resolve_seconds = metrics.histogram('armando_rules_resolve_seconds',
+            'Time spent matching an utterance against the patterns and resolving its rules')
+        self.__actions_counter = metrics.counter('armando_rules_actions_total', 'Actions run, by type', ('type',))
+        self.__action_failures_counter = metrics.counter('armando_rules_action_failures_total',
+            'Actions that raised an exception, failed or were skipped in a rule')
+        self.__action_seconds = metrics.histogram('armando_rules_action_seconds', 'Time spent running an action')
+
         self.__config_file = config_file
-        xml_doc = minidom.parse(self.__config_file)
+        self.__streaming = streaming
+        self.__rule_set = None
+        self.__reload_lock = threading.RLock()
+        self.__watcher = None
+
+        if use_cache is None:
+            use_cache = bool(config.get('rules.cache'))
+        if self.__streaming is None:
+            self.__streaming = bool(config.get('rules.streaming'))
+        if watch is None:
+            watch = bool(config.get('rules.watch'))
+        if approximate is None:
+            approximate = bool(config.get('rules.approximate'))
+        self.__approximate = approximate
+        if hit_stats is None:
+            hit_stats = bool(config.get('rules.hit_stats'))
+        if warm_plugins is None:
+            warm_plugins = bool(config.get('rules.warm_plugins'))
+        self.__warm_plugins = warm_plugins
+
+        self.__resolution = (resolution or config.get('rules.resolution') or 'full').lower()
+        if self.__resolution not in self.__resolution_modes:
+            raise AttributeError('Invalid resolution mode [%s] - valid values: [%s]'
+                % (self.__resolution, ', '.join(self.__resolution_modes)))
+
+        self.__stats = RulesStats.get_stats(config_file) if hit_stats else None
+        self.__patterns_ranks = None
+        self.__hits_since_ranking = 0
+
+        if match_cache_size is None:
+            match_cache_size = config.get('rules.match_cache_size')
+
+        self.__cache = RulesCache() if use_cache else None
+        self.__match_cache = MatchCache(match_cache_size) if match_cache_size and match_cache_size > 0 else None
+        rule_set = self.__cache.load(self.__config_file) if self.__cache else None
+
+        if rule_set is None:
+            rule_set = self.__parse_rules_file()
+            if self.__cache:
+                self.__cache.save(self.__config_file, rule_set)
+
+        self.__rule_set = rule_set
+
+        if self.__warm_plugins:
+            self.warm_plugins()
+        if watch:
+            self.watch()
+
+    def reload(self):
+        """
+        Parse the rules file again and atomically replace the compiled rule set.
+        Patterns and actions whose definition didn't change are reused instead of
+        being compiled again. Calls already in progress keep using the rule set
+        they started with, and the current rule set is left untouched if the
+        new rules file can't be parsed
+        """
 
-        try:
-            self.__config = xml_doc.getElementsByTagName('app')[0]
-        except IndexError as e:
-            raise AttributeError(u'[%s] has no "app" root node' % self.__config_file)
+        with self.__reload_lock:
+            rule_set = self.__parse_rules_file()
+            if self.__cache:
+                self.__cache.save(self.__config_file, rule_set)
 
-        self.__parse_patterns()
-        self.__parse_actions()
-        self.__parse_rules()
+            if self.__warm_plugins:
+                self.warm_plugins(rule_set)
+
+            self.__rule_set = rule_set
+            if self.__match_cache:
+                self.__match_cache.clear()
+
+        self.__logger.info({
+            'msg_type': 'Rules reloaded',
+            'rules_file': self.__config_file,
+            'patterns': len(rule_set.patterns),
+            'actions': len(rule_set.actions),
+            'rules': len(rule_set.rules),
+        })
+
+    def warm_plugins(self, rule_set=None):
+        """
+        Load the plugins referenced by the Python actions of the rule set, and create
+        their singletons, so that the first run of the actions doesn't pay for it.
+        Plugins that can't be loaded are logged and left to fail when their actions run
+        """
+
+        for action in (rule_set or self.__rule_set).actions:
+            if action.get_type() != 'python':
+                continue
+
+            try:
+                action.load_plugins()
+            except Exception as e:
+                self.__logger.warning({
+                    'msg_type': 'Could not load the plugins of the action',
+                    'action_id': action.get_id(),
+                    'plugins': action.get_plugins(),
+                    'exception': str(e),
+                })
+
+    def watch(self, interval=None):
+        """
+        Start watching the rules file in a background thread and reload the rules
+        whenever it changes (see RulesWatcher)
+        interval -- Polling interval in seconds, when inotify is not available
+            (default: config[rules.watch_interval] or 2)
+        """
+
+        with self.__reload_lock:
+            if self.__watcher is not None:
+                return
+
+            self.__watcher = RulesWatcher(self.__config_file, callback=self.reload, interval=interval)
+            self.__watcher.start()
+
+    def stop_watching(self):
+        " Stop watching the rules file "
+
+        with self.__reload_lock:
+            if self.__watcher is None:
+                return
+
+            self.__watcher.stop()
+            self.__watcher = None
+
+    def __parse_rules_file(self):
+        if self.__streaming:
+            patterns, actions, rules = RulesStreamParser(self.__config_file, previous=self.__rule_set).parse()
+            return RuleSet(patterns=patterns, actions=actions, rules=rules, previous=self.__rule_set)
+
+        xml_doc = minidom.parse(self.__config_file)
 
-    def __parse_patterns(self):
         try:
-            xml_patterns = self.__config.getElementsByTagName('patterns')[0]
+            try:
+                xml_app = xml_doc.getElementsByTagName('app')[0]
+            except IndexError as e:
+                raise AttributeError(u'[%s] has no "app" root node' % self.__config_file)
+
+            return RuleSet(
+                patterns=self.__parse_patterns(xml_app),
+                actions=self.__parse_actions(xml_app),
+                rules=self.__parse_rules(xml_app),
+                previous=self.__rule_set)
+        finally:
+            # Break the DOM reference cycles, so the document can be released right away
+            xml_doc.unlink()
+
+    def __parse_patterns(self, xml_app):
+        try:
+            xml_patterns = xml_app.getElementsByTagName('patterns')[0]
         except IndexError as e:
             self.__logger.warning({
                 'msg_type' : 'Configuration warning',
                 'content'  : '"%s" has no patterns node' % self.__config_file
             })
 
-            return
+            return []
 
-        self.__xml_patterns = xml_patterns.getElementsByTagName('pattern')
-        if len(self.__xml_patterns) == 0:
+        xml_pattern_nodes = xml_patterns.getElementsByTagName('pattern')
+        if len(xml_pattern_nodes) == 0:
             self.__logger.warning({
                 'msg_type' : 'Configuration warning',
                 'content'  : '"%s" has no patterns' % self.__config_file
             })
 
-            return
+            return []
 
-        self.__parse_xml_patterns_node()
+        return self.__parse_xml_patterns_node(xml_pattern_nodes)
 
-    def __parse_xml_patterns_node(self):
-        self.__patterns = []
+    def __parse_xml_patterns_node(self, xml_pattern_nodes):
+        patterns = []
 
-        for xml_pattern in self.__xml_patterns:
+        for xml_pattern in xml_pattern_nodes:
             if not 'id' in xml_pattern.attributes:
-                raise AttributeError('Pattern #%d has no ID attribute' % len(__self.patterns)+1)
+                raise AttributeError('Pattern #%d has no ID attribute' % (len(patterns)+1))
 
             pattern_id = xml_pattern.attributes['id'].value
 
@@ -152,94 +1041,100 @@ class Rules(object):
                 raise AttributeError('The pattern [%s] has no match attributes' % pattern_id)
 
             match_content = match.firstChild.wholeText
-            pattern = Pattern(id=pattern_id, match=match_content)
-            self.__patterns.append(pattern)
-        self.__patterns_map = dict(map(lambda _: (_.get_id(), _), self.__patterns))
+            pattern = RuleSet.get_pattern(self.__rule_set, pattern_id, match_content)
+            patterns.append(pattern)
+        return patterns
 
-    def __parse_actions(self):
+    def __parse_actions(self, xml_app):
         try:
-            xml_actions = self.__config.getElementsByTagName('actions')[0]
+            xml_actions = xml_app.getElementsByTagName('actions')[0]
         except IndexError as e:
             self.__logger.warning({
                 'msg_type' : 'Configuration warning',
                 'content'  : '"%s" has no actions node' % self.__config_file
             })
 
-            return
+            return []
 
-        self.__xml_actions = xml_actions.getElementsByTagName('action')
-        if len(self.__xml_actions) == 0:
+        xml_action_nodes = xml_actions.getElementsByTagName('action')
+        if len(xml_action_nodes) == 0:
             self.__logger.warning({
                 'msg_type' : 'Configuration warning',
                 'content'  : '"%s" has no actions' % self.__config_file
             })
 
-            return
+            return []
 
-        self.__parse_xml_actions_node()
+        return self.__parse_xml_actions_node(xml_action_nodes)
 
-    def __parse_xml_actions_node(self):
-        self.__actions = []
-        for xml_action in self.__xml_actions:
+    def __parse_xml_actions_node(self, xml_action_nodes):
+        actions = []
+        for xml_action in xml_action_nodes:
             if not 'id' in xml_action.attributes:
-                raise AttributeError('Action #%d has no ID attribute' % len(__self.actions)+1)
+                raise AttributeError('Action #%d has no ID attribute' % (len(actions)+1))
 
             if not 'type' in xml_action.attributes:
-                raise AttributeError('Action #%d has no type attribute - either "python" or "shell" is required' % len(__self.actions)+1)
+                raise AttributeError('Action #%d has no type attribute - either "python" or "shell" is required' % (len(actions)+1))
 
-            action = Action(\
+            action = RuleSet.get_action(self.__rule_set, \
                 id=xml_action.attributes['id'].value, \
                 type=xml_action.attributes['type'].value, \
-                code=xml_action.firstChild.wholeText)
+                code=xml_action.firstChild.wholeText, \
+                timeout=xml_action.attributes['timeout'].value if 'timeout' in xml_action.attributes else None)
 
-            self.__actions.append(action)
-        self.__actions_map = dict(map(lambda _: (_.get_id(), _), self.__actions))
+            actions.append(action)
+        return actions
 
-    def __parse_rules(self):
+    def __parse_rules(self, xml_app):
         try:
-            xml_rules = self.__config.getElementsByTagName('rules')[0]
+            xml_rules = xml_app.getElementsByTagName('rules')[0]
         except IndexError as e:
             self.__logger.warning({
                 'msg_type' : 'Configuration warning',
                 'content'  : '"%s" has no rules node' % self.__config_file
             })
 
-            return
+            return []
 
-        self.__xml_rules = xml_rules.getElementsByTagName('rule')
-        if len(self.__xml_rules) == 0:
+        xml_rule_nodes = xml_rules.getElementsByTagName('rule')
+        if len(xml_rule_nodes) == 0:
             self.__logger.warning({
                 'msg_type' : 'Configuration warning',
                 'content'  : '"%s" has no rules' % self.__config_file
             })
 
-            return
+            return []
 
-        self.__parse_xml_rules_node()
+        return self.__parse_xml_rules_node(xml_rule_nodes)
 
-    def __parse_xml_rules_node(self):
-        self.__rules = []
+    def __parse_xml_rules_node(self, xml_rule_nodes):
+        rules = []
 
-        for xml_rule in self.__xml_rules:
+        for xml_rule in xml_rule_nodes:
             if not 'id' in xml_rule.attributes:
-                raise AttributeError('Rule #%d has no ID attribute' % len(__self.rules)+1)
+                raise AttributeError('Rule #%d has no ID attribute' % (len(rules)+1))
 
             on_nodes = xml_rule.getElementsByTagName('on')
             if len(on_nodes) != 1:
-                raise AttributeError('Rule #%d must have exactly one ON node' % len(__self.rules)+1)
+                raise AttributeError('Rule #%d must have exactly one ON node' % (len(rules)+1))
 
             then_nodes = xml_rule.getElementsByTagName('then')
             if len(then_nodes) != 1:
-                raise AttributeError('Rule #%d must have exactly one THEN node' % len(__self.rules)+1)
+                raise AttributeError('Rule #%d must have exactly one THEN node' % (len(rules)+1))
+
+            then_node = xml_rule.getElementsByTagName('then')[0]
+            action_ids, after = self.__parse_then_node(then_node)
 
             rule = {
                 'id': xml_rule.attributes['id'].value,
                 'on': self.__parse_on_node(xml_rule.getElementsByTagName('on')[0], []),
-                'then': self.__parse_then_node(xml_rule.getElementsByTagName('then')[0]),
+                'then': action_ids,
+                'after': after,
+                'sequential': then_node.getAttribute('sequential').lower() in ('1', 'true', 'yes'),
             }
 
-            self.__rules.append(rule)
-        self.__rules_map = dict(map(lambda _: (_['id'], _), self.__rules))
+            rules.append(rule)
+        return rules
 
     @classmethod
     def __parse_on_node(cls, node, out_node, in_and = False, in_or = False):
@@ -275,7 +1170,13 @@ class Rules(object):
 
     @classmethod
     def __parse_then_node(cls, node):
+        """
+        Return the list of action IDs in the THEN node, and for each of them the
+        list of action IDs it has to wait for (comma-separated after attribute)
+        """
+
         action_ids = []
+        after = []
         child = node.firstChild
 
         while child != None:
@@ -288,17 +1189,22 @@ class Rules(object):
                     raise AttributeError('A rule action has no ID attribute')
 
             action_ids.append(child.attributes['id'].value)
+            after.append(re.split(r'\s*,\s*', child.getAttribute('after').strip()) if child.getAttribute('after') else [])
             child = child.nextSibling
-        return action_ids
+        return action_ids, after
 
     def get_patterns(self):
-        return self.__patterns
+        return self.__rule_set.patterns
 
     def get_actions(self):
-        return self.__actions
+        return self.__rule_set.actions
 
     def get_rules(self):
-        return self.__rules
+        return self.__rule_set.rules
+
+    def get_rule_set(self):
+        " Return the compiled RuleSet currently in use "
+        return self.__rule_set
 
     def pattern_match(self, string):
         """
@@ -331,68 +1237,279 @@ class Rules(object):
                     }
                 }
 
-        An empty array is returned in case nothing is matched
+        An empty array is returned in case nothing is matched.
+        If approximate matching is enabled and nothing is matched, the best
+        approximate match is returned instead
         """
 
-        matches = []
+        rule_set = self.__rule_set
+        with self.__tracer.span('rules.pattern_match') as span, self.__resolve_seconds.time():
+            if self.__match_cache:
+                matches = self.__cached_resolve(rule_set, string)[0]
+            else:
+                matches = rule_set.matcher.match(string)
 
-        for pattern in self.get_patterns():
-            match_value = pattern.get_match()
-            match_attributes = pattern.get_attributes()
-            m = re.search(match_value, string, re.IGNORECASE)
+            if not matches and self.__approximate:
+                matches = rule_set.get_approximate_matcher().match(string)
+            span.set('matches', len(matches))
 
-            if m:
-                match = {
-                    'id': pattern.get_id(),
-                    'attributes': {},
-                }
+        self.__count_hits(matches)
+        return matches
 
-                for attribute in match_attributes:
-                    attribute_match = m.group(attribute['regex_index'])
-                    if attribute_match:
-                        match['attributes'][attribute['name']] = attribute_match.strip()
+    def resolve(self, string):
+        """
+        Match [string] against the patterns and resolve the rules satisfied by
+        the matched patterns, on the same version of the rule set.
+        Return a tuple (matches, rule_ids), where matches has the same format as
+        the pattern_match output and rule_ids the one of get_rules_by_patterns
+        """
 
-                matches.append(match)
-        return matches
+        rule_set = self.__rule_set
+        with self.__tracer.span('rules.resolve', resolution=self.__resolution) as span, \
+                self.__resolve_seconds.time():
+            if self.__resolution == 'first':
+                matches, rule_ids = rule_set.resolve_first(string, self.__get_patterns_ranks(rule_set))
+            elif self.__match_cache:
+                matches, rule_ids = self.__cached_resolve(rule_set, string)
+            else:
+                matches, rule_ids = rule_set.resolve(string)
 
-    def get_rules_by_patterns(self, pattern_ids):
+            if not matches and self.__approximate:
+                matches = rule_set.get_approximate_matcher().match(string)
+                rule_ids = list(rule_set.rules_index.get(frozenset([_['id'] for _ in matches]), []))
+
+            span.set('matches', len(matches)).set('rules', len(rule_ids))
+
+        self.__count_hits(matches)
+        return matches, rule_ids
+
+    def resolve_first(self, string):
         """
-        Given an array of matched pattern IDs, return an array of matched rules
+        First-match resolution of [string]: the patterns are evaluated one at a time,
+        the most frequently matched first if hit statistics are enabled and in rules.xml
+        order otherwise, and the evaluation stops as soon as the matched patterns satisfy
+        a rule. Cheaper than a full resolution when a few patterns take most of the
+        traffic, but patterns that would have matched later in the order are not reported.
+        The match cache is not used, as the evaluation order changes with the hits.
+        Return a tuple (matches, rule_ids) in the same format as resolve
         """
 
-        rules = []
+        rule_set = self.__rule_set
+        matches, rule_ids = rule_set.resolve_first(string, self.__get_patterns_ranks(rule_set))
+        self.__count_hits(matches)
+        return matches, rule_ids
 
-        for rule in self.__rules:
-            rule_satisfied = False  # OR logic for pattern sets
+    def __count_hits(self, matches):
+        if matches:
+            self.__matches_counter.inc()
+        else:
+            self.__misses_counter.inc()
+
+        if self.__stats and matches:
+            self.__stats.hit([_['id'] for _ in matches])
+            self.__hits_since_ranking += 1
+
+    def __get_patterns_ranks(self, rule_set):
+        """
+        Return the position of each pattern of [rule_set] in the first-match evaluation
+        order, by descending hits. The ranking is refreshed every __ranking_interval hits
+        """
+
+        if not self.__stats:
+            return None
+
+        ranking = self.__patterns_ranks
+        if ranking is None or ranking[0] is not rule_set or self.__hits_since_ranking >= self.__ranking_interval:
+            hits = self.__stats.get_hits()
+            order = sorted(range(len(rule_set.patterns)),
+                key=lambda i: (-hits.get(rule_set.patterns[i].get_id(), 0), i))
+
+            ranks = [0] * len(order)
+            for rank, pattern_index in enumerate(order):
+                ranks[pattern_index] = rank
+
+            ranking = self.__patterns_ranks = (rule_set, ranks)
+            self.__hits_since_ranking = 0
+
+        return ranking[1]
+
+    def get_pattern_hits(self):
+        " Return the hit counters as { pattern_id: hits }, or None if hit statistics are disabled "
+        return self.__stats.get_hits() if self.__stats else None
+
+    def save_pattern_hits(self):
+        " Write the hit counters to disk now, rather than at the next periodic save or at exit "
+        if self.__stats:
+            self.__stats.save()
+
+    def resolve_hypotheses(self, hypotheses, threshold=None):
+        """
+        Resolve the N-best list of the transcripts of an utterance (see
+        SpeechRecognition.recognize_speech_alternatives_from_file), so that a
+        misrecognized first hypothesis doesn't require recording the command again.
+        The hypotheses are prefiltered all at once (see PatternMatcher.get_candidates_many)
+        and evaluated in order, stopping at the first one that resolves to at least one rule.
+        If approximate matching is enabled and no hypothesis matches, they are approximately
+        matched in the same order.
+        hypotheses -- List of (transcript, confidence), from the most to the least likely
+        threshold -- Hypotheses with a confidence lower than this are ignored, while
+            hypotheses with an unknown (None) confidence are always evaluated.
+            Default: config[rules.confidence_threshold] or 0
+        Return the winning hypothesis as { 'index': position in [hypotheses], 'transcript',
+        'confidence', 'matches', 'rule_ids' }, or None if no hypothesis resolves to a rule
+        """
 
-            for pattern_set in rule['on']:
-                pattern_map = dict(map(lambda _: (_, True), pattern_set))
-                input_pattern_map = dict(map(lambda _: (_, True), pattern_ids))
-                pattern_set_satisfied = True  # AND logic for patterns
+        if threshold is None:
+            threshold = Config.get_config().get('rules.confidence_threshold') or 0
 
-                for pattern_id in pattern_ids:
-                    if not pattern_id in pattern_map:
-                        pattern_set_satisfied = False
-                        break
+        rule_set = self.__rule_set
+        hypotheses = list(hypotheses)
+        result = rule_set.resolve_hypotheses(hypotheses, threshold)
 
-                for pattern_id in pattern_set:
-                    if not pattern_id in input_pattern_map:
-                        pattern_set_satisfied = False
-                        break
+        if result is None and self.__approximate:
+            for i, (transcript, confidence) in enumerate(hypotheses):
+                if confidence is not None and confidence < threshold:
+                    continue
 
-                if pattern_set_satisfied:
-                    rule_satisfied = True
+                matches = rule_set.get_approximate_matcher().match(transcript)
+                rule_ids = list(rule_set.rules_index.get(frozenset([_['id'] for _ in matches]), []))
+
+                if rule_ids:
+                    result = {
+                        'index': i,
+                        'transcript': transcript,
+                        'confidence': confidence,
+                        'matches': matches,
+                        'rule_ids': rule_ids,
+                    }
                     break
 
-            if rule_satisfied:
-                rules.append(rule['id'])
-        return rules
+        self.__count_hits(result['matches'] if result else [])
+
+        self.__logger.debug({
+            'msg_type': 'Hypotheses resolved',
+            'hypotheses': len(hypotheses),
+            'winner': result['index'] if result else None,
+            'rule_ids': result['rule_ids'] if result else [],
+        })
+
+        return result
+
+    def approximate_match(self, string, limit=1):
+        """
+        Approximately match [string] against the patterns, to catch utterances
+        misrecognized by the speech API (see ApproximateMatcher).
+        Return up to [limit] matched patterns, sorted by descending similarity,
+        in the same format as pattern_match plus their 'score' between 0 and 1
+        """
+
+        return self.__rule_set.get_approximate_matcher().match(string, limit=limit)
+
+    def __cached_resolve(self, rule_set, string):
+        """
+        Resolve [string] on [rule_set] through the match cache. Entries store the matched
+        pattern IDs, the position of their attributes and the resolved rule IDs, so that
+        the attributes are always extracted from the utterance in its current case
+        """
+
+        # Utterances differing only in case may match differently if some
+        # patterns contain case sensitive groups
+        key = MatchCache.normalize(string, casefold=not rule_set.case_sensitive)
+        entry = self.__match_cache.get(key, rule_set)
+
+        if entry is None:
+            matches = rule_set.matcher.match(string, spans=True)
+            entry = (
+                [(_['id'], list(_['spans'].items())) for _ in matches],
+                tuple(rule_set.rules_index.get(frozenset([_['id'] for _ in matches]), [])),
+            )
+
+            self.__match_cache.put(key, rule_set, entry)
+
+        pattern_spans, rule_ids = entry
+        matches = [{
+            'id': pattern_id,
+            'attributes': dict((name, string[start:end]) for (name, (start, end)) in spans),
+        } for (pattern_id, spans) in pattern_spans]
+
+        return matches, list(rule_ids)
+
+    def get_match_cache_stats(self):
+        """
+        Return the match cache statistics as { 'size', 'max_size', 'hits', 'misses' },
+        or None if the match cache is disabled
+        """
+
+        return self.__match_cache.get_stats() if self.__match_cache else None
+
+    def resolve_batch(self, utterances, processes=None, chunksize=64):
+        """
+        Resolve a (possibly long) iterable of utterances, fanning the work out
+        across a pool of processes that share the compiled rule set - worker
+        processes are forked where the platform supports it, so the rule set is
+        inherited rather than copied. The utterances are read in bounded windows
+        of processes * chunksize * 4 items, so that neither the input nor the
+        pending results are ever loaded in memory as a whole, and the results are
+        streamed back in input order.
+        The workers only run RuleSet.resolve, which never uses the configuration,
+        the loggers, the tracer or the metrics: other threads of this process
+        (rules watcher, log writer, metrics server) may hold their locks at fork
+        time, and the forked copies of those locks would never be released.
+        utterances -- Iterable of strings
+        processes -- Number of worker processes (default: number of CPUs).
+            If 1, utterances are resolved in the calling process
+        chunksize -- Number of utterances sent to a worker at a time
+        Yield a tuple (utterance, matches, rule_ids) for each utterance
+        """
+
+        rule_set = self.__rule_set
+        processes = processes or multiprocessing.cpu_count()
+
+        if processes == 1:
+            for utterance in utterances:
+                matches, rule_ids = rule_set.resolve(utterance)
+                yield utterance, matches, rule_ids
+            return
+
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+
+        pool = context.Pool(processes=processes,
+            initializer=RuleSet._init_batch_worker, initargs=(rule_set,))
+
+        utterances = iter(utterances)
+        window = processes * chunksize * self.__batch_read_ahead
+
+        try:
+            while True:
+                batch = list(itertools.islice(utterances, window))
+                if not batch:
+                    break
+
+                for result in pool.imap(RuleSet._resolve_batch_item, batch, chunksize):
+                    yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def get_rules_by_patterns(self, pattern_ids):
+        """
+        Given an array of matched pattern IDs, return an array of matched rules.
+        A rule is matched if any of its AND pattern sets contains exactly the
+        provided pattern IDs
+        """
+
+        with self.__tracer.span('rules.get_rules_by_patterns'):
+            return list(self.__rule_set.rules_index.get(frozenset(pattern_ids), []))
 
     def get_actions_by_rule(self, rule_id):
-        rule = self.__rules_map[rule_id]
+        rule = self.__rule_set.rules_map[rule_id]
         return rule['then']
 
-    def run_action(self, action_id, arguments={}):
+    def run_action(self, action_id, arguments={}, wait=True):
         """
         Run an action by ID.
         action_id -- Action ID
@@ -400,8 +1517,122 @@ class Rules(object):
             The arguments are defined inside of the action code delimited by $$..$$.
             e.g. if you want to pass {'filename': 'your_file'} to your action, you need
             then to use it through $$filename$$ in your action code.
+        wait -- If False, shell actions return immediately a Future resolving to
+            their ShellResult instead of waiting for the command (see Action.run)
         """
 
-        action = self.__actions_map[action_id]
-        action.run(arguments)
+        return self.__run_action(self.__rule_set.actions_map[action_id], arguments, wait)
+
+    def __run_action(self, action, arguments, wait=True):
+        self.__actions_counter.labels(action.get_type()).inc()
+
+        with self.__tracer.span('rules.run_action', action_id=action.get_id(), type=action.get_type()), \
+                self.__action_seconds.time():
+            try:
+                result = action.run(arguments, wait=wait)
+            except Exception as e:
+                self.__action_failures_counter.inc()
+                raise e
+
+        # Shell commands that failed or timed out count as failures too
+        if isinstance(result, futures.Future):
+            result.add_done_callback(self.__count_failure)
+        else:
+            self.__count_failure(result)
+        return result
+
+    def __count_failure(self, result):
+        " Count a failed action, given its ShellResult or the Future of a shell command run without waiting "
+
+        if isinstance(result, futures.Future):
+            if result.cancelled() or result.exception() is not None:
+                self.__action_failures_counter.inc()
+                return
+            result = result.result()
+
+        if isinstance(result, ShellResult) and not result.succeeded():
+            self.__action_failures_counter.inc()
+
+    @classmethod
+    def __get_action_pool(cls):
+        with cls.__action_pool_lock:
+            if cls.__action_pool is None:
+                cls.__action_pool = ThreadPoolExecutor(max_workers=
+                    Config.get_config().get('rules.action_workers') or cls.__default_action_workers)
+        return cls.__action_pool
+
+    def run_rule(self, rule_id, arguments={}):
+        """
+        Run all the actions of a rule and wait for them to complete.
+        Independent actions run concurrently, while an action declared as
+        <action id="..." after="other-action-id,..."/> only starts once the actions
+        it depends on have succeeded, and all the actions of a
+        <then sequential="true"> block run one after the other.
+        rule_id -- Rule ID
+        arguments -- Arguments passed to all the actions (see run_action)
+        Return a list with an item { 'id': action_id, 'result': result, 'error': exception }
+        for each action, in the same order as the rule THEN node. The actions
+        depending on a failed action are skipped and reported with an error.
+        """
+
+        with self.__tracer.span('rules.run_rule', rule_id=rule_id):
+            return self.__run_rule(self.__rule_set, rule_id, arguments)
+
+    def __run_rule(self, rule_set, rule_id, arguments):
+        action_ids = rule_set.rules_map[rule_id]['then']
+        actions = [rule_set.actions_map[_] for _ in action_ids]
+        dependencies = rule_set.dependencies[rule_id]
+        results = [None for _ in actions]
+        pending = {}
+        failed = set()
+        pool = self.__get_action_pool()
+
+        while True:
+            # Schedule the ready actions - skipped actions can unlock other skipped actions
+            scheduled = True
+            while scheduled:
+                scheduled = False
+                for i, action in enumerate(actions):
+                    if results[i] is not None or i in pending.values() \
+                            or any(results[_] is None for _ in dependencies[i]):
+                        continue
+
+                    if failed.intersection(dependencies[i]):
+                        failed.add(i)
+                        self.__action_failures_counter.inc()
+                        results[i] = {'id': action_ids[i], 'result': None,
+                            'error': RuntimeError('Action skipped, one of its dependencies failed')}
+                        scheduled = True
+                    else:
+                        pending[pool.submit(self.__tracer.bind(self.__run_action), action, arguments)] = i
+
+            if not pending:
+                break
+
+            done, _ = futures.wait(list(pending.keys()), return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                error = future.exception()
+                result = future.result() if error is None else None
+
+                if isinstance(result, ShellResult) and not result.succeeded():
+                    error = RuntimeError('The shell command %s' % ('timed out' if result.timed_out
+                        else 'returned %d' % result.returncode))
+
+                results[i] = {
+                    'id': action_ids[i],
+                    'result': result,
+                    'error': error,
+                }
+
+                if error is not None:
+                    failed.add(i)
+                    self.__logger.error({
+                        'msg_type': 'Action failed',
+                        'rule_id': rule_id,
+                        'action_id': action_ids[i],
+                        'exception': str(error),
+                    })
+
+        return results
 
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import pickle
+
+from __init__ import Armando
+from config import Config
+from logger import Logger
+
+class RulesCache(object):
+    """
+    On-disk cache for compiled rule sets. A cached rule set is keyed on the
+    rules file real path, size, modification time and content hash, and it is
+    only returned as long as all of them still match the rules file on disk.
+    Note that the cache files are pickled objects, so the cache directory must
+    not be writable by untrusted users.
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    # Increase it whenever the layout of the cached objects changes
+    __cache_version = 6
+    __default_cache_dir = '%s/rules_cache' % (Armando.get_tmp_dir())
+
+    def __init__(self, cache_dir=None):
+        """
+        cache_dir -- Directory where the compiled rule sets are stored.
+            Default: config[rules.cache_dir] or __TMPDIR__/rules_cache
+        """
+
+        self.__config = Config.get_config()
+        self.__logger = Logger.get_logger(__name__)
+        self.cache_dir = cache_dir or self.__config.get('rules.cache_dir') or self.__default_cache_dir
+
+    def __get_cache_file(self, rules_file):
+        return self.cache_dir + os.sep + \
+            hashlib.sha1(os.path.realpath(rules_file).encode()).hexdigest() + '.cache'
+
+    @classmethod
+    def __get_file_stat(cls, rules_file):
+        stat = os.stat(rules_file)
+        return {
+            'version': cls.__cache_version,
+            'path': os.path.realpath(rules_file),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+        }
+
+    @classmethod
+    def __get_file_hash(cls, rules_file):
+        with open(rules_file, 'rb') as fp:
+            return hashlib.sha256(fp.read()).hexdigest()
+
+    def load(self, rules_file):
+        """
+        Return the cached rule set for [rules_file], or None if there is no valid
+        cached copy for the current version of the file
+        """
+
+        cache_file = self.__get_cache_file(rules_file)
+        if not os.path.isfile(cache_file):
+            return None
+
+        try:
+            with open(cache_file, 'rb') as fp:
+                key = pickle.load(fp)
+                if key != dict(self.__get_file_stat(rules_file), hash=key.get('hash')) \
+                        or key['hash'] != self.__get_file_hash(rules_file):
+                    return None
+
+                rule_set = pickle.load(fp)
+        except Exception as e:
+            self.__logger.warning({
+                'msg_type': 'Invalid rules cache file',
+                'cache_file': cache_file,
+                'rules_file': rules_file,
+                'exception': str(e),
+            })
+
+            return None
+
+        self.__logger.debug({
+            'msg_type': 'Rules loaded from cache',
+            'cache_file': cache_file,
+            'rules_file': rules_file,
+        })
+
+        return rule_set
+
+    def save(self, rules_file, rule_set):
+        """
+        Store the compiled [rule_set] for [rules_file]. Errors are logged and
+        otherwise ignored, as the cache is only an optimization
+        """
+
+        cache_file = self.__get_cache_file(rules_file)
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+
+            key = dict(self.__get_file_stat(rules_file), hash=self.__get_file_hash(rules_file))
+
+            with open(tmp_file, 'wb') as fp:
+                pickle.dump(key, fp, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(rule_set, fp, pickle.HIGHEST_PROTOCOL)
+
+            # Atomic replace, concurrent readers never see a partially written cache
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            self.__logger.warning({
+                'msg_type': 'Could not write the rules cache file',
+                'cache_file': cache_file,
+                'rules_file': rules_file,
+                'exception': str(e),
+            })
+
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+# vim:sw=4:ts=4:et:
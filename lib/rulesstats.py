@@ -0,0 +1,166 @@
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+import weakref
+
+from __init__ import Armando
+from config import Config
+from logger import Logger
+
+class RulesStats(object):
+    """
+    Per-pattern hit counters of a rules file, persisted across restarts as a
+    JSON file. Counters are keyed on the pattern IDs, so they survive the
+    changes to the rules file, and they are saved at most once every
+    save_interval seconds and when the process exits. The Rules instances
+    counting the hits of the same stats file share their counters (see get_stats)
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __default_stats_dir = '%s/rules_stats' % (Armando.get_tmp_dir())
+    __default_save_interval = 60
+    # Live instances, saved at exit, and the shared instances by stats file
+    __instances = weakref.WeakSet()
+    __shared_instances = weakref.WeakValueDictionary()
+    __instances_lock = threading.Lock()
+
+    def __init__(self, rules_file, stats_file=None, save_interval=None):
+        """
+        rules_file -- Rules file whose pattern hits are counted
+        stats_file -- JSON file where the counters are stored. Default: config[rules.stats_file]
+            or __TMPDIR__/rules_stats/<hash of the rules file path>.json
+        save_interval -- Minimum interval in seconds between two saves of the counters
+            (default: config[rules.stats_save_interval] or 60)
+        """
+
+        self.__config = Config.get_config()
+        self.__logger = Logger.get_logger(__name__)
+        self.__lock = threading.Lock()
+        self.__save_lock = threading.Lock()
+
+        self.stats_file = self.__get_stats_file(rules_file, stats_file)
+
+        self.save_interval = float(save_interval or self.__config.get('rules.stats_save_interval')
+            or self.__default_save_interval)
+
+        self.__hits = self.__load()
+        self.__dirty = False
+        self.__last_save = time.time()
+
+        with self.__instances_lock:
+            self.__instances.add(self)
+
+    @classmethod
+    def __get_stats_file(cls, rules_file, stats_file=None):
+        return stats_file or Config.get_config().get('rules.stats_file') or \
+            cls.__default_stats_dir + os.sep + \
+            hashlib.sha1(os.path.realpath(rules_file).encode()).hexdigest() + '.json'
+
+    @classmethod
+    def get_stats(cls, rules_file, stats_file=None, save_interval=None):
+        """
+        Return the counters of [rules_file] shared by all the users of the same
+        stats file, so that their hits are summed rather than overwritten at each
+        save. The counters are created if no one is using them (see RulesStats)
+        """
+
+        stats_file = cls.__get_stats_file(rules_file, stats_file)
+
+        with cls.__instances_lock:
+            stats = cls.__shared_instances.get(stats_file)
+
+        if stats is None:
+            stats = RulesStats(rules_file, stats_file=stats_file, save_interval=save_interval)
+            with cls.__instances_lock:
+                stats = cls.__shared_instances.setdefault(stats_file, stats)
+        return stats
+
+    @classmethod
+    def save_all(cls):
+        " Save the counters of all the live instances - called when the process exits "
+
+        with cls.__instances_lock:
+            instances = list(cls.__instances)
+
+        for stats in instances:
+            stats.save()
+
+    def __load(self):
+        if not os.path.isfile(self.stats_file):
+            return {}
+
+        try:
+            with open(self.stats_file) as fp:
+                return dict((str(k), int(v)) for (k, v) in json.load(fp)['hits'].items())
+        except Exception as e:
+            self.__logger.warning({
+                'msg_type': 'Invalid rules stats file',
+                'stats_file': self.stats_file,
+                'exception': str(e),
+            })
+
+            return {}
+
+    def hit(self, pattern_ids):
+        " Count a hit for each of [pattern_ids], and save the counters if due "
+
+        if not pattern_ids:
+            return
+
+        with self.__lock:
+            for pattern_id in pattern_ids:
+                self.__hits[pattern_id] = self.__hits.get(pattern_id, 0) + 1
+            self.__dirty = True
+            save = time.time() - self.__last_save >= self.save_interval
+
+        if save:
+            self.save()
+
+    def get_hits(self):
+        " Return a copy of the counters, as { pattern_id: hits } "
+
+        with self.__lock:
+            return dict(self.__hits)
+
+    def save(self):
+        " Write the counters to the stats file, if they changed since the last save "
+
+        # Saves are serialized, so an older copy of the counters never replaces a newer one
+        with self.__save_lock:
+            with self.__lock:
+                if not self.__dirty:
+                    return
+
+                content = json.dumps({'hits': self.__hits})
+                self.__dirty = False
+                self.__last_save = time.time()
+
+            self.__write(content)
+
+    def __write(self, content):
+        tmp_file = '%s.%d.%d.tmp' % (self.stats_file, os.getpid(), threading.get_ident())
+
+        try:
+            stats_dir = os.path.dirname(self.stats_file)
+            if stats_dir and not os.path.isdir(stats_dir):
+                os.makedirs(stats_dir)
+
+            with open(tmp_file, 'w') as fp:
+                fp.write(content)
+            os.replace(tmp_file, self.stats_file)
+        except Exception as e:
+            self.__logger.warning({
+                'msg_type': 'Could not write the rules stats file',
+                'stats_file': self.stats_file,
+                'exception': str(e),
+            })
+
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+atexit.register(RulesStats.save_all)
+
+# vim:sw=4:ts=4:et:
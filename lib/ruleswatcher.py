@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+import traceback
+
+from config import Config
+from logger import Logger
+
+try:
+    import inotify_simple
+except ImportError as e:
+    inotify_simple = None
+
+class RulesWatcher(threading.Thread):
+    """
+    Watches a rules file and invokes a callback whenever the file changes.
+    It relies on inotify if the inotify_simple module is available, and it
+    falls back to polling the file modification time, size and inode otherwise.
+    @depend: inotify_simple [pip install inotify_simple] (optional)
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __default_interval = 2
+    # Wait for bursts of writes (e.g. editors saving through a temporary file) to settle
+    __settle_seconds = 0.2
+
+    def __init__(self, rules_file, callback, interval=None):
+        """
+        rules_file -- Path of the file to be watched
+        callback -- Function invoked without arguments when the file changes
+        interval -- Polling interval in seconds, used when inotify is not available
+            (default: config[rules.watch_interval] or 2)
+        """
+        super(RulesWatcher, self).__init__()
+        self.daemon = True
+
+        self.__config = Config.get_config()
+        self.__logger = Logger.get_logger(__name__)
+
+        self.rules_file = os.path.realpath(rules_file)
+        self.callback = callback
+        self.interval = float(interval or self.__config.get('rules.watch_interval') or self.__default_interval)
+        self.__stop_event = threading.Event()
+        self.__last_stat = self.__get_file_stat()
+        self.__inotify = self.__init_inotify() if inotify_simple else None
+
+    def __init_inotify(self):
+        # Watch the directory rather than the file, as many editors replace the
+        # file through a rename, which would silently drop a watch on the file itself
+        flags = inotify_simple.flags
+        inotify = inotify_simple.INotify()
+        inotify.add_watch(os.path.dirname(self.rules_file),
+            flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+        return inotify
+
+    def __get_file_stat(self):
+        try:
+            stat = os.stat(self.rules_file)
+            return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except OSError as e:
+            return None
+
+    def __notify(self):
+        time.sleep(self.__settle_seconds)
+
+        try:
+            self.callback()
+        except Exception as e:
+            self.__logger.error({
+                'msg_type': 'Could not reload the rules file',
+                'rules_file': self.rules_file,
+                'exception': str(e),
+                'traceback': traceback.format_exc(),
+            })
+
+    def __poll(self):
+        while not self.__stop_event.wait(self.interval):
+            stat = self.__get_file_stat()
+            if stat is not None and stat != self.__last_stat:
+                self.__last_stat = stat
+                self.__notify()
+
+    def __watch_inotify(self):
+        inotify = self.__inotify
+        filename = os.path.basename(self.rules_file)
+
+        try:
+            while not self.__stop_event.is_set():
+                events = inotify.read(timeout=int(self.interval * 1000))
+                if any(event.name == filename for event in events):
+                    # Drain the other events of the same burst
+                    inotify.read(timeout=int(self.__settle_seconds * 1000))
+                    self.__notify()
+        finally:
+            inotify.close()
+
+    def run(self):
+        self.__logger.info({
+            'msg_type': 'Watching rules file',
+            'rules_file': self.rules_file,
+            'method': 'inotify' if self.__inotify else 'polling',
+        })
+
+        if self.__inotify:
+            self.__watch_inotify()
+        else:
+            self.__poll()
+
+    def stop(self):
+        " Stop watching the file "
+        self.__stop_event.set()
+
+# vim:sw=4:ts=4:et:
@@ -0,0 +1,126 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+from logger import Logger
+
+class ShellResult(object):
+    """
+    Outcome of a shell command run through ShellExecutor
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    def __init__(self, command, returncode, stdout, stderr, timed_out, duration, action_id=None):
+        self.command = command
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.duration = duration
+        self.action_id = action_id
+
+    def succeeded(self):
+        " Return True if the command terminated in time with exit status 0 "
+        return not self.timed_out and self.returncode == 0
+
+class ShellExecutor(object):
+    """
+    Runs shell commands on a bounded pool of workers, so that slow commands
+    never block the caller. Each command is started in its own process group
+    and the whole group is killed if the command exceeds its timeout.
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __executor = None
+    __executor_lock = threading.RLock()
+    __default_max_workers = 4
+
+    def __init__(self, max_workers=None, timeout=None):
+        """
+        max_workers -- Maximum number of commands running at the same time, further
+            commands are queued (default: config[rules.shell_workers] or 4)
+        timeout -- Default timeout in seconds for the commands
+            (default: config[rules.shell_timeout] or no timeout)
+        """
+        self.__config = Config.get_config()
+        self.__logger = Logger.get_logger(__name__)
+
+        self.max_workers = max_workers or self.__config.get('rules.shell_workers') or self.__default_max_workers
+        self.timeout = timeout or self.__config.get('rules.shell_timeout') or None
+        self.__pool = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    @classmethod
+    def get_executor(cls):
+        """
+        Thread-safe singleton to access or initialize the static default shell executor
+        """
+        cls.__executor_lock.acquire()
+        try:
+            if cls.__executor is None:
+                cls.__executor = ShellExecutor()
+        finally:
+            cls.__executor_lock.release()
+        return cls.__executor
+
+    def __run(self, command, timeout, action_id):
+        start_time = time.time()
+        timed_out = False
+
+        process = subprocess.Popen(command, shell=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=True)
+
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired as e:
+            timed_out = True
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError as e:
+                pass
+            stdout, stderr = process.communicate()
+
+        result = ShellResult(command=command, returncode=process.returncode,
+            stdout=stdout.decode(errors='replace'), stderr=stderr.decode(errors='replace'),
+            timed_out=timed_out, duration=time.time()-start_time, action_id=action_id)
+
+        log = self.__logger.debug if result.succeeded() else self.__logger.warning
+        log({
+            'msg_type': 'Shell command timed out' if timed_out else 'Shell command terminated',
+            'action_id': action_id,
+            'returncode': result.returncode,
+            'duration': result.duration,
+            'stdout': result.stdout,
+            'stderr': result.stderr,
+        })
+
+        return result
+
+    def submit(self, command, timeout=None, action_id=None):
+        """
+        Schedule a shell command and return a concurrent.futures.Future
+        that resolves to its ShellResult
+        command -- Shell command to be executed
+        timeout -- Timeout in seconds for this command (default: self.timeout)
+        action_id -- ID of the action that runs the command, for logging purposes
+        """
+
+        self.__logger.debug({
+            'msg_type': 'Submitting shell command',
+            'action_id': action_id,
+            'command': command,
+        })
+
+        return self.__pool.submit(self.__run, command,
+            float(timeout) if timeout else self.timeout, action_id)
+
+    def shutdown(self, wait=True):
+        " Stop accepting new commands and, if wait is True, wait for the running ones "
+        self.__pool.shutdown(wait=wait)
+
+# vim:sw=4:ts=4:et:
@@ -1,5 +1,7 @@
 from config import Config
 from logger import Logger
+from metrics import MetricsRegistry
+from tracing import Tracer
 
 import json
 import os
@@ -34,13 +36,19 @@ class SpeechRecognition():
 
         self.__config = Config.get_config()
         self.__logger = Logger.get_logger(__name__)
-        self.api_key = self.__config.get('speech.api_key')
-        self.languages = self.__config.get('speech.languages')
+        self.__tracer = Tracer.get_tracer()
+
+        metrics = MetricsRegistry.get_registry()
+        self.__requests_counter = metrics.counter('armando_speech_requests_total', 'Speech recognition API requests')
+        self.__failures_counter = metrics.counter('armando_speech_failures_total',
+            'Failed speech recognitions, by reason (connection, http or not_recognized)', ('reason',))
+        self.__request_seconds = metrics.histogram('armando_speech_request_seconds',
+            'Duration of the speech recognition API requests')
+        self.__confidence_histogram = metrics.histogram('armando_speech_confidence',
+            'Confidence of the recognized transcripts', buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1))
 
-        if self.languages:
-            self.languages = self.languages.split('\s*,\s*')
-        else:
-            self.languages = self.__default_languages
+        self.api_key = self.__config.get('speech.api_key')
+        self.languages = list(self.__config.get('speech.languages') or self.__default_languages)
 
         if not self.api_key:
             raise AttributeError('No Google speech recognition API key in ' \
@@ -54,9 +62,13 @@ class SpeechRecognition():
             'languages': self.languages,
         })
 
-    def recognize_speech_from_file(self):
+    def recognize_speech_alternatives_from_file(self):
         """
-        Recognizes the speech contained in a FLAC audio file
+        Recognizes the speech contained in a FLAC audio file and returns the full
+        N-best list of the recognized transcripts, as [(transcript, confidence), ...]
+        sorted from the most to the least likely. The API usually reports the confidence
+        of the first alternative only: a missing confidence is 1 for the first alternative,
+        as in recognize_speech_from_file, and None for the other ones
         self.filename -- From config[audio.flac_file]
         """
 
@@ -64,35 +76,72 @@ class SpeechRecognition():
         if not filename:
             raise AttributeError('No audio.flac_file configuration option specified')
 
+        with open(filename, 'rb') as fp:
+            return self.recognize_speech_alternatives(fp.read())
+
+    def recognize_speech_alternatives(self, data):
+        """
+        Recognizes the speech contained in the FLAC audio [data] (bytes, e.g. the output of
+        AudioSource.record_to_flac_data) and returns the N-best list of the recognized
+        transcripts, in the same format as recognize_speech_alternatives_from_file
+        """
+
         self.__logger.info({
             'msg_type': 'Google Speech Recognition API request',
             'api_key': '******',
             'language': self.languages[0],
         })
 
-        r = requests.post( \
-            'http://www.google.com/speech-api/v2/recognize?' + urlencode({
-                'lang': self.languages[0],
-                'key': self.api_key,
-                'output': 'json',
-            }),
-
-            data = open(filename, 'rb').read(),
-            headers = {
-                'Content-type': 'audio/x-flac; rate=44100',
-            },
-        )
-
-        if not r.ok:
-            raise RuntimeError('Got an unexpected HTTP response %d from the server' % r.status_code)
+        self.__requests_counter.inc()
+
+        with self.__tracer.span('speech.recognize', language=self.languages[0]) as span, \
+                self.__request_seconds.time():
+            try:
+                r = requests.post( \
+                    'http://www.google.com/speech-api/v2/recognize?' + urlencode({
+                        'lang': self.languages[0],
+                        'key': self.api_key,
+                        'output': 'json',
+                    }),
+
+                    data = data,
+                    headers = {
+                        'Content-type': 'audio/x-flac; rate=44100',
+                    },
+                )
+            except Exception as e:
+                self.__failures_counter.labels('connection').inc()
+                raise e
+
+            span.set('status', r.status_code)
+            if not r.ok:
+                self.__failures_counter.labels('http').inc()
+                raise RuntimeError('Got an unexpected HTTP response %d from the server' % r.status_code)
 
         self.__logger.info({
             'msg_type': 'Google Speech Recognition API response',
             'response': r.text,
         })
 
+        try:
+            alternatives = self.parse_alternatives(r.text)
+        except SpeechRecognitionError as e:
+            self.__failures_counter.labels('not_recognized').inc()
+            raise e
+
+        if alternatives[0][1] is not None:
+            self.__confidence_histogram.observe(alternatives[0][1])
+        return alternatives
+
+    @classmethod
+    def parse_alternatives(cls, response_text):
+        """
+        Parse the N-best list of the final result out of a Google Speech
+        Recognition API response (see recognize_speech_alternatives_from_file)
+        """
+
         response = []
-        for line in re.split('\r?\n', r.text):
+        for line in re.split('\r?\n', response_text):
             if re.match('^\s*$', line):
                 continue
             response.append(json.loads(line))
@@ -102,10 +151,28 @@ class SpeechRecognition():
                 for _ in item['result']:
                     if 'final' in _:
                         if 'alternative' in _ and len(_['alternative']):
-                            return _['alternative'][0]['transcript'], \
-                                _['alternative'][0]['confidence'] if 'confidence' in _['alternative'][0] else 1
+                            return [(alternative['transcript'],
+                                alternative['confidence'] if 'confidence' in alternative else (1 if i == 0 else None))
+                                for (i, alternative) in enumerate(_['alternative'])]
 
         raise SpeechRecognitionError('Speech not recognized')
 
+    def recognize_speech_from_file(self):
+        """
+        Recognizes the speech contained in a FLAC audio file and returns
+        the most likely transcript as (transcript, confidence)
+        self.filename -- From config[audio.flac_file]
+        """
+
+        return self.recognize_speech_alternatives_from_file()[0]
+
+    def recognize_speech(self, data):
+        """
+        Recognizes the speech contained in the FLAC audio [data] and returns
+        the most likely transcript as (transcript, confidence)
+        """
+
+        return self.recognize_speech_alternatives(data)[0]
+
 # vim:sw=4:ts=4:et:
 
@@ -0,0 +1,233 @@
+import collections
+import threading
+import time
+import uuid
+
+from config import Config
+from logger import Logger
+
+class Span(object):
+    """
+    Timed stage of a traced request, measured on the monotonic clock. Spans
+    are used as context managers, and the spans opened inside a span on the
+    same thread (or in functions wrapped through Tracer.bind) are its children
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'timestamp', 'start', 'end',
+        'attributes', 'error', '_Span__tracer', '_Span__previous')
+
+    def __init__(self, tracer, name, trace_id, parent_id=None, attributes=None):
+        self.__tracer = tracer
+        self.__previous = None
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.error = None
+        self.timestamp = None
+        self.start = None
+        self.end = None
+
+    def set(self, key, value):
+        " Set the attribute [key] of the span "
+        self.attributes[key] = value
+        return self
+
+    def get_duration(self):
+        " Return the duration of the span in seconds, None if the span is still open "
+        return self.end - self.start if self.end is not None else None
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'timestamp': self.timestamp,
+            'duration_ms': self.get_duration() * 1000 if self.end is not None else None,
+            'attributes': dict(self.attributes),
+            'error': self.error,
+        }
+
+    def __enter__(self):
+        self.__previous = self.__tracer._push(self)
+        self.timestamp = time.time()
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.end = time.monotonic()
+        if exc_type is not None:
+            self.error = '%s: %s' % (exc_type.__name__, exc_value)
+
+        self.__tracer._pop(self, self.__previous)
+        return False
+
+class NullSpan(object):
+    """
+    Span returned when tracing is disabled, which doesn't record anything
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __slots__ = ()
+
+    def set(self, key, value):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+class Tracer(object):
+    """
+    Lightweight tracing of the stages of a voice command (recording, encoding,
+    speech recognition, rules matching, actions and plugin calls). All the spans
+    opened while a span is open share its trace ID, so the stages of a command
+    can be correlated. Closed spans are stored in an in-memory ring buffer
+    and/or logged, according to config[tracing.output].
+    Example:
+        tracer = Tracer.get_tracer()
+        with tracer.span('command'):
+            audio.record_to_flac()
+            ...
+        spans = tracer.get_trace(trace_id)
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __tracer = None
+    __tracer_lock = threading.RLock()
+    __null_span = NullSpan()
+    __default_buffer_size = 1000
+    __outputs = ('buffer', 'logger', 'both')
+
+    def __init__(self, enabled=None, output=None, buffer_size=None):
+        """
+        enabled -- Whether the spans are recorded (default: config[tracing.enabled] or False)
+        output -- Where the closed spans go: buffer (in-memory ring buffer), logger or both
+            (default: config[tracing.output] or buffer)
+        buffer_size -- Number of spans kept in the ring buffer (default: config[tracing.buffer_size] or 1000)
+        """
+        self.__logger = Logger.get_logger(__name__)
+        self.__local = threading.local()
+        self.__load_settings(enabled, output, buffer_size)
+        Config.subscribe('tracing', self.__on_config_change)
+
+    @classmethod
+    def get_tracer(cls):
+        """
+        Thread-safe singleton to access or initialize the static default tracer
+        """
+        tracer = cls.__tracer
+        if tracer is not None:
+            return tracer
+
+        cls.__tracer_lock.acquire()
+        try:
+            if cls.__tracer is None:
+                cls.__tracer = Tracer()
+        finally:
+            cls.__tracer_lock.release()
+        return cls.__tracer
+
+    def __load_settings(self, enabled=None, output=None, buffer_size=None):
+        config = Config.get_config()
+        self.enabled = bool(enabled if enabled is not None else config.get('tracing.enabled'))
+        self.output = (output or config.get('tracing.output') or 'buffer').lower()
+        self.buffer_size = int(buffer_size or config.get('tracing.buffer_size') or self.__default_buffer_size)
+
+        if self.output not in self.__outputs:
+            raise AttributeError('Invalid tracing output [%s] - valid values: [%s]'
+                % (self.output, ', '.join(self.__outputs)))
+
+        self.__spans = collections.deque(maxlen=self.buffer_size)
+
+    def __on_config_change(self, key, old_value, new_value):
+        " Apply the changes to the [tracing] settings - the ring buffer is emptied "
+        self.__load_settings()
+
+    def span(self, name, **attributes):
+        """
+        Return a new span named [name], to be used as a context manager. The span
+        is a child of the current span if any, otherwise it starts a new trace.
+        attributes -- Initial attributes of the span
+        """
+
+        if not self.enabled:
+            return self.__null_span
+
+        parent = self.get_current_span()
+        if parent is None:
+            return Span(self, name, uuid.uuid4().hex[:16], attributes=attributes)
+        return Span(self, name, parent.trace_id, parent_id=parent.span_id, attributes=attributes)
+
+    def start_trace(self, name, trace_id=None, **attributes):
+        """
+        Return a new root span named [name], which starts a new trace even if a span
+        is open on the current thread.
+        trace_id -- Request ID of the trace (default: a new random ID)
+        """
+
+        if not self.enabled:
+            return self.__null_span
+        return Span(self, name, trace_id or uuid.uuid4().hex[:16], attributes=attributes)
+
+    def get_current_span(self):
+        " Return the innermost open span of the current thread, or None "
+        return getattr(self.__local, 'span', None)
+
+    def get_current_trace_id(self):
+        " Return the trace ID of the current span, or None "
+        span = self.get_current_span()
+        return span.trace_id if span else None
+
+    def bind(self, func):
+        """
+        Return a function calling [func] with the current span as parent span,
+        so that the spans opened by [func] in another thread (e.g. in a thread pool)
+        belong to the current trace
+        """
+
+        parent = self.get_current_span()
+        if parent is None:
+            return func
+
+        def traced(*args, **kwargs):
+            previous = self._push(parent)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.__local.span = previous
+
+        return traced
+
+    def _push(self, span):
+        previous = getattr(self.__local, 'span', None)
+        self.__local.span = span
+        return previous
+
+    def _pop(self, span, previous):
+        self.__local.span = previous
+
+        if self.output != 'logger':
+            self.__spans.append(span)
+
+        if self.output != 'buffer':
+            self.__logger.info(dict(span.to_dict(), msg_type='Trace span'))
+
+    def get_spans(self, trace_id=None):
+        " Return the closed spans in the ring buffer, oldest first, optionally only of [trace_id] "
+        return [_ for _ in list(self.__spans) if trace_id is None or _.trace_id == trace_id]
+
+    def get_trace(self, trace_id):
+        " Return the closed spans of [trace_id] as dictionaries, in order of start time "
+        return [_.to_dict() for _ in sorted(self.get_spans(trace_id), key=lambda span: span.start)]
+
+    def clear(self):
+        " Empty the ring buffer "
+        self.__spans.clear()
+
+# vim:sw=4:ts=4:et:
@@ -0,0 +1,136 @@
+import array
+import math
+import sys
+
+from config import Config
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+
+class VoiceActivityDetector(object):
+    """
+    Energy-based voice activity detection over a stream of raw PCM audio
+    (signed 16 bit little endian samples). The audio is split in fixed windows,
+    and a window contains speech if its short-term energy (RMS) is above
+    energy_threshold and its zero-crossing rate is below zcr_threshold (noise
+    has a high zero-crossing rate). The recording can stop once speech has
+    been followed by trailing_silence seconds of silence, when no speech
+    started within start_timeout seconds, or after max_seconds.
+    @depend: numpy [pip install numpy] (optional, the windows are analyzed in pure Python otherwise)
+    @author: Fabio "BlackLight" Manganiello <blacklight86@gmail.com>
+    """
+
+    __default_window_ms = 30
+    __default_energy_threshold = 0.02
+    __default_zcr_threshold = 0.4
+    __default_min_speech = 0.1
+    __default_trailing_silence = 0.8
+    __default_start_timeout = 3
+    __default_max_seconds = 10
+
+    def __init__(self, sample_rate=44100, channels=2, window_ms=None, energy_threshold=None, zcr_threshold=None,
+            min_speech=None, trailing_silence=None, start_timeout=None, max_seconds=None):
+        """
+        sample_rate -- Sample rate of the audio
+        channels -- Number of interleaved channels of the audio, only the first one is analyzed
+        window_ms -- Analysis window in milliseconds (default: config[audio.vad_window_ms] or 30)
+        energy_threshold -- Minimum RMS of a speech window, relative to the full scale
+            (default: config[audio.vad_energy_threshold] or 0.02)
+        zcr_threshold -- Maximum zero-crossing rate of a speech window, in crossings per sample
+            (default: config[audio.vad_zcr_threshold] or 0.4)
+        min_speech -- Seconds of consecutive speech windows needed to detect the start of the speech
+            (default: config[audio.vad_min_speech] or 0.1)
+        trailing_silence -- Seconds of silence after the speech that end the recording
+            (default: config[audio.vad_trailing_silence] or 0.8)
+        start_timeout -- Seconds after which the recording ends if no speech started
+            (default: config[audio.vad_start_timeout] or 3)
+        max_seconds -- Maximum duration of the recording (default: config[audio.vad_max_seconds] or 10)
+        """
+
+        config = Config.get_config()
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.window_ms = int(window_ms or config.get('audio.vad_window_ms') or self.__default_window_ms)
+        self.energy_threshold = float(energy_threshold or config.get('audio.vad_energy_threshold')
+            or self.__default_energy_threshold)
+        self.zcr_threshold = float(zcr_threshold or config.get('audio.vad_zcr_threshold')
+            or self.__default_zcr_threshold)
+        self.min_speech = float(min_speech or config.get('audio.vad_min_speech') or self.__default_min_speech)
+        self.trailing_silence = float(trailing_silence or config.get('audio.vad_trailing_silence')
+            or self.__default_trailing_silence)
+        self.start_timeout = float(start_timeout or config.get('audio.vad_start_timeout')
+            or self.__default_start_timeout)
+        self.max_seconds = float(max_seconds or config.get('audio.vad_max_seconds') or self.__default_max_seconds)
+
+        self.window_samples = max(1, self.sample_rate * self.window_ms // 1000)
+        self.window_bytes = self.window_samples * self.channels * 2
+        self.reset()
+
+    def reset(self):
+        " Reset the detector for a new recording "
+        self.speech_detected = False
+        self.finished = False
+        self.windows = 0
+        self.__speech_windows = 0
+        self.__silence_windows = 0
+
+    def get_duration(self):
+        " Return the duration in seconds of the audio processed so far "
+        return self.windows * self.window_ms / 1000
+
+    def analyze(self, window):
+        " Return (rms, zcr) of the first channel of the PCM [window] (bytes) "
+
+        window = window[:len(window) - len(window) % (2 * self.channels)]
+        if not window:
+            return 0, 0
+
+        if numpy is not None:
+            samples = numpy.frombuffer(window, dtype='<i2')[::self.channels].astype(numpy.float64)
+            rms = math.sqrt(numpy.dot(samples, samples) / len(samples)) / 32768
+            zcr = numpy.count_nonzero(numpy.diff(numpy.signbit(samples))) / len(samples)
+            return rms, zcr
+
+        samples = array.array('h', window)
+        if sys.byteorder == 'big':
+            samples.byteswap()
+
+        samples = samples[::self.channels]
+        rms = math.sqrt(sum(_ * _ for _ in samples) / len(samples)) / 32768
+        zcr = sum(1 for (a, b) in zip(samples, samples[1:]) if (a < 0) != (b < 0)) / len(samples)
+        return rms, zcr
+
+    def is_speech(self, window):
+        " Return True if the PCM [window] contains speech "
+        rms, zcr = self.analyze(window)
+        return rms >= self.energy_threshold and zcr <= self.zcr_threshold
+
+    def process(self, window):
+        """
+        Process the next PCM [window] of the recording (self.window_bytes long, except
+        possibly the last one) and return True when the recording should stop
+        """
+
+        self.windows += 1
+
+        if self.is_speech(window):
+            self.__speech_windows += 1
+            self.__silence_windows = 0
+            if self.__speech_windows * self.window_ms >= self.min_speech * 1000:
+                self.speech_detected = True
+        else:
+            self.__speech_windows = 0
+            self.__silence_windows += 1
+
+        duration = self.get_duration()
+        if self.speech_detected:
+            self.finished = self.__silence_windows * self.window_ms >= self.trailing_silence * 1000
+        else:
+            self.finished = duration >= self.start_timeout
+
+        self.finished = self.finished or duration >= self.max_seconds
+        return self.finished
+
+# vim:sw=4:ts=4:et:
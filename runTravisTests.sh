@@ -1,6 +1,9 @@
 #!/bin/bash
 
 cd t/
+./testaudiosource.py
 ./testconfig.py
+./testlogger.py
+./testmetrics.py
 ./testspeechrules.py
 
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+import unittest
+import math
+import os
+import random
+import struct
+import sys
+import time
+
+from __armando__ import Armando
+
+###
+Armando.initialize()
+###
+
+from config import Config
+Config.get_config('conf/main.test.conf')
+
+from audiosource import AudioSource
+from voiceactivitydetector import VoiceActivityDetector
+
+# Generates stereo 16 bit PCM at 44100 Hz: [silence seconds] of silence, [speech seconds]
+# of a 440 Hz tone, then silence for [trailing seconds] (forever if negative)
+pcm_generator = sys.executable + """ -c '
+import math, struct, sys
+silence, speech, trailing = [float(_) for _ in sys.argv[1:]]
+out = sys.stdout.buffer
+tone = b"".join(struct.pack("<hh", v, v) for v in (int(8000 * math.sin(2 * math.pi * 440 * i / 44100)) for i in range(4410)))
+out.write(b"\\0" * int(silence * 44100) * 4)
+out.write(tone * int(speech * 10))
+while trailing != 0:
+    out.write(b"\\0" * 4410 * 4)
+    out.flush()
+    trailing = max(0, trailing - 0.1) if trailing > 0 else trailing
+' """
+
+def pcm(samples):
+    return b''.join(struct.pack('<hh', _, _) for _ in samples)
+
+def tone(seconds, amplitude=8000):
+    return pcm(int(amplitude * math.sin(2 * math.pi * 440 * i / 44100)) for i in range(int(seconds * 44100)))
+
+def silence(seconds):
+    return pcm(0 for i in range(int(seconds * 44100)))
+
+class TestAudioSource(unittest.TestCase):
+    def setUp(self):
+        self.audio = AudioSource()
+        self.audio.stream_record_cmd = 'printf "recorded audio"'
+        self.audio.stream_flac_cmd = 'tr a-z A-Z'
+        self.audio.flac_file = 'test_audio.flac'
+
+    def tearDown(self):
+        if os.path.isfile(self.audio.flac_file):
+            os.remove(self.audio.flac_file)
+
+    def test_record_to_flac_data(self):
+        self.assertEqual(self.audio.record_to_flac_data(), b'RECORDED AUDIO')
+
+    def test_record_to_flac_streaming(self):
+        self.audio.streaming = True
+        self.audio.record_to_flac()
+
+        with open(self.audio.flac_file, 'rb') as fp:
+            self.assertEqual(fp.read(), b'RECORDED AUDIO')
+        self.assertFalse(os.path.isfile(self.audio.wav_file), 'No WAV file should be written')
+
+    def test_record_failure(self):
+        self.audio.stream_record_cmd = 'exit 1'
+        self.assertRaises(RuntimeError, self.audio.record_to_flac_data)
+
+        self.audio.stream_record_cmd = 'printf "recorded audio"'
+        self.audio.stream_flac_cmd = 'cat > /dev/null'
+        self.assertRaises(RuntimeError, self.audio.record_to_flac_data)
+
+    def test_voice_activity_detector(self):
+        detector = VoiceActivityDetector(min_speech=0.1, trailing_silence=0.3, start_timeout=1, max_seconds=5)
+        self.assertTrue(detector.is_speech(tone(0.03)))
+        self.assertFalse(detector.is_speech(silence(0.03)))
+
+        # Loud noise has a high zero-crossing rate
+        noise = pcm(random.choice((-8000, 8000)) for i in range(1323))
+        self.assertFalse(detector.is_speech(noise))
+
+        audio = silence(0.3) + tone(0.5) + silence(2)
+        windows = [audio[i:i + detector.window_bytes] for i in range(0, len(audio), detector.window_bytes)]
+        processed = 0
+        for window in windows:
+            processed += 1
+            if detector.process(window):
+                break
+
+        self.assertTrue(detector.speech_detected)
+        self.assertAlmostEqual(detector.get_duration(), 1.1, delta=0.1)
+
+        detector.reset()
+        for window in windows[:10]:
+            detector.process(windows[0])
+        self.assertFalse(detector.finished)
+        for window in windows[:30]:
+            detector.process(windows[0])
+        self.assertTrue(detector.finished, 'The recording should stop if no speech starts')
+        self.assertFalse(detector.speech_detected)
+
+    def test_record_to_flac_vad(self):
+        self.audio.vad = True
+        self.audio.vad_flac_cmd = 'cat'
+
+        # The recorder never stops by itself: the recording ends after the trailing silence
+        self.audio.vad_record_cmd = pcm_generator + '0.5 0.5 -1'
+        start = time.time()
+        data = self.audio.record_to_flac_data()
+        self.assertTrue(time.time() - start < 5, 'The recording did not stop after the speech')
+
+        # Pre-roll, speech and trailing silence
+        self.assertTrue(0.5 * 44100 * 4 <= len(data) <= 2 * 44100 * 4, '%d bytes recorded' % len(data))
+
+        # Recordings without speech are discarded
+        self.audio.vad_record_cmd = pcm_generator + '0.5 0 0'
+        self.assertEqual(self.audio.record_to_flac_data(), None)
+        self.assertFalse(self.audio.record_to_flac())
+        self.assertFalse(os.path.isfile(self.audio.flac_file))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -38,6 +38,105 @@ class TestConfig(unittest.TestCase):
         self.assertEqual(self.config.get('dirs.libdir'), Armando.get_lib_dir(), 'dirs.basedir incorrectly set')
         self.assertEqual(self.config.get('dirs.sharedir'), Armando.get_share_dir(), 'dirs.basedir incorrectly set')
 
+    def test_typed_values(self):
+        self.assertEqual(self.config.get('mpd.port'), 56600, 'mpd.port should be an int')
+        self.assertEqual(self.config.get('MPD.host'), 'localhost', 'mpd.host should be a string')
+        self.assertEqual(self.config.mpd.port, 56600, 'mpd.port is not readable as an attribute')
+        self.assertEqual(self.config.get_section('Logger').loglevel, 'DEBUG', 'logger.loglevel is not readable from its section')
+        self.assertIsNone(self.config.speech.languages, 'speech.languages should not exist')
+        self.assertRaises(AttributeError, getattr, self.config, 'not_a_section')
+
+    def test_read_only(self):
+        import operator
+        self.assertRaises(TypeError, operator.setitem, self.config.config, 'mpd.port', 1)
+        self.assertRaises(AttributeError, setattr, self.config.mpd, 'port', 1)
+
+    def test_invalid_typed_value(self):
+        import os
+        import tempfile
+        from config import ConfigError
+
+        fd, rcfile = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as fp:
+            fp.write('[mpd]\nport = not a number\n[hue]\nlightbulbs = Kitchen, Living room\n')
+
+        try:
+            self.assertRaises(ConfigError, Config, rcfile)
+            with open(rcfile, 'w') as fp:
+                fp.write('[hue]\nlightbulbs = Kitchen, Living room\n')
+            self.assertEqual(Config(rcfile).hue.lightbulbs, ('Kitchen', 'Living room'))
+        finally:
+            os.remove(rcfile)
+
+    def test_rules_typed_values(self):
+        import os
+        import tempfile
+        from config import ConfigError
+
+        fd, rcfile = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as fp:
+            fp.write('[rules]\ncache = off\napproximate = yes\nmatch_cache_size = 16\nshell_timeout = 2.5\n')
+
+        try:
+            rules = Config(rcfile).rules
+            self.assertIs(rules.cache, False)
+            self.assertIs(rules.approximate, True)
+            self.assertEqual(rules.match_cache_size, 16)
+            self.assertEqual(rules.shell_timeout, 2.5)
+
+            with open(rcfile, 'w') as fp:
+                fp.write('[rules]\nshell_workers = many\n')
+            self.assertRaises(ConfigError, Config, rcfile)
+        finally:
+            os.remove(rcfile)
+
+    def test_reload(self):
+        import gc
+        import os
+        import tempfile
+
+        class Subscriber(object):
+            def __init__(self):
+                self.changes = []
+                Config.subscribe('mpd', self.on_change)
+
+            def on_change(self, key, old_value, new_value):
+                self.changes.append((key, old_value, new_value))
+
+        fd, rcfile = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as fp:
+            fp.write('[logger]\nlogfile = __BASEDIR__/t/tests.log\nloglevel = DEBUG\n[mpd]\nhost = localhost\nport = 6600\n')
+
+        try:
+            config = Config.get_config(rcfile)
+            self.assertIs(Config.get_config(), config)
+
+            from mpd import MPD
+            mpd = MPD()
+            subscriber = Subscriber()
+
+            with open(rcfile, 'w') as fp:
+                fp.write('[logger]\nlogfile = __BASEDIR__/t/tests.log\nloglevel = DEBUG\n[mpd]\nhost = mpdhost\nport = 6601\n')
+
+            self.assertEqual(Config.reload(), ['mpd.host', 'mpd.port'])
+            self.assertIsNot(Config.get_config(), config)
+            self.assertEqual(config.get('mpd.host'), 'localhost', 'The previous snapshot should not change')
+            self.assertEqual(Config.get_config().get('mpd.port'), 6601)
+            self.assertEqual((mpd.host, mpd.port), ('mpdhost', 6601))
+            self.assertEqual(subscriber.changes, [('mpd.host', 'localhost', 'mpdhost'), ('mpd.port', 6600, 6601)])
+
+            # Subscribers are weakly referenced
+            del subscriber
+            gc.collect()
+            self.assertEqual(Config.reload(), [])
+
+            with open(rcfile, 'w') as fp:
+                fp.write('[mpd]\nport = invalid\n')
+            self.assertRaises(Exception, Config.reload)
+            self.assertEqual(Config.get_config().get('mpd.port'), 6601)
+        finally:
+            os.remove(rcfile)
+
 if __name__ == "__main__":
     unittest.main()
 
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+import unittest
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from __armando__ import Armando
+
+###
+Armando.initialize()
+###
+
+from config import Config
+Config.get_config('conf/main.test.conf')
+
+from logger import AsyncLogWriter, Logger, SegmentedLogHandler, SegmentedLogReader
+
+class RecordsHandler(logging.Handler):
+    def __init__(self):
+        super(RecordsHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(json.loads(record.getMessage()))
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        Logger.get_logger(__name__)
+        self.handler = RecordsHandler()
+        logging.getLogger().addHandler(self.handler)
+
+    def tearDown(self):
+        logging.getLogger().removeHandler(self.handler)
+
+    def test_lazy_fields(self):
+        logger = Logger.get_logger(__name__)
+        calls = []
+        msg = { 'msg_type': 'Lazy record', 'payload': lambda: calls.append(1) or 'payload' }
+
+        level = logging.root.level
+        logging.root.setLevel(logging.INFO)
+        try:
+            logger.debug(msg)
+            self.assertEqual(calls, [], 'Lazy fields should not be evaluated below the log level')
+            self.assertEqual(self.handler.records, [])
+
+            logger.info(msg)
+            self.assertEqual(calls, [1])
+            self.assertEqual(self.handler.records[0]['payload'], 'payload')
+            self.assertEqual(self.handler.records[0]['module'], __name__)
+            self.assertFalse('module' in msg, "The caller's record should not be modified")
+        finally:
+            logging.root.setLevel(level)
+
+    def test_truncated_fields(self):
+        record = Logger.render({ 'response': 'x' * 100, 'short': 'y', 'n': 1 }, __name__, 10)
+        self.assertEqual(record['response'], 'x' * 10 + '... [90 bytes truncated]')
+        self.assertEqual((record['short'], record['n']), ('y', 1))
+
+        # Multi-byte characters are never split
+        record = Logger.render({ 'text': '\u00e8' * 10 }, __name__, 5)
+        self.assertEqual(record['text'], '\u00e8' * 2 + '... [15 bytes truncated]')
+        self.assertEqual(Logger.render({ 'text': 'x' * 100 }, __name__, 0)['text'], 'x' * 100)
+
+    def test_async_writer(self):
+        writer = AsyncLogWriter(queue_size=100, flush_interval=0.05)
+        writer.start()
+
+        try:
+            msg = { 'msg_type': 'Async record' }
+            for i in range(10):
+                self.assertTrue(writer.enqueue((0, logging.INFO, __name__, dict(msg, seq=i))))
+
+            self.assertTrue(writer.flush(5), 'The queued records were not written')
+            self.assertEqual([_['seq'] for _ in self.handler.records], list(range(10)))
+            self.assertEqual(self.handler.records[0]['module'], __name__)
+        finally:
+            writer.stop()
+
+    def test_async_writer_max_field_bytes_reload(self):
+        writer = AsyncLogWriter(queue_size=100)
+        fd, rcfile = tempfile.mkstemp()
+
+        try:
+            with os.fdopen(fd, 'w') as fp, open('conf/main.test.conf') as src:
+                fp.write(src.read().replace('[logger]\n', '[logger]\nmax_field_bytes = 10\n'))
+            Config.reload(rcfile)
+
+            writer.enqueue((0, logging.INFO, __name__, { 'response': 'x' * 100 }))
+            writer.flush()
+            self.assertEqual(self.handler.records[-1]['response'], 'x' * 10 + '... [90 bytes truncated]')
+        finally:
+            Config.reload('conf/main.test.conf')
+            os.remove(rcfile)
+
+    def test_async_writer_overflow(self):
+        # Records are queued but not written until the writer is started
+        writer = AsyncLogWriter(queue_size=4, overflow='drop')
+        results = [writer.enqueue((0, logging.INFO, __name__, { 'seq': i })) for i in range(6)]
+        self.assertEqual(results, [True] * 4 + [False] * 2)
+        self.assertEqual(writer.dropped, 2)
+
+        writer.flush()
+        self.assertEqual([_.get('seq') for _ in self.handler.records], [0, 1, 2, 3, None])
+        self.assertEqual(self.handler.records[-1]['dropped'], 2, 'The dropped records were not reported')
+
+        writer = AsyncLogWriter(queue_size=8, overflow='sample', sample_rate=2)
+        results = [writer.enqueue((0, logging.INFO, __name__, { 'seq': i })) for i in range(8)]
+        self.assertEqual(results, [True] * 4 + [False, True] * 2)
+
+        self.assertRaises(AttributeError, AsyncLogWriter, overflow='invalid')
+
+    def test_async_writer_block(self):
+        writer = AsyncLogWriter(queue_size=2, overflow='block', flush_interval=0.05)
+        for i in range(2):
+            writer.enqueue((0, logging.INFO, __name__, { 'seq': i }))
+
+        producer = threading.Thread(target=writer.enqueue, args=((0, logging.INFO, __name__, { 'seq': 2 }),))
+        producer.start()
+        producer.join(0.2)
+        self.assertTrue(producer.is_alive(), 'The producer should wait for room in the queue')
+
+        writer.start()
+        try:
+            producer.join(5)
+            self.assertFalse(producer.is_alive(), 'The producer was not unblocked')
+            writer.flush(5)
+            self.assertEqual([_['seq'] for _ in self.handler.records], [0, 1, 2])
+            self.assertEqual(writer.dropped, 0)
+        finally:
+            writer.stop()
+
+    def test_segmented_log(self):
+        logs_dir = tempfile.mkdtemp()
+        logfile = logs_dir + os.sep + 'test.log'
+        handler = SegmentedLogHandler(logfile, segment_bytes=1000, max_bytes=2500, compress=True)
+
+        try:
+            for i in range(100):
+                level = logging.WARNING if i % 10 == 0 else logging.INFO
+                msg = json.dumps({ 'msg_type': 'Segmented record', 'module': __name__, 'seq': i, 'payload': 'x' * 20 })
+                handler.handle(logging.LogRecord(__name__, level, __file__, 0, msg, None, None))
+
+            # Wait for the background compression
+            deadline = time.time() + 5
+            while time.time() < deadline and any(not path.endswith('.gz') for (sequence, path)
+                    in SegmentedLogHandler.get_segments(logfile)):
+                time.sleep(0.05)
+            time.sleep(0.1)
+
+            segments = SegmentedLogHandler.get_segments(logfile)
+            self.assertTrue(len(segments) > 1, 'The log was not rotated')
+            self.assertTrue(all(path.endswith('.gz') for (sequence, path) in segments), 'The segments were not compressed')
+            self.assertTrue(os.path.getsize(logfile) <= 1000)
+
+            total = sum(os.path.getsize(logs_dir + os.sep + _) for _ in os.listdir(logs_dir))
+            self.assertTrue(total <= 2500, 'The log takes %d bytes on disk' % total)
+
+            reader = SegmentedLogReader(logfile)
+            records = list(reader.read())
+            seqs = [_['seq'] for _ in records]
+            self.assertEqual(seqs, list(range(seqs[0], 100)), 'The records should be read in order')
+            self.assertTrue(seqs[0] > 0, 'The oldest segments should have been removed')
+            self.assertEqual(records[-1]['level'], 'INFO')
+
+            warnings = list(reader.read(level='warning', contains='Segmented'))
+            self.assertEqual([_['seq'] for _ in warnings], [_ for _ in seqs if _ % 10 == 0])
+            self.assertEqual(list(reader.read(msg_type='Segmented record', match=lambda r: r['seq'] == 99))[0]['seq'], 99)
+            self.assertEqual(list(reader.read(since=time.time() + 60)), [])
+        finally:
+            handler.close()
+            shutil.rmtree(logs_dir)
+
+    def test_segmented_log_age_after_restart(self):
+        logs_dir = tempfile.mkdtemp()
+        logfile = logs_dir + os.sep + 'test.log'
+
+        # Segment opened two days ago by a previous run, and written a minute ago
+        with open(logfile, 'w') as fp:
+            fp.write('%.3f INFO {"msg_type": "Old record"}\n' % (time.time() - 2 * 24 * 60 * 60))
+            fp.write('%.3f INFO {"msg_type": "Recent record"}\n' % (time.time() - 60))
+
+        handler = SegmentedLogHandler(logfile, segment_seconds=24 * 60 * 60, compress=False)
+
+        try:
+            msg = json.dumps({ 'msg_type': 'New record', 'module': __name__ })
+            handler.handle(logging.LogRecord(__name__, logging.INFO, __file__, 0, msg, None, None))
+
+            segments = SegmentedLogHandler.get_segments(logfile)
+            self.assertEqual(len(segments), 1, 'The old segment was not rotated')
+            self.assertEqual([_['msg_type'] for _ in SegmentedLogReader(logfile).read()],
+                ['Old record', 'Recent record', 'New record'])
+        finally:
+            handler.close()
+            shutil.rmtree(logs_dir)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.request
+
+from __armando__ import Armando
+
+###
+Armando.initialize()
+###
+
+from config import Config
+Config.get_config('conf/main.test.conf')
+
+from metrics import MetricsRegistry, MetricsServer
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counters_and_gauges(self):
+        counter = self.registry.counter('test_requests_total', 'Test requests', ('result',))
+        counter.labels('ok').inc()
+        counter.labels('ok').inc(2)
+        counter.labels('error').inc()
+        self.assertTrue(self.registry.counter('test_requests_total', 'Test requests', ('result',)) is counter)
+        self.assertRaises(AttributeError, self.registry.gauge, 'test_requests_total', 'Test requests')
+        self.assertRaises(AttributeError, counter.labels, 'ok', 'extra')
+
+        gauge = self.registry.gauge('test_queue_size', 'Test queue size')
+        gauge.set(5)
+        gauge.dec()
+
+        self.assertEqual(self.registry.dump(), '\n'.join([
+            '# HELP test_queue_size Test queue size',
+            '# TYPE test_queue_size gauge',
+            'test_queue_size 4',
+            '# HELP test_requests_total Test requests',
+            '# TYPE test_requests_total counter',
+            'test_requests_total{result="error"} 1',
+            'test_requests_total{result="ok"} 3',
+        ]) + '\n')
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('test_seconds', 'Test latency', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+
+        errors = self.registry.counter('test_errors_total', 'Test errors')
+        with self.assertRaises(RuntimeError):
+            with histogram.time(errors_counter=errors):
+                raise RuntimeError()
+
+        lines = self.registry.dump().split('\n')
+        self.assertTrue('test_seconds_bucket{le="0.1"} 3' in lines, 'Fast requests not counted')
+        self.assertTrue('test_seconds_bucket{le="1.0"} 4' in lines)
+        self.assertTrue('test_seconds_bucket{le="+Inf"} 5' in lines)
+        self.assertTrue('test_seconds_count 5' in lines)
+        self.assertTrue('test_errors_total 1' in lines)
+
+    def test_server(self):
+        self.registry.counter('test_served_total', 'Test counter').inc()
+        server = MetricsServer(self.registry, host='127.0.0.1', port=0)
+        server.start()
+
+        try:
+            response = urllib.request.urlopen('http://127.0.0.1:%d/metrics' % server.port, timeout=5)
+            self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+            self.assertTrue('test_served_total 1' in response.read().decode().split('\n'))
+        finally:
+            server.stop()
+
+    def test_server_address_in_use(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+
+        try:
+            self.assertEqual(self.registry.serve(host='127.0.0.1', port=sock.getsockname()[1]), None)
+        finally:
+            sock.close()
+
+        self.registry.counter('test_unserved_total', 'Test counter').inc()
+        self.assertTrue('test_unserved_total 1' in self.registry.dump().split('\n'))
+
+    def test_lazy_registry(self):
+        " Importing the rules doesn't create the metrics registry, the server is only started explicitly "
+
+        fd, rcfile = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as fp, open('conf/main.test.conf') as src:
+            fp.write(src.read() + '\n[metrics]\nenabled = True\nport = 0\n')
+
+        code = '\n'.join([
+            'import threading',
+            'from __armando__ import Armando',
+            'Armando.initialize()',
+            'from config import Config',
+            'Config.get_config(%r)' % rcfile,
+            'import rules',
+            'from metrics import MetricsRegistry',
+            'print(MetricsRegistry._MetricsRegistry__registry is None)',
+            'print(any(_.name == "MetricsServer" for _ in threading.enumerate()))',
+            'server = MetricsRegistry.start_server()',
+            'print(server is MetricsRegistry.start_server() and server.is_alive())',
+        ])
+
+        try:
+            output = subprocess.check_output([sys.executable, '-c', code], timeout=60).decode().split()
+            self.assertEqual(output, ['True', 'False', 'True'])
+        finally:
+            os.remove(rcfile)
+
+    def test_rules_metrics(self):
+        from rules import Rules
+        rules = Rules('conf/speech.test.xml')
+        registry = MetricsRegistry.get_registry()
+        utterances = registry.get_metric('armando_rules_utterances_total')
+        matches, misses = utterances.labels('match').value, utterances.labels('miss').value
+
+        rules.resolve('create the file foo')
+        rules.pattern_match('nothing to see here')
+        self.assertEqual(utterances.labels('match').value, matches + 1)
+        self.assertEqual(utterances.labels('miss').value, misses + 1)
+        self.assertTrue('armando_rules_resolve_seconds_count' in registry.dump())
+
+    def test_rules_action_failures(self):
+        from rules import Rules
+        rules = Rules('conf/speech.test.xml')
+        failures = MetricsRegistry.get_registry().get_metric('armando_rules_action_failures_total')
+        arguments = {'filename': 'test_metrics_missing_file'}
+
+        # Failed shell commands are counted once, whether they run alone or in a rule
+        value = failures.value
+        self.assertFalse(rules.run_action('remove-test-file-shell', arguments).succeeded())
+        self.assertEqual(failures.value, value + 1)
+
+        self.assertIsNotNone(rules.run_rule('remove-test-file-shell-on-remove-file', arguments)[0]['error'])
+        self.assertEqual(failures.value, value + 2)
+
+        future = rules.run_action('remove-test-file-shell', arguments, wait=False)
+        self.assertFalse(future.result().succeeded())
+
+        deadline = time.time() + 5
+        while time.time() < deadline and failures.value < value + 3:
+            time.sleep(0.01)
+        self.assertEqual(failures.value, value + 3)
+
+if __name__ == "__main__":
+    unittest.main()
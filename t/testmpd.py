@@ -29,6 +29,13 @@ class TestConfig(unittest.TestCase):
         current_track = self.mpd.get_current_track()
         self.assertEqual(current_track.get('artist'), 'Miles Davis')
 
+        # Bytes received from the socket, not decoded characters
+        from metrics import MetricsRegistry
+        counter = MetricsRegistry.get_registry().get_metric('armando_mpd_response_bytes_total')
+        value = counter.value
+        response = self.mpd.server_cmd('currentsong')
+        self.assertEqual(counter.value - value, len('\n'.join(response).encode('utf-8')))
+
     def tearDown(self):
         self.mpd_mock.stop()
 
@@ -2,6 +2,9 @@
 
 import unittest
 import os
+import shutil
+import tempfile
+import time
 
 from __armando__ import Armando
 
@@ -18,6 +21,32 @@ class TestTakkRules(unittest.TestCase):
         Config.get_config('conf/main.test.conf')
         from rules import Rules
         self.rules = Rules('conf/speech.test.xml')
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def __create_rules(self, rules_options, rules_class=None):
+        " Create the rules with the [rules] options set only in the configuration file "
+
+        from rules import Rules
+        rcfile = self.tmp_dir + os.sep + 'main.conf'
+
+        try:
+            with open('conf/main.test.conf') as src, open(rcfile, 'w') as dst:
+                dst.write(src.read() + '\n[rules]\n' + ''.join('%s = %s\n' % _ for _ in rules_options.items()))
+
+            Config.reload(rcfile)
+            return (rules_class or Rules)('conf/speech.test.xml', use_cache=False)
+        finally:
+            Config.reload('conf/main.test.conf')
+
+    def __write_rules_file(self, patterns='', rules=''):
+        " Write a copy of conf/speech.test.xml, with some more patterns and rules, to the temporary directory "
+
+        rules_file = self.tmp_dir + os.sep + 'rules.xml'
+        with open('conf/speech.test.xml') as fp:
+            content = fp.read()
+        with open(rules_file, 'w') as fp:
+            fp.write(content.replace('<patterns>', '<patterns>' + patterns).replace('<rules>', '<rules>' + rules))
+        return rules_file
 
     def test_pattern_matched(self):
         patterns = self.rules.pattern_match('play some music artist Led Zeppelin')
@@ -29,6 +58,361 @@ class TestTakkRules(unittest.TestCase):
         patterns = self.rules.pattern_match('this will never be matched by any of my rules')
         self.assertEqual(len(patterns), 0)
 
+    def test_multiple_patterns_matched(self):
+        patterns = self.rules.pattern_match('create the file foo then remove the file bar')
+        self.assertEqual([_['id'] for _ in patterns], ['create-file', 'remove-file'])
+        self.assertEqual(patterns[0]['attributes']['filename'], 'bar')
+        self.assertEqual(patterns[1]['attributes']['filename'], 'bar')
+
+    def test_compiled_matcher_consistency(self):
+        import re
+
+        for string in ['play some music artist Led Zeppelin album IV',
+                       'PLAY music title Black Dog',
+                       'create a file foo', 'remove file bar and create file foo',
+                       'nothing to see here', '']:
+            expected = []
+            for pattern in self.rules.get_patterns():
+                m = re.search(pattern.get_match(), string, re.IGNORECASE)
+                if m:
+                    expected.append({
+                        'id': pattern.get_id(),
+                        'attributes': dict([(_['name'], m.group(_['regex_index']).strip())
+                            for _ in pattern.get_attributes() if m.group(_['regex_index'])]),
+                    })
+
+            self.assertEqual(self.rules.pattern_match(string), expected)
+
+    def test_pattern_literals(self):
+        patterns = dict([(_.get_id(), _) for _ in self.rules.get_patterns()])
+        self.assertEqual(patterns['play-music'].get_literals(), ['play', 'music'])
+        self.assertEqual(patterns['create-file'].get_literals(), ['create', 'file'])
+
+        from rules import Pattern
+        self.assertEqual(Pattern('lights', 'turn (on|off) the lights?').get_literals(), ['turn', 'the', 'light'])
+        self.assertEqual(Pattern('alternation', 'lights on|lights off').get_literals(), [])
+
+    def test_pattern_invalid_regex_index(self):
+        from rules import Pattern
+        self.assertEqual(Pattern('volume', 'volume (up|down) {steps[regex-index=2]}').search('volume up 3'),
+            {'steps': '3'})
+        self.assertRaises(AttributeError, Pattern, 'volume', 'volume (up|down) {steps[regex-index=3]}')
+
+    def test_pattern_literals_prefilter(self):
+        patterns = self.rules.pattern_match('Playing some MUSIC artist Led Zeppelin')
+        self.assertEqual(len(patterns), 1)
+        self.assertEqual(patterns[0]['attributes']['artist'], 'Led Zeppelin')
+
+    def test_rules_cache(self):
+        from rulescache import RulesCache
+
+        rules_file = self.__write_rules_file()
+        cache = RulesCache(cache_dir=self.tmp_dir)
+        self.assertEqual(cache.load(rules_file), None)
+        cache.save(rules_file, self.rules.get_rule_set())
+
+        rule_set = cache.load(rules_file)
+        self.assertEqual([_.get_id() for _ in rule_set.patterns],
+            [_.get_id() for _ in self.rules.get_patterns()])
+        self.assertEqual(rule_set.rules, self.rules.get_rules())
+        self.assertEqual(rule_set.matcher.match('play music artist Led Zeppelin'),
+            self.rules.pattern_match('play music artist Led Zeppelin'))
+
+        with open(rules_file, 'a') as fp:
+            fp.write('\n')
+        self.assertEqual(cache.load(rules_file), None)
+
+    def test_streaming_parser(self):
+        from rules import Rules
+        rules = Rules('conf/speech.test.xml', use_cache=False, streaming=True)
+
+        self.assertEqual([_.get_id() for _ in rules.get_patterns()],
+            [_.get_id() for _ in self.rules.get_patterns()])
+        self.assertEqual([_.get_match() for _ in rules.get_patterns()],
+            [_.get_match() for _ in self.rules.get_patterns()])
+        self.assertEqual([(_.get_id(), _.get_type(), _.get_code()) for _ in rules.get_actions()],
+            [(_.get_id(), _.get_type(), _.get_code()) for _ in self.rules.get_actions()])
+        self.assertEqual(rules.get_rules(), self.rules.get_rules())
+
+    def test_reload(self):
+        from rules import Rules
+
+        rules_file = self.__write_rules_file()
+        rules = Rules(rules_file, use_cache=False)
+        old_patterns = dict([(_.get_id(), _) for _ in rules.get_patterns()])
+        self.assertEqual(rules.pattern_match('next song'), [])
+
+        self.__write_rules_file(patterns='<pattern id="next-song"><match>next song</match></pattern>')
+        rules.reload()
+        new_patterns = dict([(_.get_id(), _) for _ in rules.get_patterns()])
+        self.assertEqual(rules.pattern_match('next song'), [{'id': 'next-song', 'attributes': {}}])
+        self.assertTrue(new_patterns['play-music'] is old_patterns['play-music'])
+        self.assertEqual(rules.get_rules_by_patterns(['create-file']), ['create-test-file-shell-on-create-file'])
+
+        # A broken rules file leaves the current rule set in place
+        with open(rules_file, 'w') as fp:
+            fp.write('<app>')
+        self.assertRaises(Exception, rules.reload)
+        self.assertEqual(len(rules.pattern_match('next song')), 1)
+
+    def test_watch(self):
+        from rules import Rules
+
+        rules = Rules(self.__write_rules_file(), use_cache=False)
+        rules.watch(interval=0.1)
+
+        try:
+            self.__write_rules_file(patterns='<pattern id="next-song"><match>next song</match></pattern>')
+
+            for i in range(50):
+                if rules.pattern_match('next song'):
+                    break
+                time.sleep(0.1)
+
+            self.assertEqual(len(rules.pattern_match('next song')), 1)
+        finally:
+            rules.stop_watching()
+
+    def test_resolve(self):
+        matches, rules = self.rules.resolve('create the file foo')
+        self.assertEqual(matches, [{'id': 'create-file', 'attributes': {'filename': 'foo'}}])
+        self.assertEqual(rules, ['create-test-file-shell-on-create-file'])
+
+    def test_resolve_batch(self):
+        utterances = ['create the file foo', 'remove the file bar', 'nothing here',
+            'create file foo and remove file bar', 'play music artist Led Zeppelin'] * 20
+
+        for processes in (1, 2):
+            results = list(self.rules.resolve_batch(iter(utterances), processes=processes, chunksize=8))
+            self.assertEqual([_[0] for _ in results], utterances)
+
+            for utterance, matches, rules in results:
+                self.assertEqual((matches, rules), self.rules.resolve(utterance))
+
+    def test_resolve_batch_bounded_input(self):
+        consumed = []
+
+        def utterances():
+            for i in range(1000):
+                consumed.append(i)
+                yield 'create the file foo%d' % i
+
+        results = self.rules.resolve_batch(utterances(), processes=2, chunksize=8)
+        self.assertEqual(next(results)[2], ['create-test-file-shell-on-create-file'])
+        self.assertLessEqual(len(consumed), 2 * 8 * 4)
+        self.assertEqual(len(list(results)), 999)
+
+    def test_resolve_batch_forked_workers(self):
+        " The forked workers don't use the singletons whose locks other threads may hold "
+
+        import threading
+        from logger import AsyncLogWriter, Logger
+        from metrics import MetricsRegistry
+        from tracing import Tracer
+
+        locks = [Config._Config__config_lock, Config._Config__subscribers_lock,
+            Logger._Logger__loggers_lock, AsyncLogWriter._AsyncLogWriter__writer_lock,
+            MetricsRegistry._MetricsRegistry__registry_lock, Tracer._Tracer__tracer_lock]
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def hold_locks():
+            for lock in locks:
+                lock.acquire()
+            acquired.set()
+            release.wait()
+            for lock in locks:
+                lock.release()
+
+        holder = threading.Thread(target=hold_locks)
+        holder.start()
+        acquired.wait()
+
+        results = []
+        batch = threading.Thread(target=lambda: results.extend(
+            self.rules.resolve_batch(['create the file foo', 'nothing here'] * 50, processes=2, chunksize=8)))
+        batch.daemon = True
+
+        try:
+            batch.start()
+            batch.join(60)
+            self.assertFalse(batch.is_alive(), 'The batch workers are blocked on a lock held at fork time')
+            self.assertEqual(len(results), 100)
+        finally:
+            release.set()
+            holder.join()
+
+    def test_match_cache(self):
+        from rules import Rules
+        rules = Rules('conf/speech.test.xml', use_cache=False, match_cache_size=2)
+
+        self.assertEqual(rules.resolve('play some music artist Led Zeppelin'),
+            self.rules.resolve('play some music artist Led Zeppelin'))
+        self.assertEqual(rules.get_match_cache_stats(), {'size': 1, 'max_size': 2, 'hits': 0, 'misses': 1})
+
+        # Case variants hit the same entry, attributes keep their current case
+        matches, rule_ids = rules.resolve('PLAY some music artist led zeppelin')
+        self.assertEqual(matches, [{'id': 'play-music', 'attributes': {'artist': 'led zeppelin'}}])
+        self.assertEqual(rules.pattern_match('create the file Foo'), self.rules.pattern_match('create the file Foo'))
+        self.assertEqual(rules.resolve('create the FILE foo')[1], ['create-test-file-shell-on-create-file'])
+        self.assertEqual(rules.get_match_cache_stats(), {'size': 2, 'max_size': 2, 'hits': 2, 'misses': 2})
+
+        # Whitespace variants are matched as they are
+        for string in ('  play some   music artist  Led  Zeppelin ', 'create the file  foo  bar'):
+            self.assertEqual(rules.resolve(string), self.rules.resolve(string))
+            self.assertEqual(rules.pattern_match(string), self.rules.pattern_match(string))
+
+        # Least recently used entry evicted
+        rules.pattern_match('nothing to see here')
+        rules.pattern_match('play some music artist Led Zeppelin')
+        self.assertEqual(rules.get_match_cache_stats()['misses'], 6)
+
+        # Returned results are copies
+        rules.pattern_match('create the file foo')[0]['attributes']['filename'] = 'bar'
+        self.assertEqual(rules.pattern_match('create the file foo')[0]['attributes']['filename'], 'foo')
+
+        rules.reload()
+        self.assertEqual(rules.get_match_cache_stats()['size'], 0)
+        self.assertIsNone(self.rules.get_match_cache_stats())
+
+    def test_match_cache_case_sensitive_patterns(self):
+        from rules import Rules
+
+        rules_file = self.__write_rules_file(
+            patterns='<pattern id="play-mode"><match>play (?-i:MODE) {mode[regex-index=1]}</match></pattern>')
+
+        rules = Rules(rules_file, use_cache=False, match_cache_size=10)
+        self.assertEqual(rules.pattern_match('play MODE shuffle'),
+            [{'id': 'play-mode', 'attributes': {'mode': 'shuffle'}}])
+        self.assertEqual(rules.pattern_match('play mode shuffle'), [])
+        self.assertEqual(rules.get_match_cache_stats()['misses'], 2)
+
+    def test_approximate_match(self):
+        matches = self.rules.approximate_match('plai some musik artist Led Zeppelin')
+        self.assertEqual([(_['id'], _['attributes']) for _ in matches],
+            [('play-music', {'artist': 'Led Zeppelin'})])
+        self.assertGreater(matches[0]['score'], 0.6)
+        self.assertLess(matches[0]['score'], 1)
+
+        self.assertEqual(self.rules.approximate_match('please creat file foo')[0]['attributes'], {'filename': 'foo'})
+        self.assertEqual(self.rules.approximate_match('play some music')[0]['score'], 1)
+        self.assertEqual(self.rules.approximate_match('this will never be matched by any of my rules'), [])
+        self.assertEqual(self.rules.pattern_match('plai some musik'), [])
+
+    def test_approximate_fallback(self):
+        from rules import Rules
+        rules = Rules('conf/speech.test.xml', use_cache=False, approximate=True)
+
+        self.assertEqual(rules.pattern_match('create the file foo'), self.rules.pattern_match('create the file foo'))
+        matches, rule_ids = rules.resolve('please creat the file foo')
+        self.assertEqual([_['id'] for _ in matches], ['create-file'])
+        self.assertEqual(rule_ids, ['create-test-file-shell-on-create-file'])
+        self.assertEqual(rules.pattern_match('this will never be matched by any of my rules'), [])
+
+    def test_approximate_fallback_from_config(self):
+        rules = self.__create_rules({ 'approximate': 'on' })
+        self.assertEqual([_['id'] for _ in rules.resolve('please creat the file foo')[0]], ['create-file'])
+        self.assertEqual(self.__create_rules({ 'approximate': 'off' }).resolve('please creat the file foo'), ([], []))
+
+    def test_resolve_hypotheses(self):
+        hypotheses = [('create the pile foo', 0.9), ('create the file foo', None), ('remove the file foo', None)]
+        result = self.rules.resolve_hypotheses(hypotheses)
+
+        self.assertEqual(result['index'], 1)
+        self.assertEqual(result['transcript'], 'create the file foo')
+        self.assertEqual((result['matches'], result['rule_ids']), self.rules.resolve('create the file foo'))
+
+        hypotheses = [('remove the file foo', 0.2), ('create the file foo', 0.8)]
+        self.assertEqual(self.rules.resolve_hypotheses(hypotheses)['index'], 0)
+        self.assertEqual(self.rules.resolve_hypotheses(hypotheses, threshold=0.5)['index'], 1)
+        self.assertIsNone(self.rules.resolve_hypotheses(hypotheses, threshold=0.9))
+        self.assertIsNone(self.rules.resolve_hypotheses([('nothing here', 1), ('play sóme music', None)]))
+        self.assertIsNone(self.rules.resolve_hypotheses([]))
+
+    def test_first_match_resolution(self):
+        import gc
+        import weakref
+        from rules import Rules
+        from rulesstats import RulesStats
+
+        rules_file = self.__write_rules_file()
+        stats_file = RulesStats(rules_file).stats_file
+        string = 'create the file foo then remove the file bar'
+
+        try:
+            rules = Rules(rules_file, use_cache=False, hit_stats=True)
+            self.assertEqual(rules.resolve(string)[1], ['create-and-remove-test-file-shell-on-double-command'])
+
+            # Without any other hits, patterns are evaluated in rules.xml order
+            matches, rule_ids = rules.resolve_first(string)
+            self.assertEqual([_['id'] for _ in matches], ['create-file'])
+            self.assertEqual(rule_ids, ['create-test-file-shell-on-create-file'])
+
+            for i in range(3):
+                rules.pattern_match('remove the file bar')
+            self.assertEqual(rules.get_pattern_hits(), {'create-file': 2, 'remove-file': 4})
+            rules.save_pattern_hits()
+
+            # Hits are persisted, and the most frequent pattern is evaluated first
+            rules = Rules(rules_file, use_cache=False, hit_stats=True, resolution='first')
+            self.assertEqual(rules.get_pattern_hits(), {'create-file': 2, 'remove-file': 4})
+            matches, rule_ids = rules.resolve(string)
+            self.assertEqual(matches, [{'id': 'remove-file', 'attributes': {'filename': 'bar'}}])
+            self.assertEqual(rule_ids, ['remove-test-file-shell-on-remove-file'])
+            rules.save_pattern_hits()
+
+            self.assertRaises(AttributeError, Rules, rules_file, resolution='random')
+            self.assertIsNone(self.rules.get_pattern_hits())
+
+            # Rules on the same stats file share their counters
+            other_rules = Rules(rules_file, use_cache=False, hit_stats=True)
+            other_rules.pattern_match('create the file foo')
+            self.assertEqual(rules.get_pattern_hits(), {'create-file': 3, 'remove-file': 5})
+
+            # The counters saved at exit don't keep the instances alive
+            stats = weakref.ref(RulesStats(rules_file))
+            gc.collect()
+            self.assertIsNone(stats())
+        finally:
+            if os.path.isfile(stats_file):
+                os.remove(stats_file)
+
+    def test_plugins(self):
+        from plugins import PluginRegistry
+        from rules import Action
+
+        registry = PluginRegistry.get_registry()
+        self.assertEqual(registry.get_plugin_names(),
+            set(['MPD', 'mpd', 'Hue', 'hue', 'LastFM', 'Track', 'SpeechRecognition']))
+
+        custom_registry = PluginRegistry(plugins=[])
+        custom_registry.register('music', 'EmptyTrack')
+        self.assertEqual(custom_registry.get_plugin_names(), set(['EmptyTrack']))
+        self.assertEqual(custom_registry.load('EmptyTrack').__name__, 'EmptyTrack')
+
+        self.assertEqual(Action('no-plugins', 'python', '"MPD.get_mpd() and Hue." + "$$x$$"').get_plugins(), [])
+
+        action = Action('mpd-port', 'python', 'str(MPD.get_mpd().port) + ":" + mpd.host')
+        self.assertEqual(action.get_plugins(), ['MPD', 'mpd'])
+        self.assertEqual(action.run(), '56600:localhost')
+        self.assertIs(registry.load('mpd'), registry.load('MPD').get_mpd())
+
+    def test_warm_plugins_from_config(self):
+        from rules import Rules
+        warmed = []
+
+        class WarmedRules(Rules):
+            def warm_plugins(self, rule_set=None):
+                warmed.append(rule_set)
+
+        self.__create_rules({ 'warm_plugins': 'off' }, WarmedRules)
+        self.assertEqual(warmed, [])
+
+        rules = self.__create_rules({ 'warm_plugins': 'on' }, WarmedRules)
+        self.assertEqual(warmed, [None], 'The plugins should be loaded with the rules')
+        rules.reload()
+        self.assertEqual(len(warmed), 2, 'The plugins should be loaded again on reload')
+
     def test_non_existing_action(self):
         self.assertRaises(KeyError, self.rules.run_action, 'non-existing-action')
 
@@ -51,6 +435,14 @@ class TestTakkRules(unittest.TestCase):
         self.assertEqual(action_ids[0], 'create-test-file-shell')
         self.assertEqual(action_ids[1], 'remove-test-file-shell')
 
+    def test_get_rules_by_patterns_exact_set(self):
+        self.assertEqual(self.rules.get_rules_by_patterns(['remove-file', 'create-file']),
+            ['create-and-remove-test-file-shell-on-double-command'])
+        self.assertEqual(self.rules.get_rules_by_patterns(['create-file', 'create-file']),
+            ['create-test-file-shell-on-create-file'])
+        self.assertEqual(self.rules.get_rules_by_patterns(['create-file', 'remove-file', 'play-music']), [])
+        self.assertEqual(self.rules.get_rules_by_patterns([]), [])
+
     def test_get_rules_by_non_existing_pattern(self):
         rules = self.rules.get_rules_by_patterns(['i-dont-exist'])
         self.assertEqual(len(rules), 0)
@@ -68,6 +460,132 @@ class TestTakkRules(unittest.TestCase):
 
         self.assertFalse(os.path.isfile(self.__dummy_file))
 
+    def test_shell_action_result(self):
+        result = self.rules.run_action('create-test-file-shell', {'filename': self.__dummy_file})
+        self.assertTrue(result.succeeded())
+        self.assertEqual(result.returncode, 0)
+
+        future = self.rules.run_action('remove-test-file-shell', {'filename': self.__dummy_file}, wait=False)
+        self.assertEqual(future.result(timeout=10).returncode, 0)
+        self.assertFalse(os.path.isfile(self.__dummy_file))
+
+        result = self.rules.run_action('remove-test-file-shell', {'filename': self.__dummy_file})
+        self.assertFalse(result.succeeded())
+        self.assertTrue(len(result.stderr) > 0)
+
+    def test_shell_action_timeout(self):
+        from rules import Action
+        result = Action('sleep', 'shell', 'echo started; sleep 10', timeout=0.2).run()
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.stdout.strip(), 'started')
+        self.assertLess(result.duration, 5)
+
+    def test_run_rule(self):
+        # The actions of a rule run concurrently by default, and are reported in THEN order
+        rule_id = 'create-and-remove-test-file-shell-on-double-command'
+        self.assertFalse(self.rules.get_rule_set().rules_map[rule_id]['sequential'])
+        results = self.rules.run_rule(rule_id, {'filename': self.__dummy_file})
+        self.assertEqual([_['id'] for _ in results], ['create-test-file-shell', 'remove-test-file-shell'])
+        self.assertEqual(results[0]['error'], None)
+
+    def test_run_rule_sequential(self):
+        from rules import Rules
+        rules = Rules('conf/speech.sequential.test.xml', use_cache=False)
+        self.assertEqual(Rules('conf/speech.sequential.test.xml', use_cache=False, streaming=True).get_rules(),
+            rules.get_rules())
+
+        rule_id = 'create-and-remove-test-file-shell-on-double-command'
+        self.assertTrue(rules.get_rule_set().rules_map[rule_id]['sequential'])
+        results = rules.run_rule(rule_id, {'filename': self.__dummy_file})
+
+        self.assertEqual([_['id'] for _ in results], ['create-test-file-shell', 'remove-test-file-shell'])
+        self.assertEqual([_['error'] for _ in results], [None, None])
+        self.assertFalse(os.path.isfile(self.__dummy_file))
+
+    def test_tracing(self):
+        from tracing import Tracer
+        tracer = Tracer.get_tracer()
+        enabled = tracer.enabled
+        tracer.enabled = True
+        tracer.clear()
+
+        try:
+            with tracer.span('command') as root:
+                matches, rule_ids = self.rules.resolve('create the file foo')
+                self.rules.run_rule('create-and-remove-test-file-shell-on-double-command',
+                    {'filename': self.__dummy_file})
+
+            self.assertEqual(tracer.get_current_span(), None)
+            spans = tracer.get_trace(root.trace_id)
+            self.assertEqual([_['name'] for _ in spans], ['command', 'rules.resolve', 'rules.run_rule',
+                'rules.run_action', 'rules.run_action'])
+
+            by_name = dict((_['name'], _) for _ in spans)
+            self.assertEqual(by_name['rules.resolve']['parent_id'], root.span_id)
+            self.assertEqual(by_name['rules.resolve']['attributes']['rules'], 1)
+
+            # Actions run on the action pool are children of the rule span
+            self.assertEqual(set(_['parent_id'] for _ in spans if _['name'] == 'rules.run_action'),
+                set([by_name['rules.run_rule']['span_id']]))
+            self.assertTrue(all(_['duration_ms'] >= 0 for _ in spans))
+            self.assertTrue(by_name['command']['duration_ms'] >= by_name['rules.run_rule']['duration_ms'])
+
+            with self.assertRaises(KeyError):
+                with tracer.span('failed'):
+                    self.rules.run_action('non-existing-action')
+            self.assertEqual(tracer.get_spans()[-1].name, 'failed')
+            self.assertTrue(tracer.get_spans()[-1].error.startswith('KeyError'))
+        finally:
+            tracer.enabled = enabled
+            tracer.clear()
+
+        self.rules.resolve('create the file foo')
+        self.assertEqual(tracer.get_spans(), [], 'Nothing should be traced when tracing is disabled')
+
+    def test_run_rule_dependencies(self):
+        from rules import Rules
+
+        rules_file = self.__write_rules_file(rules='''
+            <rule id="dependencies">
+                <on><pattern id="play-music"/></on>
+                <then>
+                    <action id="remove-test-file-shell" after="create-test-file-python"/>
+                    <action id="create-test-file-python"/>
+                    <action id="remove-test-file-python" after="remove-test-file-shell"/>
+                </then>
+            </rule>''')
+
+        results = Rules(rules_file, use_cache=False).run_rule('dependencies', {'filename': self.__dummy_file})
+        self.assertEqual(results[1]['error'], None)
+        self.assertEqual(results[0]['error'], None)
+        self.assertFalse(os.path.isfile(self.__dummy_file))
+
+        # remove-test-file-python fails on the missing file and its dependants are skipped
+        self.__write_rules_file(rules='''
+            <rule id="dependencies">
+                <on><pattern id="play-music"/></on>
+                <then>
+                    <action id="remove-test-file-python"/>
+                    <action id="create-test-file-shell" after="remove-test-file-python"/>
+                </then>
+            </rule>''')
+
+        results = Rules(rules_file, use_cache=False).run_rule('dependencies', {'filename': self.__dummy_file})
+        self.assertTrue(isinstance(results[0]['error'], OSError))
+        self.assertTrue(isinstance(results[1]['error'], RuntimeError))
+        self.assertFalse(os.path.isfile(self.__dummy_file))
+
+        self.__write_rules_file(rules='''
+            <rule id="dependencies">
+                <on><pattern id="play-music"/></on>
+                <then>
+                    <action id="remove-test-file-python" after="create-test-file-shell"/>
+                    <action id="create-test-file-shell" after="remove-test-file-python"/>
+                </then>
+            </rule>''')
+
+        self.assertRaises(AttributeError, Rules, rules_file, use_cache=False)
+
     def test_python_action(self):
         self.rules.run_action('create-test-file-python',
             {'filename': self.__dummy_file }
@@ -81,10 +599,75 @@ class TestTakkRules(unittest.TestCase):
 
         self.assertFalse(os.path.isfile(self.__dummy_file))
 
+    def test_python_action_arguments_binding(self):
+        from rules import Action
+        action = Action('write-file', 'python',
+            'open("$$filename$$", "w").write("$$first$$ and $$second$$")')
+
+        self.assertEqual(action.get_arguments(), ['filename', 'first', 'second'])
+        action.run({'filename': self.__dummy_file, 'first': 'one "quoted"', 'second': 'two'})
+
+        with open(self.__dummy_file) as fp:
+            self.assertEqual(fp.read(), 'one "quoted" and two')
+
+    def test_python_action_implicit_concatenation(self):
+        from rules import Action
+        action = Action('write-file', 'python',
+            'open("$$filename$$", "w").write("Hello " "$$name$$"\n    \'!\')')
+
+        self.assertEqual(action.get_arguments(), ['filename', 'name'])
+        action.run({'filename': self.__dummy_file, 'name': 'Bob'})
+
+        with open(self.__dummy_file) as fp:
+            self.assertEqual(fp.read(), 'Hello Bob!')
+
+    def test_python_action_unbound_placeholder(self):
+        from rules import Action
+        action = Action('write-file', 'python', 'open("%s", "w").write(str($$value$$ + 1))' % self.__dummy_file)
+
+        self.assertEqual(action.get_arguments(), [])
+        action.run({'value': '41'})
+
+        with open(self.__dummy_file) as fp:
+            self.assertEqual(fp.read(), '42')
+
     def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
         if os.path.isfile(self.__dummy_file):
             os.remove(self.__dummy_file)
 
+class TestSpeechRecognition(unittest.TestCase):
+    def setUp(self):
+        Config.get_config('conf/main.test.conf')
+
+    def test_parse_alternatives(self):
+        from speechrecognition import SpeechRecognition
+        response = '{"result":[]}\n' + \
+            '{"result":[{"alternative":[{"transcript":"turn on the light","confidence":0.87},' + \
+            '{"transcript":"turn on the lights"},{"transcript":"turn of the light"}],"final":true}],"result_index":0}\n'
+
+        self.assertEqual(SpeechRecognition.parse_alternatives(response), [
+            ('turn on the light', 0.87), ('turn on the lights', None), ('turn of the light', None)])
+
+        response = '{"result":[{"alternative":[{"transcript":"play some music"}],"final":true}]}'
+        self.assertEqual(SpeechRecognition.parse_alternatives(response), [('play some music', 1)])
+
+    def test_parse_no_alternatives(self):
+        from speechrecognition import SpeechRecognition, SpeechRecognitionError
+        self.assertRaises(SpeechRecognitionError, SpeechRecognition.parse_alternatives, '{"result":[]}\n')
+        self.assertRaises(SpeechRecognitionError, SpeechRecognition.parse_alternatives,
+            '{"result":[{"alternative":[],"final":true}]}')
+        self.assertRaises(SpeechRecognitionError, SpeechRecognition.parse_alternatives,
+            '{"result":[{"alternative":[{"transcript":"partial"}]}]}')
+
+    def test_literals_search_many(self):
+        from patternmatcher import AhoCorasick
+        automaton = AhoCorasick(['turn', 'on', 'light', 'lights', 'off', 'music'])
+        strings = ['turn on the light', 'turn on the lights', 'turn off the light', '',
+            'turn on the light', 'play some music', 'turn']
+
+        self.assertEqual(automaton.search_many(strings), [automaton.search(_) for _ in strings])
+
 if __name__ == "__main__":
     unittest.main()
 